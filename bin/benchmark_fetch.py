@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import io
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+from PIL import Image
+
+from saicinpainting.inference.fetching import UrlFetcher
+
+
+def make_png(height, width, channels, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (height, width, channels) if channels > 1 else (height, width)
+    buf = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def make_server(files, connect_ms, request_ms):
+    """Threaded HTTP/1.1 server of files by path, with a delay per new connection and per request
+
+    The connection delay stands for the TCP and TLS handshakes of a remote host, the request delay for its
+    time to first byte.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            time.sleep(connect_ms / 1000)
+            super().setup()
+
+        def do_GET(self):
+            time.sleep(request_ms / 1000)
+            data = files.get(self.path)
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fetch_serial(urls):
+    """What the handlers did before UrlFetcher: one requests.get, and so one new connection, per input"""
+    for url in urls.values():
+        resp = requests.get(url, timeout=60)
+        resp.raise_for_status()
+        _ = resp.content
+
+
+def measure(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started_at) * 1000)
+    return statistics.median(timings)
+
+
+def main(args):
+    files = {'/image.png': make_png(args.height, args.width, 3), '/mask.png': make_png(args.height, args.width, 1)}
+    server = make_server(files, args.connect_ms, args.request_ms)
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    urls = {'image': base + '/image.png', 'mask': base + '/mask.png'}
+    print(f'Serving {args.height}x{args.width} image ({len(files["/image.png"]) / 1024:.0f} KB) and mask '
+          f'({len(files["/mask.png"]) / 1024:.0f} KB), {args.connect_ms:g} ms per connection, '
+          f'{args.request_ms:g} ms per request')
+
+    def fetch_cold():
+        fetcher = UrlFetcher(args.pool_size, progressive=args.progressive)
+        fetcher.fetch_all(urls)
+        fetcher.close()
+
+    fetcher = UrlFetcher(args.pool_size, progressive=args.progressive)
+    fetcher.fetch_all(urls)  # opens the pooled connections
+
+    rows = [('serial requests.get', measure(lambda: fetch_serial(urls), args.repeats)),
+            ('pooled concurrent, cold', measure(fetch_cold, args.repeats)),
+            ('pooled concurrent, warm', measure(lambda: fetcher.fetch_all(urls), args.repeats))]
+    fetcher.close()
+    server.shutdown()
+
+    print(f'{"":<24} {"median ms":>9}')
+    for name, ms in rows:
+        print(f'{name:<24} {ms:9.0f}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Fetching the image and mask URLs of one request: serial '
+                                                  'requests.get vs UrlFetcher (pooled keep-alive connections, '
+                                                  'concurrent downloads), against a local server that adds '
+                                                  'connection and request latency')
+    aparser.add_argument('--height', type=int, default=1600)
+    aparser.add_argument('--width', type=int, default=1100)
+    aparser.add_argument('--connect-ms', type=float, default=100, help='Delay of every new connection')
+    aparser.add_argument('--request-ms', type=float, default=50, help='Delay of every request')
+    aparser.add_argument('--pool-size', type=int, default=8, help='FETCH_POOL_SIZE of the handler')
+    aparser.add_argument('--progressive', action='store_true', help='As FETCH_PROGRESSIVE=1')
+    aparser.add_argument('--repeats', type=int, default=10)
+
+    main(aparser.parse_args())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import time
+
+import cv2
+import numpy as np
+import torch
+from scipy import ndimage
+
+from saicinpainting.inference.mask_processing import get_resize_scale, process_mask, process_mask_tensor
+
+
+def process_mask_full_res(mask, blur_radius=5, feather_amount=0.1):
+    """The handler mask processing before it moved to model resolution, on the full-resolution page"""
+    processed_mask = mask.copy().astype(np.float32) / 255.0
+    processed_mask = ndimage.gaussian_filter(processed_mask, sigma=blur_radius / 3.0)
+    if feather_amount > 0:
+        kernel_size = max(3, int(blur_radius * feather_amount))
+        kernel = np.ones((kernel_size, kernel_size), np.float32) / (kernel_size * kernel_size)
+        processed_mask = cv2.filter2D(processed_mask, -1, kernel)
+    return np.clip(processed_mask * 255.0, 0, 255).astype(np.uint8)
+
+
+def fit_size(width, height, max_size):
+    ratio = min(1.0, max_size / max(width, height))
+    return max(8, int(width * ratio) // 8 * 8), max(8, int(height * ratio) // 8 * 8)
+
+
+def old_pipeline(mask, size, blur_radius, feather_amount):
+    return cv2.resize(process_mask_full_res(mask, blur_radius, feather_amount), size, interpolation=cv2.INTER_NEAREST)
+
+
+def new_pipeline(mask, size, blur_radius, feather_amount):
+    scale = get_resize_scale(mask.shape[::-1], size)
+    return process_mask(cv2.resize(mask, size, interpolation=cv2.INTER_AREA), blur_radius, feather_amount, scale)
+
+
+def torch_pipeline(mask, size, blur_radius, feather_amount, device='cpu'):
+    scale = get_resize_scale(mask.shape[::-1], size)
+    masks = torch.from_numpy(cv2.resize(mask, size, interpolation=cv2.INTER_AREA)).to(device)[None, None]
+    processed = process_mask_tensor(masks.float() / 255.0, blur_radius, feather_amount, scale)
+    return processed[0, 0].mul(255.0).round().to(torch.uint8).cpu().numpy()
+
+
+def measure(fn, repeats, *args):
+    fn(*args)  # warm-up, kernels are cached from here on
+    started_at = time.perf_counter()
+    for _ in range(repeats):
+        result = fn(*args)
+    return result, (time.perf_counter() - started_at) / repeats * 1000
+
+
+def make_mask(height, width, seed=0):
+    """Random strokes and blobs, like speech bubble and text masks"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), np.uint8)
+    for _ in range(40):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if rng.random() < 0.5:
+            cv2.ellipse(mask, (x, y), (int(rng.integers(10, 120)), int(rng.integers(10, 80))), 0, 0, 360, 255, -1)
+        else:
+            cv2.line(mask, (x, y), (x + int(rng.integers(-200, 200)), y + int(rng.integers(-200, 200))), 255,
+                     int(rng.integers(1, 6)))
+    return mask
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.mask:
+        masks = [cv2.imread(args.mask, cv2.IMREAD_GRAYSCALE)]
+    else:
+        masks = [make_mask(height, width) for height, width in args.sizes]
+
+    print(f'{"page":>11} {"model":>11} {"full-res ms":>11} {"cv2 ms":>8} {"torch ms":>8} {"speedup":>8} '
+          f'{"cv2 IoU":>8} {"torch IoU":>9}')
+    for mask in masks:
+        height, width = mask.shape
+        size = fit_size(width, height, args.max_size)
+        inputs = (mask, size, args.blur_radius, args.feather_amount)
+        old, old_ms = measure(old_pipeline, args.repeats, *inputs)
+        new, new_ms = measure(new_pipeline, args.repeats, *inputs)
+        with torch.no_grad():
+            on_torch, torch_ms = measure(torch_pipeline, args.repeats, *inputs, args.device)
+        ious = [((old > 0) & (other > 0)).sum() / max(1, ((old > 0) | (other > 0)).sum()) for other in (new, on_torch)]
+        print(f'{height:>5}x{width:<5} {size[1]:>5}x{size[0]:<5} {old_ms:11.1f} {new_ms:8.1f} {torch_ms:8.1f} '
+              f'{old_ms / new_ms:7.1f}x {ious[0]:8.4f} {ious[1]:9.4f}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Mask processing of the handler: blurring at full resolution '
+                                                  'then resizing vs resizing then blurring with separable cached '
+                                                  'kernels (OpenCV and torch), time and IoU of the binarized masks')
+    aparser.add_argument('--mask', default=None, help='Mask image to use instead of random masks of --sizes')
+    aparser.add_argument('--sizes', type=lambda s: [tuple(int(side) for side in size.split('x'))
+                                                    for size in s.split(',')],
+                         default=[(1600, 1100), (3200, 2200), (6400, 4400)], help='Comma-separated HxW page sizes')
+    aparser.add_argument('--max-size', type=int, default=1024, help='MAX_SIZE of the handler')
+    aparser.add_argument('--blur-radius', type=float, default=5)
+    aparser.add_argument('--feather-amount', type=float, default=0.1)
+    aparser.add_argument('--device', default='cpu', help='Device of the torch variant')
+    aparser.add_argument('--repeats', type=int, default=5)
+    aparser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for default')
+
+    main(aparser.parse_args())
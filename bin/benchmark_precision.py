@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import copy
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.model import load_model
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.precision import apply_precision
+from saicinpainting.inference.quantization import psnr
+
+MODES = [('fp32', False), ('fp32', True), ('bf16', False), ('bf16', True)]
+
+
+def load_input(image_path, mask_path, size):
+    """Page and binary mask resized so that the longer side is size, cropped to a multiple of 8"""
+    image = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    ratio = size / max(image.shape[:2])
+    height, width = (int(side * ratio) // 8 * 8 for side in image.shape[:2])
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+    return dict(image=torch.from_numpy(image.transpose(2, 0, 1).astype('float32') / 255)[None],
+                mask=torch.from_numpy((mask > 0).astype('float32'))[None, None])
+
+
+@torch.no_grad()
+def run(model, batch, repeats):
+    model(dict(batch))  # warm-up
+    started_at = time.perf_counter()
+    for _ in range(repeats):
+        output = model(dict(batch))
+    return output, (time.perf_counter() - started_at) / repeats * 1000
+
+
+def main(args):
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    base = load_model(load_serving_config(config_path), weights_path)
+    optimize_for_inference(base.generator)
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+
+    print(f'{"size":>10} {"mode":>20} {"ms":>8} {"speedup":>8} {"PSNR dB":>8} {"inpainted max diff":>18}')
+    for size in args.sizes:
+        batch = load_input(args.image, args.mask, size)
+        reference = None
+        for precision, channels_last in MODES:
+            model = apply_precision(copy.deepcopy(base), precision, channels_last)
+            output, latency = run(model, batch, args.repeats)
+            if reference is None:
+                reference, reference_latency = output, latency
+            height, width = batch['image'].shape[2:]
+            mode = precision + (' channels_last' if channels_last else '')
+            print(f'{height:>4}x{width:<5} {mode:>20} {latency:8.0f} {reference_latency / latency:7.2f}x '
+                  f'{psnr(output["predicted_image"], reference["predicted_image"]):8.2f} '
+                  f'{float((output["inpainted"] - reference["inpainted"]).abs().max()) * 255:18.1f}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Latency and output drift of channels_last and bf16 autocast '
+                                                  'against fp32, to choose PRECISION/CHANNELS_LAST per deployment')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('image', help='Page to inpaint, resized to each of --sizes')
+    aparser.add_argument('mask', help='Its mask')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--sizes', type=lambda s: [int(size) for size in s.split(',')], default=[512, 1024, 1536],
+                         help='Comma-separated longer sides')
+    aparser.add_argument('--repeats', type=int, default=3)
+    aparser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for default')
+
+    main(aparser.parse_args())
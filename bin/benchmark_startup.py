@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import sys
+
+LEGACY = '''
+import os, time
+started_at = time.perf_counter()
+import torch, yaml
+from omegaconf import OmegaConf
+from saicinpainting.training.trainers import load_checkpoint
+imported_at = time.perf_counter()
+with open(os.path.join(MODEL_DIR, 'config.yaml')) as f:
+    config = OmegaConf.create(yaml.safe_load(f))
+config.training_model.predict_only = True
+config.visualizer.kind = 'noop'
+model = load_checkpoint(config, os.path.join(MODEL_DIR, 'models', CHECKPOINT), strict=False, map_location='cpu')
+model.freeze()
+'''
+
+INFERENCE = '''
+import os, time
+started_at = time.perf_counter()
+import torch
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.model import load_model
+imported_at = time.perf_counter()
+weights_path, config_path = get_serving_paths(MODEL_DIR, CHECKPOINT)
+model = load_model(load_serving_config(config_path), weights_path)
+'''
+
+REPORT = '''
+import json, resource, sys
+loaded_at = time.perf_counter()
+heavy = ['pytorch_lightning', 'pandas', 'sklearn', 'joblib', 'kornia', 'saicinpainting.evaluation.evaluator']
+print(json.dumps(dict(import_s=imported_at - started_at, load_s=loaded_at - imported_at,
+                      total_s=loaded_at - started_at,
+                      max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                      modules=len(sys.modules), heavy=[name for name in heavy if name in sys.modules])))
+'''
+
+
+def run(code, args):
+    prelude = f'MODEL_DIR = {args.model_dir!r}\nCHECKPOINT = {args.checkpoint!r}\n'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get('PYTHONPATH')])))
+    output = subprocess.run([sys.executable, '-c', prelude + code + REPORT], env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    from saicinpainting.inference.checkpoint import get_serving_paths
+
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    if not (os.path.exists(weights_path) and os.path.exists(config_path)):
+        sys.exit(f'{weights_path} not found, run bin/convert_serving_checkpoint.py {args.model_dir} first')
+
+    for name, code in (('load_checkpoint', LEGACY), ('saicinpainting.inference', INFERENCE)):
+        runs = [run(code, args) for _ in range(args.repeats)]
+        best = min(runs, key=lambda r: r['total_s'])
+        print(f'{name:>26}: import {best["import_s"]:.2f}s, load {best["load_s"]:.2f}s, '
+              f'total {best["total_s"]:.2f}s, max RSS {best["max_rss_mb"]:.0f} MB, '
+              f'{best["modules"]} modules, heavy: {", ".join(best["heavy"]) or "-"}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Cold start of the full training module vs the inference-only model, '
+                                                  'each measured in a fresh interpreter')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--repeats', type=int, default=3, help='Best of this many runs is reported')
+
+    main(aparser.parse_args())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import ctypes
+import os
+import re
+
+import torch
+
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.memory import MemoryModel
+from saicinpainting.inference.model import load_model
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.precision import apply_precision
+
+
+def parse_size(value):
+    """'1024' -> (1024, 1024), '768x1024' -> (768, 1024) as (height, width), floored to multiples of 8"""
+    height, _, width = value.partition('x')
+    return int(height) // 8 * 8, int(width or height) // 8 * 8
+
+
+def _read_status(name):
+    with open('/proc/self/status') as f:
+        return int(re.search(rf'{name}:\s+(\d+) kB', f.read()).group(1)) * 1024
+
+
+def _release_free_memory():
+    """Hands freed malloc arenas back to the OS, so that the next run starts from the resident baseline"""
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+@torch.no_grad()
+def measure_peak_bytes(model, device, height, width, batch_size):
+    """Peak memory growth of one forward pass: CUDA allocator peak, or peak RSS over the resident baseline"""
+    batch = {'image': torch.rand(batch_size, 3, height, width, device=device),
+             'mask': (torch.rand(batch_size, 1, height, width, device=device) > 0.7).float()}
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        baseline = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        model(batch)
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - baseline
+    _release_free_memory()
+    baseline = _read_status('VmRSS')
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')  # resets VmHWM to the current RSS
+    model(batch)
+    return _read_status('VmHWM') - baseline
+
+
+def main(args):
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    device = torch.device(args.device)
+    model = load_model(load_serving_config(config_path), weights_path, device=args.device)
+    if args.optimize:
+        optimize_for_inference(model.generator)
+    model = apply_precision(model, args.precision, args.channels_last, device_type=device.type)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # warm-up: one-time allocations and kernel selection are not activation memory
+    measure_peak_bytes(model, device, *args.sizes[0], 1)
+
+    points = []
+    print(f'{"size":>10} {"batch":>5} {"peak MB":>9} {"B/px":>7}')
+    for batch_size in args.batch_sizes:
+        for height, width in args.sizes:
+            peak = max(measure_peak_bytes(model, device, height, width, batch_size) for _ in range(args.repeats))
+            points.append(dict(height=height, width=width, batch_size=batch_size, peak_bytes=peak))
+            print(f'{height:>4}x{width:<5} {batch_size:>5} {peak / 2 ** 20:9.0f} {peak / (height * width * batch_size):7.0f}')
+
+    memory_model = MemoryModel.fit(points, device=str(device), precision=args.precision,
+                                   channels_last=args.channels_last, optimize=args.optimize)
+    print(f'\n{memory_model}, predicted vs measured:')
+    for point in points:
+        predicted = memory_model.peak_bytes(point['height'], point['width'], point['batch_size'])
+        print(f'{point["height"]:>4}x{point["width"]:<5} {point["batch_size"]:>5} {predicted / 2 ** 20:9.0f} MB '
+              f'{(predicted - point["peak_bytes"]) / 2 ** 20:+7.0f} MB')
+
+    output = args.output or os.path.join(args.model_dir, 'memory_model.json')
+    memory_model.save(output)
+    print(f'\nWrote {output} (MEMORY_MODEL of rp_handler_cpu)')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Measures the peak memory of generator forward passes for '
+                                                  'growing input and batch sizes and fits the memory cost model '
+                                                  'used by the admission control of rp_handler_cpu. Run it with '
+                                                  'the RUNTIME_* env, device and precision of the deployment')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--sizes', type=lambda s: [parse_size(size) for size in s.split(',')],
+                         default=[parse_size(size) for size in ('256', '512', '512x768', '768', '1024')],
+                         help='Comma-separated input sizes, a side or HxW')
+    aparser.add_argument('--batch-sizes', type=lambda s: [int(b) for b in s.split(',')], default=[1, 2],
+                         help='Comma-separated batch sizes')
+    aparser.add_argument('--device', default='cpu')
+    aparser.add_argument('--precision', default='fp32', help='fp32 or bf16, as PRECISION')
+    aparser.add_argument('--channels-last', action='store_true', help='As CHANNELS_LAST=1')
+    aparser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                         help='Measure the generator without BatchNorm folding (as with OPTIMIZE=0)')
+    aparser.add_argument('--repeats', type=int, default=2, help='Runs per point, the largest peak is kept')
+    aparser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for default')
+    aparser.add_argument('--output', default=None, help='Output path, <model_dir>/memory_model.json by default')
+
+    main(aparser.parse_args())
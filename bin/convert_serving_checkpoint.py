@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import os
+
+import yaml
+from omegaconf import OmegaConf
+
+from saicinpainting.inference.checkpoint import convert_checkpoint, get_serving_paths
+
+
+def main(args):
+    with open(os.path.join(args.model_dir, 'config.yaml'), 'r') as f:
+        train_config = OmegaConf.create(yaml.safe_load(f))
+    train_config.training_model.predict_only = True
+
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    convert_checkpoint(train_config, os.path.join(args.model_dir, 'models', args.checkpoint),
+                       weights_path, config_path)
+    print(f'Wrote {weights_path} and {config_path}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser()
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+
+    main(aparser.parse_args())
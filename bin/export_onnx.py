@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.model import load_model
+from saicinpainting.inference.onnx_backend import OnnxInpaintingModel, check_parity, export_onnx
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_sizes(s):
+    return [tuple(int(side) for side in size.split('x')) for size in s.split(',')]
+
+
+def main(args):
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    if not os.path.exists(weights_path):
+        raise FileNotFoundError(f'{weights_path} not found, run bin/convert_serving_checkpoint.py first')
+    model = load_model(load_serving_config(config_path), weights_path)
+
+    outpath = args.outpath or os.path.splitext(weights_path)[0] + '.onnx'
+    export_onnx(model, outpath, fft=args.fft, opset=args.opset)
+    print(f'Wrote {outpath}')
+
+    if args.check_sizes:
+        onnx_model = OnnxInpaintingModel(outpath, threads=args.threads)
+        for row in check_parity(model, onnx_model, parse_sizes(args.check_sizes), repeats=args.repeats):
+            height, width = row['size']
+            print(f'{height}x{width}: max abs diff {row["max_abs_diff"]:.2e}, '
+                  f'torch {row["torch_ms"]} ms, onnxruntime {row["onnx_ms"]} ms')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    aparser = argparse.ArgumentParser(description='Export the generator to ONNX with dynamic height and width, '
+                                                  'then check parity and latency against PyTorch')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--outpath', default=None, help='Defaults to models/<checkpoint>.generator.onnx')
+    aparser.add_argument('--fft', choices=['dft', 'matmul'], default='matmul',
+                         help='ONNX DFT op or DFT as matrix products built from the input shape')
+    aparser.add_argument('--opset', type=int, default=None,
+                         help='ONNX opset, 17 for the matmul FFT and 20 for the DFT op by default')
+    aparser.add_argument('--check-sizes', default='256x256,512x384,768x1024',
+                         help='Comma-separated HxW sizes for the parity check, empty to skip')
+    aparser.add_argument('--repeats', type=int, default=3)
+    aparser.add_argument('--threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 for default')
+
+    main(aparser.parse_args())
@@ -11,13 +11,16 @@ import os
 import sys
 import traceback
 
+from saicinpainting.runtime import configure_runtime, get_runtime_config
+
+# one thread per process unless RUNTIME_THREADS or RUNTIME_CONFIG say otherwise
+configure_runtime(get_runtime_config(default_threads=1))
+
 from saicinpainting.evaluation.utils import move_to_device
 from saicinpainting.evaluation.refinement import refine_predict
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.precision import apply_precision
+from saicinpainting.inference.tiling import tiled_inpaint
 
 import cv2
 import hydra
@@ -59,12 +62,19 @@ def main(predict_config: OmegaConf):
                                        predict_config.model.checkpoint)
         model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location='cpu')
         model.freeze()
+        if predict_config.get('optimize', True):
+            optimize_for_inference(model.generator)
         if not predict_config.get('refine', False):
             model.to(device)
+            model = apply_precision(model, predict_config.get('precision', 'fp32'),
+                                    predict_config.get('channels_last', False), device_type=device.type)
 
         if not predict_config.indir.endswith('/'):
             predict_config.indir += '/'
 
+        tiling = predict_config.get('tiling', None)
+        use_tiling = tiling is not None and tiling.get('enabled', False)
+
         dataset = make_default_val_dataset(predict_config.indir, **predict_config.dataset)
         for img_i in tqdm.trange(len(dataset)):
             mask_fname = dataset.mask_filenames[img_i]
@@ -84,7 +94,15 @@ def main(predict_config: OmegaConf):
                 with torch.no_grad():
                     batch = move_to_device(batch, device)
                     batch['mask'] = (batch['mask'] > 0) * 1
-                    batch = model(batch)                    
+                    if use_tiling:
+                        # tiled inference only produces the blended 'inpainted' output
+                        batch['inpainted'] = tiled_inpaint(model, batch,
+                                                           tile_size=tiling.tile_size,
+                                                           overlap=tiling.overlap,
+                                                           context_size=tiling.get('context_size', None),
+                                                           modulo=predict_config.dataset.pad_out_to_modulo)
+                    else:
+                        batch = model(batch)
                     cur_res = batch[predict_config.out_key][0].permute(1, 2, 0).detach().cpu().numpy()
                     unpad_to_size = batch.get('unpad_to_size', None)
                     if unpad_to_size is not None:
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+
+import torch
+
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.model import load_model
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.profiling import LayerProfiler
+
+
+def parse_size(value):
+    """'1024' -> (1024, 1024), '768x1024' -> (768, 1024) as (height, width), floored to multiples of 8"""
+    height, _, width = value.partition('x')
+    return int(height) // 8 * 8, int(width or height) // 8 * 8
+
+
+def make_input(model, height, width):
+    image = torch.rand(1, 3, height, width)
+    mask = (torch.rand(1, 1, height, width) > 0.7).float()
+    masked = image * (1 - mask)
+    return torch.cat([masked, mask], dim=1) if model.concat_mask else masked
+
+
+@torch.no_grad()
+def profile(generator, inputs):
+    generator(inputs)  # warm-up, allocations and kernel selection are not part of the profile
+    with LayerProfiler(generator) as profiler:
+        generator(inputs)
+    return profiler
+
+
+def print_top(profiler, n):
+    print(f'  {"self ms":>9} {"total ms":>9} {"GFLOP":>7} {"out MB":>7}  module')
+    for event in profiler.top(n):
+        print(f'  {event["self_ms"]:9.1f} {event["total_ms"]:9.1f} {event["flops"] / 1e9:7.2f} '
+              f'{event["output_bytes"] / 2 ** 20:7.1f}  {event["name"]} ({event["type"]}, {event["category"]})')
+
+
+def main(args):
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    model = load_model(load_serving_config(config_path), weights_path)
+    if args.optimize:
+        optimize_for_inference(model.generator)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.trace_dir:
+        os.makedirs(args.trace_dir, exist_ok=True)
+
+    print(f'{"size":>10} {"total ms":>9} {"conv ms":>9} {"fft ms":>9} {"norm/act":>9} {"other":>9} '
+          f'{"local ms":>9} {"spectral":>9} {"fft %":>6} {"GFLOP":>7} {"max act MB":>10}')
+    profilers = []
+    for height, width in args.sizes:
+        profiler = profile(model.generator, make_input(model, height, width))
+        summary = profiler.summary()
+        categories = summary['by_category_ms']
+        print(f'{height:>4}x{width:<5} {summary["total_ms"]:9.0f} {categories.get("conv", 0):9.0f} '
+              f'{categories.get("fft", 0):9.0f} {categories.get("norm_act", 0):9.0f} {categories.get("other", 0):9.0f} '
+              f'{summary["local_ms"]:9.0f} {summary["spectral_ms"]:9.0f} '
+              f'{categories.get("fft", 0) / summary["total_ms"] * 100:5.1f}% {summary["gflops"]:7.1f} '
+              f'{summary["max_activation_bytes"] / 2 ** 20:10.1f}')
+        if args.trace_dir:
+            name = os.path.join(args.trace_dir, f'generator_{height}x{width}')
+            profiler.export_chrome_trace(name + '.trace.json')
+            profiler.export_folded_stacks(name + '.folded')
+        profilers.append(((height, width), profiler))
+
+    for (height, width), profiler in profilers[-1:]:
+        print(f'\nTop {args.top} module calls by self time at {height}x{width}:')
+        print_top(profiler, args.top)
+    if args.trace_dir:
+        print(f'\nWrote <size>.trace.json (chrome://tracing, ui.perfetto.dev) and <size>.folded (flamegraph.pl, '
+              f'speedscope) to {args.trace_dir}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Per-layer wall time, flops and activation memory of the '
+                                                  'generator, with local conv vs spectral (FFT) branches split, '
+                                                  'for growing input sizes')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--sizes', type=lambda s: [parse_size(size) for size in s.split(',')],
+                         default=[parse_size('512'), parse_size('1024'), parse_size('1536')],
+                         help='Comma-separated input sizes, a side or HxW')
+    aparser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                         help='Profile the generator without BatchNorm folding (as with OPTIMIZE=0)')
+    aparser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for default')
+    aparser.add_argument('--top', type=int, default=15, help='Module calls to list for the largest size')
+    aparser.add_argument('--trace-dir', default=None, help='Write a Chrome trace and folded stacks per size here')
+
+    main(aparser.parse_args())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import copy
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from saicinpainting.evaluation.data import InpaintingDataset
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.model import load_model
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.quantization import compare_models, get_state_dict_size, quantize_model
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_batches(datadir, img_suffix, max_size, limit):
+    """Pages and their masks from datadir (name.png + name_mask*.png, like bin/predict.py), downscaled to max_size"""
+    dataset = InpaintingDataset(datadir, img_suffix=img_suffix)
+    batches = []
+    for i in range(min(len(dataset), limit) if limit else len(dataset)):
+        item = dataset[i]
+        image = torch.from_numpy(item['image'])[None]
+        mask = (torch.from_numpy(item['mask'])[None] > 0).float()
+        height, width = image.shape[2:]
+        ratio = min(1.0, max_size / max(height, width))
+        size = (max(8, int(height * ratio) // 8 * 8), max(8, int(width * ratio) // 8 * 8))
+        batches.append(dict(image=F.interpolate(image, size=size, mode='area'),
+                            mask=(F.interpolate(mask, size=size, mode='nearest') > 0).float()))
+    if not batches:
+        raise ValueError(f'No masks matching *mask*.png found in {datadir}')
+    return batches
+
+
+def make_lpips():
+    try:
+        from saicinpainting.evaluation.losses.lpips import PerceptualLoss
+        return PerceptualLoss(model='net-lin', net='vgg', use_gpu=False).eval()
+    except Exception as ex:
+        LOGGER.warning(f'LPIPS is not available, reporting PSNR only: {ex}')
+        return None
+
+
+def main(args):
+    weights_path, config_path = get_serving_paths(args.model_dir, args.checkpoint)
+    config = load_serving_config(config_path)
+    fp32_model = load_model(config, weights_path)
+    batches = load_batches(args.datadir, args.img_suffix, args.max_size, args.limit)
+    LOGGER.info(f'Calibrating on {len(batches)} pages')
+
+    # BatchNorm is folded first, so the int8 convs include it; rp_handler_cpu rebuilds the same structure
+    int8_model = copy.deepcopy(fp32_model)
+    optimize_for_inference(int8_model.generator)
+    int8_model = quantize_model(int8_model, batches, backend=args.backend)
+    outpath = args.outpath or os.path.splitext(weights_path)[0] + '.int8.pt'
+    torch.save(int8_model.generator.state_dict(), outpath)
+    print(f'Wrote {outpath}')
+
+    rows = compare_models(fp32_model, int8_model, batches, lpips=make_lpips())
+    fp32_ms = np.mean([row['reference_ms'] for row in rows])
+    int8_ms = np.mean([row['candidate_ms'] for row in rows])
+    fp32_size = get_state_dict_size(fp32_model.generator)
+    int8_size = get_state_dict_size(int8_model.generator)
+    print(f'latency: fp32 {fp32_ms:.0f} ms, int8 {int8_ms:.0f} ms ({fp32_ms / int8_ms:.2f}x)')
+    print(f'size: fp32 {fp32_size / 2 ** 20:.1f} MB, int8 {int8_size / 2 ** 20:.1f} MB')
+    print(f'int8 vs fp32 output: PSNR mean {np.mean([row["psnr"] for row in rows]):.2f} dB, '
+          f'min {np.min([row["psnr"] for row in rows]):.2f} dB'
+          + (f', LPIPS mean {np.mean([row["lpips"] for row in rows]):.4f}' if 'lpips' in rows[0] else ''))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    aparser = argparse.ArgumentParser(description='Post-training int8 quantization of the generator, calibrated on '
+                                                  'real pages, with a latency/size/quality report against fp32')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('datadir', help='Calibration pages and masks: name<img_suffix> and name_mask*.png')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--outpath', default=None, help='Defaults to models/<checkpoint>.generator.int8.pt')
+    aparser.add_argument('--img-suffix', default='.png')
+    aparser.add_argument('--max-size', type=int, default=1024, help='Pages are downscaled to fit it, like MAX_SIZE')
+    aparser.add_argument('--limit', type=int, default=0, help='Use at most this many pages, 0 for all')
+    aparser.add_argument('--backend', default='x86', help='torch.backends.quantized engine: x86, fbgemm or qnnpack')
+
+    main(aparser.parse_args())
@@ -5,11 +5,10 @@ import os
 import sys
 import traceback
 
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
+from saicinpainting.runtime import configure_runtime, get_runtime_config
+
+# one thread per process unless RUNTIME_THREADS or RUNTIME_CONFIG say otherwise
+configure_runtime(get_runtime_config(default_threads=1))
 
 import hydra
 from omegaconf import OmegaConf
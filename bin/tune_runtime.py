@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import itertools
+import json
+import os
+import subprocess
+import sys
+
+from saicinpainting.runtime import find_allocator
+
+TRIAL = '''
+import json, time
+from saicinpainting.runtime import configure_runtime, get_runtime_config
+runtime = configure_runtime(get_runtime_config())
+import torch
+from saicinpainting.inference.checkpoint import get_serving_paths, load_serving_config
+from saicinpainting.inference.model import load_model
+from saicinpainting.inference.optimize import optimize_for_inference
+weights_path, config_path = get_serving_paths(MODEL_DIR, CHECKPOINT)
+model = load_model(load_serving_config(config_path), weights_path)
+optimize_for_inference(model.generator)
+image = torch.rand(1, 3, HEIGHT, WIDTH)
+mask = (torch.rand(1, 1, HEIGHT, WIDTH) > 0.7).float()
+latencies = []
+with torch.no_grad():
+    model(dict(image=image, mask=mask))  # warm-up
+    for _ in range(REPEATS):
+        started_at = time.perf_counter()
+        model(dict(image=image, mask=mask))
+        latencies.append(time.perf_counter() - started_at)
+print(json.dumps(dict(latency_ms=sorted(latencies)[len(latencies) // 2] * 1000, runtime=runtime)))
+'''
+
+
+def get_thread_counts(max_threads):
+    counts = [1]
+    while counts[-1] * 2 < max_threads:
+        counts.append(counts[-1] * 2)
+    return sorted(set(counts + [max_threads]))
+
+
+def run_trial(args, threads, interop_threads, allocator):
+    prelude = (f'MODEL_DIR = {args.model_dir!r}\nCHECKPOINT = {args.checkpoint!r}\n'
+               f'HEIGHT, WIDTH = {args.height}, {args.width}\nREPEATS = {args.repeats}\n')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get('PYTHONPATH')])),
+               RUNTIME_THREADS=str(threads), RUNTIME_INTEROP_THREADS=str(interop_threads))
+    env.pop('RUNTIME_CONFIG', None)
+    env.pop('RUNTIME_ALLOCATOR', None)
+    if allocator != 'system':
+        # -c scripts can not re-execute themselves, so the library is preloaded here
+        env['LD_PRELOAD'] = find_allocator(allocator)
+    output = subprocess.run([sys.executable, '-c', prelude + TRIAL], env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    max_threads = len(os.sched_getaffinity(0))
+    thread_counts = args.threads or get_thread_counts(max_threads)
+    allocators = ['system'] + [name for name in ('jemalloc', 'tcmalloc') if find_allocator(name)]
+    print(f'{args.height}x{args.width}, threads {thread_counts}, inter-op threads {args.interop_threads}, '
+          f'allocators {allocators}')
+
+    sweep = []
+    for threads, interop_threads, allocator in itertools.product(thread_counts, args.interop_threads, allocators):
+        trial = run_trial(args, threads, interop_threads, allocator)
+        sweep.append(dict(threads=threads, interop_threads=interop_threads, allocator=allocator,
+                          latency_ms=round(trial['latency_ms'], 1), loaded_allocator=trial['runtime']['allocator']))
+        print(f'threads {threads:3d}, inter-op {interop_threads}, {allocator:8s}: {trial["latency_ms"]:8.0f} ms')
+
+    best = min(sweep, key=lambda trial: trial['latency_ms'])
+    result = dict(threads=best['threads'], interop_threads=best['interop_threads'], allocator=best['allocator'],
+                  size=[args.height, args.width], latency_ms=best['latency_ms'], sweep=sweep)
+    outpath = args.outpath or os.path.join(args.model_dir, 'runtime.json')
+    with open(outpath, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Best: {best}\nWrote {outpath}, use it with RUNTIME_CONFIG={outpath}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    aparser = argparse.ArgumentParser(description='Sweep intra-op/inter-op thread counts and allocators for one '
+                                                  'input size, write the fastest settings for RUNTIME_CONFIG')
+    aparser.add_argument('model_dir', help='Directory with config.yaml and models/')
+    aparser.add_argument('--checkpoint', default='best_genpref.ckpt', help='Checkpoint file name in models/')
+    aparser.add_argument('--height', type=int, default=1024)
+    aparser.add_argument('--width', type=int, default=768)
+    aparser.add_argument('--threads', type=lambda s: [int(n) for n in s.split(',')], default=None,
+                         help='Comma-separated intra-op thread counts, default: powers of two up to the CPU count')
+    aparser.add_argument('--interop-threads', type=lambda s: [int(n) for n in s.split(',')], default=[1],
+                         help='Comma-separated inter-op thread counts, 0 for the torch default')
+    aparser.add_argument('--repeats', type=int, default=3)
+    aparser.add_argument('--outpath', default=None, help='Defaults to <model_dir>/runtime.json')
+
+    main(aparser.parse_args())
@@ -1,45 +1,511 @@
+import asyncio
 import json
+import math
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 
-from rp_handler_cpu import handler
+from rp_handler_cpu import COALESCE, COMPILED, ENCODE_POOL, IN_FLIGHT, MEMORY, RESULT_CACHE, RUNTIME, SCHEDULER, \
+	STARTUP_TIMINGS, coalesce_request, encode_image, get_coalesced_result, inpaint_request, prepare_request, \
+	release_request, to_response
+from saicinpainting.inference.cache import make_cache_key
+from saicinpainting.inference.coalescing import SingleFlight
+from saicinpainting.inference.http_parsing import HttpError, parse_binary_request, parse_json_input, \
+	parse_request_line, read_body
+from saicinpainting.inference.jobs import JobQueueFull, JobStore
+from saicinpainting.inference.memory import DECISIONS
+from saicinpainting.inference.metrics import MetricsRegistry, get_rss_bytes
+from worker_pool import WorkerPool
 
 
-class Handler(BaseHTTPRequestHandler):
-	def _set_headers(self, status: int = 200):
-		self.send_response(status)
-		self.send_header("Content-Type", "application/json")
-		self.end_headers()
+# Model runs, at most INFERENCE_CONCURRENCY at a time; INFERENCE_QUEUE_SIZE more may wait, the rest get 429
+INFERENCE_CONCURRENCY = int(os.environ.get("INFERENCE_CONCURRENCY", "1"))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "8"))
+# Body parsing and image decoding run on this pool, off the event loop and off the model threads
+# (encoding runs on rp_handler_cpu.ENCODE_POOL)
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "4"))
+MAX_BODY_MB = float(os.environ.get("MAX_BODY_MB", "64"))
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "60"))
+HEADER_TIMEOUT = float(os.environ.get("HEADER_TIMEOUT", "30"))
+# WORKERS > 1 forks that many inference processes sharing the loaded weights; each of them runs one request
+# at a time on WORKER_THREADS intra-op threads (default: its share of the CPUs), pinned when PIN_WORKERS=1
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "0"))
+PIN_WORKERS = os.environ.get("PIN_WORKERS", "1") == "1"
+# Async jobs (POST /jobs): at most JOB_QUEUE_SIZE queued or running, run on the inference threads or workers
+# without the INFERENCE_QUEUE_SIZE limit; finished jobs are kept JOB_TTL seconds, in JOB_DIR too if set so that
+# their results survive a restart
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "32"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "3600"))
+JOB_DIR = os.environ.get("JOB_DIR", "")
 
-	def do_POST(self):  # noqa: N802 (HTTP method name)
-		if self.path not in ("/run", "/rpc"):
-			self._set_headers(404)
-			self.wfile.write(json.dumps({"error": "not_found"}).encode())
-			return
+ENDPOINTS = ("/run", "/rpc", "/inpaint", "/jobs", "/jobs/{id}", "/jobs/{id}/result", "/stats", "/metrics")
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+
+def _get_error_type(e: Exception) -> str:
+	"""Class name of an exception, of the original one for exceptions raised in worker processes."""
+	return getattr(e, "error_type", None) or type(e).__name__
+
+
+def _get_endpoint(path: str) -> str:
+	"""Label of a request path for the metrics, job ids collapsed to {id}."""
+	parts = path.split("/")
+	if len(parts) in (3, 4) and parts[1] == "jobs" and parts[2]:
+		parts[2] = "{id}"
+	endpoint = "/".join(parts)
+	return endpoint if endpoint in ENDPOINTS else "other"
+
+
+class RawResponse:
+	"""Response body sent as is, e.g. encoded image bytes, instead of JSON."""
+	def __init__(self, data: bytes, content_type: str, headers=None):
+		self.data = data
+		self.content_type = content_type
+		self.headers = headers or {}
+
+
+def _get_input_key(inp) -> str:
+	"""Hash of a raw request input, to coalesce identical requests before they reach a worker process."""
+	names = sorted(inp)
+	return make_cache_key(names, *(inp[name] for name in names))
+
+
+def _get_refine_progress(progress):
+	"""Refiner progress of a job, with the loss rounded and NaN (no masked pixels left at a scale) as null."""
+	loss = progress.get("loss")
+	return {**progress, "loss": round(loss, 6) if loss is not None and math.isfinite(loss) else None}
+
+
+class Server:
+	def __init__(self, workers: WorkerPool = None):
+		self.workers = workers
+		self.concurrency = workers.size if workers is not None else INFERENCE_CONCURRENCY
+		self.io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+		self.inference_pool = ThreadPoolExecutor(max_workers=INFERENCE_CONCURRENCY, thread_name_prefix="inference")
+		self.inference_pending = 0  # running + waiting for a free inference thread
+		self.in_flight = 0
+		self.connections = set()
+		self.idle = asyncio.Event()
+		self.idle.set()
+		self.shutting_down = False
+		self.jobs = JobStore(JOB_QUEUE_SIZE, JOB_TTL, JOB_DIR or None)
+		# workers run one request at a time each, so identical requests are coalesced here, before dispatch
+		self.worker_in_flight = SingleFlight() if COALESCE and workers is not None else None
+		self.job_queue = None
+		self.job_tasks = []
+		self.metrics = self.make_metrics()
+
+	def make_metrics(self) -> MetricsRegistry:
+		metrics = MetricsRegistry()
+		self.requests_total = metrics.counter("inpaint_http_requests_total", "HTTP requests by endpoint and status",
+			("endpoint", "status"))
+		self.request_seconds = metrics.histogram("inpaint_http_request_duration_seconds",
+			"Time from the request head to the response being ready", ("endpoint",))
+		self.stage_seconds = metrics.histogram("inpaint_stage_duration_seconds",
+			"Time spent in each pipeline stage of successful requests, as in metadata.timings", ("stage",))
+		self.input_megapixels = metrics.histogram("inpaint_input_megapixels", "Input image size of successful requests",
+			buckets=MEGAPIXEL_BUCKETS)
+		self.errors_total = metrics.counter("inpaint_errors_total", "Failed requests by error type", ("type",))
+		metrics.gauge("inpaint_in_flight_requests", "Requests being read, processed or answered",
+			fn=lambda: self.in_flight)
+		metrics.gauge("inpaint_inference_pending", "Requests running or waiting for an inference thread or worker",
+			fn=lambda: self.inference_pending)
+		metrics.gauge("process_resident_memory_bytes", "Resident memory of the server and its inference workers",
+			("process",), fn=self.get_memory)
+		metrics.counter("inpaint_coalesced_requests_total",
+			"Requests that shared the result of an identical request in flight instead of running",
+			fn=self.get_coalesced)
+		if MEMORY is not None:
+			# shared with the worker processes, so these cover all of them
+			metrics.counter("inpaint_admission_total", "Memory admission decisions of model runs and pages",
+				("decision",), fn=lambda: {(name,): MEMORY.stats()[name] for name in DECISIONS})
+			metrics.gauge("inpaint_memory_reserved_bytes", "Predicted peak memory of the model runs in flight",
+				fn=lambda: MEMORY.stats()["reserved_bytes"])
+			metrics.gauge("inpaint_memory_free_bytes", "Free memory of the device",
+				fn=lambda: MEMORY.stats()["free_bytes"])
+		if self.workers is not None:
+			metrics.gauge("inpaint_workers", "Inference worker processes by state", ("state",),
+				fn=lambda: {(state,): count for state, count in self.workers.counts().items() if state != "restarts"})
+			metrics.counter("inpaint_worker_restarts_total", "Inference workers forked again after dying",
+				fn=lambda: self.workers.counts()["restarts"])
+		metrics.gauge("inpaint_jobs", "Async jobs by status, finished ones until they expire", ("status",),
+			fn=self.get_job_counts)
+		metrics.gauge("inpaint_cache_bytes", "Size of the cached results by tier, of all workers", ("tier",),
+			fn=lambda: self.get_cache_occupancy("bytes"))
+		metrics.gauge("inpaint_cache_entries", "Cached results by tier, of all workers", ("tier",),
+			fn=lambda: self.get_cache_occupancy("entries"))
+		if self.workers is None:
+			# with WORKERS > 1 every worker counts its own hits
+			metrics.counter("inpaint_cache_hits_total", "Result cache hits", fn=lambda: RESULT_CACHE.stats()["hits"])
+			metrics.counter("inpaint_cache_misses_total", "Result cache misses",
+				fn=lambda: RESULT_CACHE.stats()["misses"])
+		return metrics
+
+	def get_memory(self):
+		memory = {("server",): get_rss_bytes()}
+		if self.workers is not None:
+			for worker in self.workers.stats():
+				if worker["alive"]:
+					memory[(f"worker-{worker['index']}",)] = get_rss_bytes(worker["pid"])
+		return memory
 
-		length = int(self.headers.get("Content-Length", "0"))
-		body = self.rfile.read(length) if length else b"{}"
+	def get_in_flight(self):
+		"""SingleFlight coalescing the requests of this server, None with COALESCE=0."""
+		return self.worker_in_flight if self.workers is not None else IN_FLIGHT
+
+	def get_coalesced(self):
+		in_flight = self.get_in_flight()
+		return in_flight.coalesced if in_flight is not None else 0
+
+	def get_cache_occupancy(self, unit: str):
+		stats = RESULT_CACHE.stats() if self.workers is None else self.workers.cache_stats()
+		return {(tier,): stats[f"{tier}_{unit}"] for tier in ("memory", "disk")}
+
+	def get_job_counts(self):
+		stats = self.jobs.stats()
+		return {(status,): stats[status] for status in ("queued", "running", "finished")}
+
+	def observe(self, metadata):
+		"""Record the stage timings and input size from the metadata of a successful result."""
+		for name, ms in metadata.get("timings", {}).items():
+			self.stage_seconds.observe(ms / 1000, stage=name)
+		width, height = metadata.get("input_size") or (0, 0)
+		if width and height:
+			self.input_megapixels.observe(width * height / 1e6)
+
+	async def run_io(self, fn, *args):
+		return await asyncio.get_running_loop().run_in_executor(self.io_pool, fn, *args)
+
+	async def run_inference(self, fn, *args, check_busy: bool = True):
+		if check_busy and self.inference_pending >= self.concurrency + INFERENCE_QUEUE_SIZE:
+			raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, "server_busy")
+		self.inference_pending += 1
 		try:
-			payload = json.loads(body.decode("utf-8"))
-		except Exception:
-			self._set_headers(400)
-			self.wfile.write(json.dumps({"error": "invalid_json"}).encode())
-			return
+			return await asyncio.get_running_loop().run_in_executor(self.inference_pool, fn, *args)
+		finally:
+			self.inference_pending -= 1
 
+	async def run_in_worker(self, payload, fn: str = "handler", check_busy: bool = True):
+		if check_busy and self.inference_pending >= self.concurrency + INFERENCE_QUEUE_SIZE:
+			raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, "server_busy")
+		self.inference_pending += 1
 		try:
-			result = handler(payload)
-			self._set_headers(200)
-			self.wfile.write(json.dumps(result).encode())
+			return await asyncio.wrap_future(self.workers.submit(payload, fn))
+		finally:
+			self.inference_pending -= 1
+
+	async def run_request_in_worker(self, inp, check_busy: bool = True):
+		"""rp_handler_cpu.run_request in a worker process, shared by identical requests in flight."""
+		if self.worker_in_flight is None:
+			return await self.run_in_worker(inp, "run_request", check_busy)
+		key = await self.run_io(_get_input_key, inp)
+		leader = self.worker_in_flight.claim(key)
+		if leader is not None:
+			return get_coalesced_result(await asyncio.wrap_future(leader))
+		try:
+			encoded = await self.run_in_worker(inp, "run_request", check_busy)
+		except BaseException as e:
+			self.worker_in_flight.release(key, error=e)
+			raise
+		self.worker_in_flight.release(key, encoded)
+		return encoded
+
+	def stats(self):
+		return {
+			"in_flight": self.in_flight,
+			"inference_pending": self.inference_pending,
+			"inference_concurrency": self.concurrency,
+			"inference_queue_size": INFERENCE_QUEUE_SIZE,
+			"batching": SCHEDULER.stats() if SCHEDULER is not None and self.workers is None else None,
+			"workers": self.workers.stats() if self.workers is not None else None,
+			"worker_counts": self.workers.counts() if self.workers is not None else None,
+			"startup": STARTUP_TIMINGS,
+			"runtime": RUNTIME,
+			# with WORKERS > 1 every worker has its own memory tier, only their occupancy is collected
+			"cache": RESULT_CACHE.stats() if self.workers is None else self.workers.cache_stats(),
+			"compile": COMPILED.stats() if COMPILED is not None and self.workers is None else None,
+			"jobs": self.jobs.stats(),
+			"coalescing": self.get_in_flight().stats() if COALESCE else None,
+			"admission": MEMORY.stats() if MEMORY is not None else None,
+		}
+
+	async def handle_run(self, body: bytes):
+		inp = await self.run_io(parse_json_input, body)
+		try:
+			if self.workers is not None:
+				# decoding, inference and encoding all happen in the worker process, only base64 here
+				encoded = await self.run_request_in_worker(inp)
+			else:
+				encoded = await self.run_pipeline(inp)
+		except HttpError:
+			raise
 		except Exception as e:
-			self._set_headers(500)
-			self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+			# same contract as rp_handler_cpu.handler
+			self.errors_total.inc(type=_get_error_type(e))
+			return {"status": "error", "message": str(e)}
+		self.observe(encoded["metadata"])
+		return await self.run_io(to_response, encoded)
+
+	async def run_pipeline(self, inp, job=None):
+		"""
+		rp_handler_cpu.run_request split over the io and inference pools; raises on errors.
+		Identical requests in flight share one run. With a job, its stage, timings and refinement progress are updated along the way.
+		"""
+		if job is not None:
+			self.jobs.set_progress(job, stage="prepare")
+		request = await self.run_io(prepare_request, inp)
+		if "encoded" in request:
+			return request["encoded"]  # result cache hit
+		leader = coalesce_request(request)
+		if leader is not None:
+			return get_coalesced_result(await asyncio.wrap_future(leader))
+		try:
+			encoded = await self.run_inpaint(request, job)
+		except BaseException as e:
+			release_request(request, error=e)
+			raise
+		release_request(request, encoded)
+		return encoded
+
+	async def run_inpaint(self, request, job=None):
+		"""Model run and encoding of a prepared request that was not coalesced."""
+		if job is not None:
+			job.timings = request["timings"]
+			request["progress"] = lambda progress: self.jobs.set_progress(job, refine=_get_refine_progress(progress))
+			self.jobs.set_progress(job, stage="inpaint")
+		result = await self.run_inference(inpaint_request, request, check_busy=job is None)
+		if job is not None:
+			job.timings = result["metadata"]["timings"]
+			self.jobs.set_progress(job, stage="encode")
+		return await asyncio.get_running_loop().run_in_executor(ENCODE_POOL, encode_image, result)
+
+	async def handle_inpaint(self, headers, query: str, body: bytes):
+		inp = await self.run_io(parse_binary_request, headers, query, body)
+		try:
+			if self.workers is not None:
+				# memoryview slices of the body can not be pickled to the worker
+				inp = {name: bytes(value) if isinstance(value, memoryview) else value for name, value in inp.items()}
+				encoded = await self.run_request_in_worker(inp)
+			else:
+				encoded = await self.run_pipeline(inp)
+		except HttpError:
+			raise
+		except Exception as e:
+			if _get_error_type(e) == "InsufficientMemory":
+				raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, str(e), "InsufficientMemory")
+			raise HttpError(HTTPStatus.UNPROCESSABLE_ENTITY, str(e), _get_error_type(e))
+		self.observe(encoded["metadata"])
+		metadata = await self.run_io(json.dumps, encoded["metadata"])
+		return RawResponse(encoded["data"], encoded["content_type"], {"X-Metadata": metadata})
+
+	async def handle_submit(self, headers, query: str, body: bytes):
+		"""POST /jobs: the JSON body of /run or the binary one of /inpaint, answered with the job id right away."""
+		content_type = headers.get("content-type", "")
+		if content_type.startswith("multipart/form-data") or "x-image-length" in headers:
+			inp = await self.run_io(parse_binary_request, headers, query, body)
+			inp = {name: bytes(value) if isinstance(value, memoryview) else value for name, value in inp.items()}
+		else:
+			inp = await self.run_io(parse_json_input, body, True)
+		try:
+			job = self.jobs.create(inp)
+		except JobQueueFull:
+			raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, "job_queue_full")
+		self.job_queue.put_nowait(job)
+		return {"id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}",
+				"result_url": f"/jobs/{job.id}/result"}
+
+	async def handle_result(self, job):
+		"""GET /jobs/{id}/result: the encoded image like /inpaint once done, 202 with the job state until then."""
+		if job.status == "error":
+			return HTTPStatus.UNPROCESSABLE_ENTITY, {"status": "error", "message": job.error["message"],
+				"error": job.error["type"]}
+		if job.status != "done":
+			return HTTPStatus.ACCEPTED, job.to_dict()
+		data, content_type = await self.run_io(self.jobs.get_result, job)
+		metadata = await self.run_io(json.dumps, job.metadata)
+		return HTTPStatus.OK, RawResponse(data, content_type, {"X-Metadata": metadata, "X-Job-Id": job.id})
+
+	async def run_job(self, job):
+		inp = job.payload
+		self.jobs.start(job)
+		try:
+			if self.workers is not None:
+				# the worker runs the whole pipeline, so its stages are not reported while it runs
+				self.jobs.set_progress(job, stage="inpaint")
+				encoded = await self.run_request_in_worker(inp, check_busy=False)
+			else:
+				encoded = await self.run_pipeline(inp, job)
+		except Exception as e:
+			self.errors_total.inc(type=_get_error_type(e))
+			await self.run_io(self.jobs.fail, job, {"message": str(e), "type": _get_error_type(e)})
+			return
+		self.observe(encoded["metadata"])
+		await self.run_io(self.jobs.finish, job, encoded)
+
+	async def run_jobs(self):
+		while True:
+			job = await self.job_queue.get()
+			try:
+				await self.run_job(job)
+			except Exception as e:
+				print(f"[local_api] Job {job.id} failed: {e}")
+
+	async def evict_jobs(self):
+		while True:
+			await asyncio.sleep(min(60.0, JOB_TTL))
+			evicted = await self.run_io(self.jobs.evict_expired)
+			if evicted:
+				print(f"[local_api] Evicted {evicted} expired job(s)")
+
+	def start_jobs(self):
+		"""Job runners, one per inference thread or worker, and the periodic eviction of expired jobs."""
+		self.job_queue = asyncio.Queue()
+		self.job_tasks = [asyncio.create_task(self.run_jobs()) for _ in range(self.concurrency)]
+		self.job_tasks.append(asyncio.create_task(self.evict_jobs()))
+
+	async def dispatch(self, method: str, target: str, headers, body: bytes):
+		path, _, query = target.partition("?")
+		if method == "GET" and path == "/stats":
+			return HTTPStatus.OK, self.stats()
+		if method == "GET" and path == "/metrics":
+			return HTTPStatus.OK, RawResponse(self.metrics.render().encode(), MetricsRegistry.content_type)
+		if method == "POST" and path in ("/run", "/rpc", "/inpaint"):
+			if self.shutting_down:
+				raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "shutting_down")
+			if path == "/inpaint":
+				return HTTPStatus.OK, await self.handle_inpaint(headers, query, body)
+			return HTTPStatus.OK, await self.handle_run(body)
+		if method == "POST" and path == "/jobs":
+			if self.shutting_down:
+				raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "shutting_down")
+			return HTTPStatus.ACCEPTED, await self.handle_submit(headers, query, body)
+		if method == "GET" and path.startswith("/jobs/"):
+			job_id, _, rest = path[len("/jobs/"):].partition("/")
+			if rest not in ("", "result"):
+				raise HttpError(HTTPStatus.NOT_FOUND, "not_found")
+			job = self.jobs.get(job_id)
+			if job is None:
+				raise HttpError(HTTPStatus.NOT_FOUND, "job_not_found")
+			if rest == "result":
+				return await self.handle_result(job)
+			return HTTPStatus.OK, job.to_dict()
+		raise HttpError(HTTPStatus.NOT_FOUND, "not_found")
+
+	async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		self.connections.add(writer)
+		try:
+			keep_alive = True
+			while keep_alive and not self.shutting_down:
+				try:
+					head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT)
+				except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError, ConnectionError):
+					return
+
+				lines = head.decode("latin-1").split("\r\n")
+				method, path, version = parse_request_line(lines[0])
+				headers = {}
+				for line in lines[1:]:
+					if ":" in line:
+						name, value = line.split(":", 1)
+						headers[name.strip().lower()] = value.strip()
+				connection = headers.get("connection", "").lower()
+				keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+				self.in_flight += 1
+				self.idle.clear()
+				started_at = time.perf_counter()
+				body_read = False
+				try:
+					if not method:
+						raise HttpError(HTTPStatus.BAD_REQUEST, "bad_request_line")
+					body = await read_body(reader, writer, headers, MAX_BODY_MB * 1024 * 1024)
+					body_read = True
+					status, result = await self.dispatch(method, path, headers, body)
+				except HttpError as e:
+					if not body_read:
+						keep_alive = False  # the body is not (fully) read, so the connection can not be reused
+					status, result = e.status, {"status": "error", "message": e.error, "error": e.error}
+					self.errors_total.inc(type=e.error_type)
+				except Exception as e:
+					status, result = HTTPStatus.INTERNAL_SERVER_ERROR, {"status": "error", "message": str(e)}
+					self.errors_total.inc(type=_get_error_type(e))
+				finally:
+					self.in_flight -= 1
+					if self.in_flight == 0:
+						self.idle.set()
+
+				endpoint = _get_endpoint(path.partition("?")[0])
+				self.requests_total.inc(endpoint=endpoint, status=int(status))
+				self.request_seconds.observe(time.perf_counter() - started_at, endpoint=endpoint)
+
+				await self.write_response(writer, status, result, keep_alive)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self.connections.discard(writer)
+			writer.close()
+
+	async def write_response(self, writer: asyncio.StreamWriter, status: int, result, keep_alive: bool):
+		if not isinstance(result, RawResponse):
+			result = RawResponse((await self.run_io(json.dumps, result)).encode(), "application/json")
+		data = result.data
+		head = [
+			f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+			f"Content-Type: {result.content_type}",
+			f"Content-Length: {len(data)}",
+			f"Connection: {'keep-alive' if keep_alive else 'close'}",
+		]
+		head.extend(f"{name}: {value}" for name, value in result.headers.items())
+		if status in (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE):
+			head.append("Retry-After: 1")
+		writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+		writer.write(data)
+		await writer.drain()
+
+	async def shutdown(self, server: asyncio.AbstractServer):
+		print(f"[local_api] Shutting down, waiting up to {SHUTDOWN_TIMEOUT}s for {self.in_flight} request(s)")
+		self.shutting_down = True
+		server.close()
+		try:
+			await asyncio.wait_for(self.idle.wait(), SHUTDOWN_TIMEOUT)
+		except asyncio.TimeoutError:
+			print(f"[local_api] {self.in_flight} request(s) still running, exiting anyway")
+		for writer in list(self.connections):
+			writer.close()  # idle keep-alive connections
+		for task in self.job_tasks:
+			task.cancel()  # queued jobs are lost, finished ones stay in JOB_DIR
+		self.inference_pool.shutdown(wait=False, cancel_futures=True)
+		self.io_pool.shutdown(wait=False, cancel_futures=True)
+		if self.workers is not None:
+			self.workers.close()
+
+
+async def serve(host: str, port: int, workers: WorkerPool = None):
+	app = Server(workers)
+	app.start_jobs()
+	server = await asyncio.start_server(app.serve_connection, host, port)
+
+	stop = asyncio.Event()
+	loop = asyncio.get_running_loop()
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(sig, stop.set)
+
+	print(f"[local_api] Listening on {host}:{port} (POST /run, POST /inpaint, POST /jobs, GET /stats, "
+		  f"GET /metrics), inference concurrency {app.concurrency}, queue {INFERENCE_QUEUE_SIZE}, workers {WORKERS}, "
+		  f"jobs {JOB_QUEUE_SIZE}")
+	async with server:
+		await stop.wait()
+		await app.shutdown(server)
 
 
 def run():
 	port = int(os.environ.get("PORT", "8080"))
-	server = HTTPServer(("0.0.0.0", port), Handler)
-	print(f"[local_api] Listening on 0.0.0.0:{port} (POST /run)")
-	server.serve_forever()
+	# fork before the event loop and its thread pools exist
+	workers = WorkerPool(WORKERS, WORKER_THREADS, PIN_WORKERS) if WORKERS > 1 else None
+	asyncio.run(serve("0.0.0.0", port, workers))
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
 import base64
 import io
 import os
-import tempfile
+import time
 from typing import Any, Dict
 
-import cv2
+from saicinpainting.runtime import configure_runtime, get_runtime_config
+
+# Threads, CPU pinning and allocator (RUNTIME_* env, see saicinpainting/runtime.py)
+RUNTIME = configure_runtime(get_runtime_config())
+print(f"[INFO] Runtime: {RUNTIME}")
+
 import numpy as np
 import torch
 from PIL import Image
@@ -15,6 +20,10 @@ from omegaconf import OmegaConf
 import yaml
 
 from saicinpainting.evaluation.utils import move_to_device
+from saicinpainting.inference.encoding import crop_patch, encode, get_output_options
+from saicinpainting.inference.fetching import UrlFetcher
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.precision import apply_precision
 from saicinpainting.training.trainers import load_checkpoint
 
 
@@ -22,17 +31,32 @@ MODEL_DIR = os.environ.get("MODEL_DIR", "/app/local-model")
 CHECKPOINT = os.environ.get("MODEL_CKPT", "best_genpref.ckpt")
 MODEL_URL = os.environ.get("MODEL_URL", "")
 DEVICE = os.environ.get("DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
-
-
-def _read_image(data: str) -> np.ndarray:
-    """Read image from base64 or URL/file path into RGB np.uint8."""
-    if data.startswith("http://") or data.startswith("https://"):
-        import requests
-
-        resp = requests.get(data, timeout=60)
-        resp.raise_for_status()
-        buf = io.BytesIO(resp.content)
-        img = Image.open(buf).convert("RGB")
+# Fold BatchNorm into the convs and skip the empty FFC branches once the model is loaded
+OPTIMIZE = os.environ.get("OPTIMIZE", "1") == "1"
+# channels_last weights and inputs, fp32 or bf16 autocast (FFTs stay fp32)
+PRECISION = os.environ.get("PRECISION", "fp32")
+CHANNELS_LAST = os.environ.get("CHANNELS_LAST", "0") == "1"
+# Output encoding: png (PNG_COMPRESSION 0-9), webp (lossless) or jpeg (JPEG_QUALITY)
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "png")
+PNG_COMPRESSION = int(os.environ.get("PNG_COMPRESSION", "1"))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "95"))
+# URL inputs: shared keep-alive session, image and mask downloaded concurrently, streamed with a size cap
+FETCH_POOL_SIZE = int(os.environ.get("FETCH_POOL_SIZE", "8"))
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", "60"))
+FETCH_MAX_MB = float(os.environ.get("FETCH_MAX_MB", "64"))
+FETCH_PROGRESSIVE = os.environ.get("FETCH_PROGRESSIVE", "0") == "1"
+
+FETCHER = UrlFetcher(FETCH_POOL_SIZE, FETCH_TIMEOUT, int(FETCH_MAX_MB * 1024 * 1024), progressive=FETCH_PROGRESSIVE)
+
+
+def _read_image(data) -> np.ndarray:
+    """Read image from a fetched PIL image or bytes, base64 or URL/file path into RGB np.uint8."""
+    if isinstance(data, Image.Image):
+        img = data.convert("RGB")
+    elif isinstance(data, bytes):
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+    elif data.startswith("http://") or data.startswith("https://"):
+        return _read_image(FETCHER.fetch(data)[0])
     elif os.path.exists(data):
         img = Image.open(data).convert("RGB")
     else:
@@ -44,15 +68,14 @@ def _read_image(data: str) -> np.ndarray:
     return np.array(img)
 
 
-def _read_mask(data: str, target_wh=None) -> np.ndarray:
+def _read_mask(data, target_wh=None) -> np.ndarray:
     """Read mask as single-channel uint8 0/255; resize to image size if needed."""
-    if data.startswith("http://") or data.startswith("https://"):
-        import requests
-
-        resp = requests.get(data, timeout=60)
-        resp.raise_for_status()
-        buf = io.BytesIO(resp.content)
-        mask_img = Image.open(buf).convert("L")
+    if isinstance(data, Image.Image):
+        mask_img = data.convert("L")
+    elif isinstance(data, bytes):
+        mask_img = Image.open(io.BytesIO(data)).convert("L")
+    elif data.startswith("http://") or data.startswith("https://"):
+        return _read_mask(FETCHER.fetch(data)[0], target_wh)
     elif os.path.exists(data):
         mask_img = Image.open(data).convert("L")
     else:
@@ -126,7 +149,9 @@ def load_model():
     model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location="cpu")
     model.freeze()
     model.to(torch.device(DEVICE))
-    return model
+    if OPTIMIZE:
+        optimize_for_inference(model.generator)
+    return apply_precision(model, PRECISION, CHANNELS_LAST, device_type=torch.device(DEVICE).type)
 
 
 INPAINTER = load_model()
@@ -136,8 +161,18 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
     inp = event.get("input", {})
 
     try:
-        image = _read_image(inp["image"])  # RGB HxWx3 uint8
-        mask = _read_mask(inp["mask"], target_wh=(image.shape[1], image.shape[0]))  # HxW uint8
+        # bad output options fail before the downloads and the model run
+        options = get_output_options(inp, OUTPUT_FORMAT, PNG_COMPRESSION, JPEG_QUALITY)
+        fmt, patch_only = options.pop("format"), options.pop("patch")
+
+        # URL inputs are downloaded concurrently
+        started_at = time.perf_counter()
+        sources, fetch = FETCHER.fetch_all({"image": inp["image"], "mask": inp["mask"]})
+        if fetch:
+            fetch["wall_ms"] = round((time.perf_counter() - started_at) * 1000, 2)
+
+        image = _read_image(sources["image"])  # RGB HxWx3 uint8
+        mask = _read_mask(sources["mask"], target_wh=(image.shape[1], image.shape[0]))  # HxW uint8
 
         # build batch like in predict.py
         image_f = image.astype("float32") / 255.0
@@ -155,16 +190,24 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
             res = out["inpainted"][0].permute(1, 2, 0).detach().cpu().numpy()
 
         res = np.clip(res * 255, 0, 255).astype("uint8")
-        res_bgr = cv2.cvtColor(res, cv2.COLOR_RGB2BGR)
-
-        # save to temp file and return base64
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            cv2.imwrite(tmp.name, res_bgr)
-            with open(tmp.name, "rb") as f:
-                b64 = base64.b64encode(f.read()).decode("utf-8")
-        os.unlink(tmp.name)
 
-        return {"status": "ok", "image_base64": b64}
+        # encode in memory, optionally only the patch around the mask
+        started_at = time.perf_counter()
+        patch = None
+        if patch_only:
+            res, (x, y, width, height) = crop_patch(res, mask)
+            patch = {"x": x, "y": y, "width": width, "height": height}
+        data, content_type = encode(res, fmt, **options)
+        b64 = base64.b64encode(data).decode("utf-8")
+
+        output = {
+            "format": fmt,
+            "content_type": content_type,
+            "bytes": len(data),
+            "patch": patch,
+            "encode_ms": round((time.perf_counter() - started_at) * 1000, 2),
+        }
+        return {"status": "ok", "image_base64": b64, "metadata": {"output": output, "fetch": fetch or None}}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
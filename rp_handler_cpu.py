@@ -1,39 +1,150 @@
+import time
+
+_IMPORT_STARTED_AT = time.perf_counter()
+
+import asyncio
 import base64
+import contextlib
 import io
 import os
-import tempfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from typing import Any, Dict
 
+from saicinpainting.runtime import configure_runtime, get_runtime_config
+
+# Threads, CPU pinning and allocator (RUNTIME_* env, see saicinpainting/runtime.py), applied before
+# OpenCV, numpy and torch start their thread pools
+RUNTIME = configure_runtime(get_runtime_config())
+print(f"[INFO] Runtime: {RUNTIME}")
+
 import cv2
 import numpy as np
 import torch
 from PIL import Image
-from scipy import ndimage
 
 import runpod
 
 from omegaconf import OmegaConf
 import yaml
 
+from saicinpainting.evaluation.data import ceil_modulo
+from saicinpainting.evaluation.refinement import refine_predict
 from saicinpainting.evaluation.utils import move_to_device
-from saicinpainting.training.trainers import load_checkpoint
+from saicinpainting.inference.batching import MicroBatchScheduler
+from saicinpainting.inference.cache import ResultCache, make_cache_key
+from saicinpainting.inference.coalescing import SingleFlight
+from saicinpainting.inference.compositing import composite_full_res, get_composite_mask, get_composite_sizes
+from saicinpainting.inference.encoding import crop_patch, encode, get_output_options
+from saicinpainting.inference.fetching import UrlFetcher
+from saicinpainting.inference.memory import InsufficientMemory, MemoryAdmission, MemoryModel
+from saicinpainting.inference.mask_processing import get_resize_scale, process_mask, process_mask_tensor
+from saicinpainting.inference.metrics import add_stage_time, collect_stages, get_stage_timings, stage
+from saicinpainting.inference.checkpoint import convert_checkpoint, get_serving_paths, load_generator_weights, \
+    load_serving_config
+from saicinpainting.inference.model import build_model
+from saicinpainting.inference.optimize import optimize_for_inference
+from saicinpainting.inference.precision import apply_precision
+from saicinpainting.inference.roi import crop_roi, get_bucket_side, get_roi_bbox, get_roi_bboxes, pad_to_size
+from saicinpainting.inference.tiling import tiled_inpaint
 
 
 MODEL_DIR = os.environ.get("MODEL_DIR", "/app/local-model")
 CHECKPOINT = os.environ.get("MODEL_CKPT", "best_genpref.ckpt")
 MODEL_URL = os.environ.get("MODEL_URL", "")
 DEVICE = os.environ.get("DEVICE", "cpu")  # Force CPU for RunPod Serverless
+# Load generator-only weights by mmap, converting the checkpoint once (at build time or on first boot) if needed
+SERVING_WEIGHTS = os.environ.get("SERVING_WEIGHTS", "1") == "1"
+# Inference backend: torch, or onnxruntime running ONNX_MODEL (exported on first boot if missing) on ORT_THREADS
+BACKEND = os.environ.get("BACKEND", "torch")
+ONNX_MODEL = os.environ.get("ONNX_MODEL", "")
+ORT_THREADS = int(os.environ.get("ORT_THREADS", "0"))
+# Fold BatchNorm into the convs and skip the empty FFC branches once the torch model is loaded
+OPTIMIZE = os.environ.get("OPTIMIZE", "1") == "1"
+# torch backend: channels_last weights and inputs, and fp32 or bf16 autocast (FFTs stay fp32), see
+# bin/benchmark_precision.py for the speed and drift on the deployment CPU
+PRECISION = os.environ.get("PRECISION", "fp32")
+CHANNELS_LAST = os.environ.get("CHANNELS_LAST", "0") == "1"
+# torch.compile the model for the COMPILE_SHAPES (HxW) buckets and COMPILE_BATCH_SIZES, warmed up at startup
+# from the artifacts in COMPILE_CACHE_DIR; inputs are padded up to the smallest fitting bucket, larger ones run eager
+COMPILE = os.environ.get("COMPILE", "0") == "1"
+COMPILE_SHAPES = os.environ.get("COMPILE_SHAPES", "512x512,1024x768,768x1024,1024x1024")
+COMPILE_BATCH_SIZES = [int(b) for b in os.environ.get("COMPILE_BATCH_SIZES", "1").split(",")]
+COMPILE_CACHE_DIR = os.environ.get("COMPILE_CACHE_DIR", os.path.join(MODEL_DIR, "compile_cache"))
+COMPILE_MODE = os.environ.get("COMPILE_MODE", "") or None  # e.g. max-autotune
+# Int8 generator calibrated by bin/quantize_generator.py, QUANTIZED_WEIGHTS defaults to models/<ckpt>.generator.int8.pt
+QUANTIZED = os.environ.get("QUANTIZED", "0") == "1"
+QUANTIZED_WEIGHTS = os.environ.get("QUANTIZED_WEIGHTS", "")
+# ROI mode: inpaint only context-padded crops around the mask at native resolution
+#   off - whole (downscaled) page, bbox - one crop around the whole mask,
+#   components - one crop per cluster of connected components, batched by shape bucket
+ROI_MODE = os.environ.get("ROI_MODE", "off")
+ROI_MARGIN = int(os.environ.get("ROI_MARGIN", "64"))  # context pixels around the mask bbox
+ROI_MERGE_DISTANCE = int(os.environ.get("ROI_MERGE_DISTANCE", "32"))  # components closer than this share a crop
+# Inputs are padded up to these sides so that crops and pages of similar size can share a batch
+SHAPE_BUCKETS = [int(b) for b in os.environ.get("SHAPE_BUCKETS", "128,256,384,512,768,1024,1536").split(",")]
+# Tiled mode: run full-resolution pages in overlapping tiles instead of downscaling them to MAX_SIZE
+TILED = os.environ.get("TILED", "0") == "1"
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "512"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "64"))
+TILE_CONTEXT_SIZE = int(os.environ.get("TILE_CONTEXT_SIZE", "512"))  # low-res global context pass, 0 disables
+# Composite mode: pages larger than MAX_SIZE still run downscaled, but only the prediction inside the mask dilated
+# by COMPOSITE_DILATION px and feathered over COMPOSITE_FEATHER px (0: one and two model px) is upscaled and
+# blended into the original page, which is returned at full resolution
+COMPOSITE = os.environ.get("COMPOSITE", "0") == "1"
+COMPOSITE_DILATION = int(os.environ.get("COMPOSITE_DILATION", "0"))
+COMPOSITE_FEATHER = int(os.environ.get("COMPOSITE_FEATHER", "0"))
+# Refinement of whole-page predictions ("refine" request key, torch backend only): REFINE_ITERS optimizer steps per
+# scale on up to REFINE_MAX_SCALES scales of the image pyramid, like bin/predict.py with refine=True
+REFINE_ITERS = int(os.environ.get("REFINE_ITERS", "15"))
+REFINE_MAX_SCALES = int(os.environ.get("REFINE_MAX_SCALES", "3"))
+# Micro-batching of concurrent requests: up to BATCH_SIZE same-bucket inputs, waiting at most BATCH_TIMEOUT_MS;
+# a request whose inputs are not inpainted within BATCH_RESULT_TIMEOUT seconds fails instead of hanging
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "1"))
+BATCH_TIMEOUT_MS = float(os.environ.get("BATCH_TIMEOUT_MS", "20"))
+BATCH_RESULT_TIMEOUT = float(os.environ.get("BATCH_RESULT_TIMEOUT", "300"))
+# Content-addressed result cache: in-process LRU of CACHE_MB, plus CACHE_DIR on disk up to CACHE_DISK_MB if set
+CACHE_MB = float(os.environ.get("CACHE_MB", "256"))
+CACHE_DIR = os.environ.get("CACHE_DIR", "")
+CACHE_DISK_MB = float(os.environ.get("CACHE_DISK_MB", "2048"))
+# Identical requests (same hash as the result cache) arriving while one of them runs share its result
+COALESCE = os.environ.get("COALESCE", "1") == "1"
+# Output encoding, in memory on ENCODE_WORKERS threads: png (PNG_COMPRESSION 0-9), webp (lossless) or jpeg (JPEG_QUALITY)
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "png")
+PNG_COMPRESSION = int(os.environ.get("PNG_COMPRESSION", "1"))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "95"))
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", "2"))
+# URL inputs: shared keep-alive session, image and mask downloaded concurrently, streamed with a size cap,
+# optionally decoded while downloading
+FETCH_POOL_SIZE = int(os.environ.get("FETCH_POOL_SIZE", "8"))
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", "60"))
+FETCH_MAX_MB = float(os.environ.get("FETCH_MAX_MB", "64"))
+FETCH_PROGRESSIVE = os.environ.get("FETCH_PROGRESSIVE", "0") == "1"
+# Memory admission (off by default, enable once bin/calibrate_memory.py has written MEMORY_MODEL for this machine;
+# without it the default coefficients are used): every model run reserves its predicted peak memory out of the
+# memory free at start minus MEMORY_HEADROOM_MB and waits up to ADMISSION_TIMEOUT s for it; whole pages too large
+# for that budget are downscaled, but not below ADMISSION_MIN_SIDE. MAX_SIZE=auto runs every page at the largest
+# size that fits the budget
+ADMISSION = os.environ.get("ADMISSION", "0") == "1"
+MEMORY_MODEL = os.environ.get("MEMORY_MODEL", os.path.join(MODEL_DIR, "memory_model.json"))
+MEMORY_HEADROOM_MB = float(os.environ.get("MEMORY_HEADROOM_MB", "512"))
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", "30"))
+ADMISSION_MIN_SIDE = int(os.environ.get("ADMISSION_MIN_SIDE", "256"))
+# refinement backpropagates through the generator, its peak is counted as this many forward passes
+REFINE_MEMORY_FACTOR = float(os.environ.get("REFINE_MEMORY_FACTOR", "8"))
+# Mask edge blurring runs at model resolution with OpenCV, or as torch ops on this device (e.g. cpu, cuda) if set
+MASK_DEVICE = os.environ.get("MASK_DEVICE", "")
 
+FETCHER = UrlFetcher(FETCH_POOL_SIZE, FETCH_TIMEOUT, int(FETCH_MAX_MB * 1024 * 1024), progressive=FETCH_PROGRESSIVE)
 
-def _read_image(data: str) -> np.ndarray:
-    """Read image from base64 or URL/file path into RGB np.uint8."""
-    if data.startswith("http://") or data.startswith("https://"):
-        import requests
 
-        resp = requests.get(data, timeout=60)
-        resp.raise_for_status()
-        buf = io.BytesIO(resp.content)
-        img = Image.open(buf).convert("RGB")
+def _read_image(data) -> np.ndarray:
+    """Read image from a decoded PIL image, raw encoded bytes, base64 or URL/file path into RGB np.uint8."""
+    if isinstance(data, Image.Image):
+        img = data.convert("RGB")
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+    elif data.startswith("http://") or data.startswith("https://"):
+        return _read_image(FETCHER.fetch(data)[0])
     elif os.path.exists(data):
         img = Image.open(data).convert("RGB")
     else:
@@ -45,15 +156,14 @@ def _read_image(data: str) -> np.ndarray:
     return np.array(img)
 
 
-def _read_mask(data: str, target_wh=None) -> np.ndarray:
+def _read_mask(data, target_wh=None) -> np.ndarray:
     """Read mask as single-channel uint8 0/255; resize to image size if needed."""
-    if data.startswith("http://") or data.startswith("https://"):
-        import requests
-
-        resp = requests.get(data, timeout=60)
-        resp.raise_for_status()
-        buf = io.BytesIO(resp.content)
-        mask_img = Image.open(buf).convert("L")
+    if isinstance(data, Image.Image):
+        mask_img = data.convert("L")
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        mask_img = Image.open(io.BytesIO(data)).convert("L")
+    elif data.startswith("http://") or data.startswith("https://"):
+        return _read_mask(FETCHER.fetch(data)[0], target_wh)
     elif os.path.exists(data):
         mask_img = Image.open(data).convert("L")
     else:
@@ -68,36 +178,20 @@ def _read_mask(data: str, target_wh=None) -> np.ndarray:
     return np.array(mask_img)
 
 
-def _process_mask(mask: np.ndarray, blur_edges: bool = True, blur_radius: int = 5, feather_amount: float = 0.1) -> np.ndarray:
+def _process_mask(mask: np.ndarray, mask_processing: Dict[str, Any], scale: float = 1.0) -> np.ndarray:
     """
-    Обрабатывает маску для более плавных переходов
-    
-    Args:
-        mask: Исходная маска (0-255)
-        blur_edges: Включить размытие краев
-        blur_radius: Радиус размытия (1-15)
-        feather_amount: Количество смягчения переходов (0.0-0.5)
-    
-    Returns:
-        Обработанная маска
+    Blur the mask edges for smoother transitions (see saicinpainting/inference/mask_processing.py),
+    on MASK_DEVICE with torch ops or with OpenCV; scale is the resize factor of mask against the input page.
     """
-    processed_mask = mask.copy().astype(np.float32) / 255.0
-    
-    if blur_edges:
-        # Применяем Gaussian blur для размытия краев
-        processed_mask = ndimage.gaussian_filter(processed_mask, sigma=blur_radius/3.0)
-        
-        # Дополнительное смягчение переходов
-        if feather_amount > 0:
-            # Создаем градиент для плавных переходов
-            kernel_size = max(3, int(blur_radius * feather_amount))
-            kernel = np.ones((kernel_size, kernel_size), np.float32) / (kernel_size * kernel_size)
-            processed_mask = cv2.filter2D(processed_mask, -1, kernel)
-    
-    # Нормализуем обратно к 0-255
-    processed_mask = np.clip(processed_mask * 255.0, 0, 255).astype(np.uint8)
-    
-    return processed_mask
+    if not mask_processing["blur_edges"]:
+        return mask
+    blur_radius, feather_amount = mask_processing["blur_radius"], mask_processing["feather_amount"]
+    with stage("process_mask"):
+        if MASK_DEVICE:
+            masks = torch.from_numpy(mask).to(MASK_DEVICE)[None, None].float().div_(255.0)
+            processed = process_mask_tensor(masks, blur_radius, feather_amount, scale)
+            return processed[0, 0].mul_(255.0).round_().to(torch.uint8).cpu().numpy()
+        return process_mask(mask, blur_radius, feather_amount, scale)
 
 
 def _ensure_checkpoint_exists(target_path: str):
@@ -135,16 +229,78 @@ def _ensure_checkpoint_exists(target_path: str):
         os.rename(tmp_path, target_path)
 
 
-def load_model():
+def _read_train_config():
     train_config_path = os.path.join(MODEL_DIR, "config.yaml")
     with open(train_config_path, "r") as f:
         train_config = OmegaConf.create(yaml.safe_load(f))
     # predict-only tweaks
     train_config.training_model.predict_only = True
     train_config.visualizer.kind = "noop"
+    return train_config
+
+
+def _load_serving_model(timings: Dict[str, float]):
+    weights_path, serving_config_path = get_serving_paths(MODEL_DIR, CHECKPOINT)
+    if not (os.path.exists(weights_path) and os.path.exists(serving_config_path)):
+        started_at = time.perf_counter()
+        checkpoint_path = os.path.join(MODEL_DIR, "models", CHECKPOINT)
+        _ensure_checkpoint_exists(checkpoint_path)
+        timings["download"] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        convert_checkpoint(_read_train_config(), checkpoint_path, weights_path, serving_config_path)
+        timings["convert"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    serving_config = load_serving_config(serving_config_path)
+    timings["read_config"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with torch.device("meta"):
+        # generator only, without pytorch_lightning; no memory is allocated for weights which are replaced right away
+        model = build_model(serving_config)
+    timings["build"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    if QUANTIZED:
+        _load_quantized_weights(model)
+    else:
+        load_generator_weights(model.generator, weights_path)
+    timings["load_weights"] = time.perf_counter() - started_at
+    return model
+
+
+def _get_quantized_path() -> str:
+    return QUANTIZED_WEIGHTS or os.path.splitext(get_serving_paths(MODEL_DIR, CHECKPOINT)[0])[0] + ".int8.pt"
+
+
+def _load_quantized_weights(model):
+    from saicinpainting.inference.quantization import make_quantized_structure
+
+    path = _get_quantized_path()
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run bin/quantize_generator.py first")
+    model.generator.to_empty(device="cpu")
+    # int8 weights are saved for the folded generator, see bin/quantize_generator.py
+    optimize_for_inference(model.generator.eval())
+    make_quantized_structure(model.generator)
+    model.generator.load_state_dict(torch.load(path, map_location="cpu", weights_only=True))
+
 
+def _load_legacy_model(timings: Dict[str, float]):
+    # full training module, pulls in pytorch_lightning and the evaluation stack
+    from saicinpainting.training.trainers import load_checkpoint
+
+    started_at = time.perf_counter()
+    train_config = _read_train_config()
+    timings["read_config"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
     checkpoint_path = os.path.join(MODEL_DIR, "models", CHECKPOINT)
     _ensure_checkpoint_exists(checkpoint_path)
+    timings["download"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
     # If downloaded file is a raw gen_state_dict, wrap now
     try:
         state = torch.load(checkpoint_path, map_location="cpu")
@@ -157,106 +313,732 @@ def load_model():
     except Exception:
         pass
     model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location="cpu")
+    timings["load_weights"] = time.perf_counter() - started_at
+    return model
+
+
+def _get_onnx_path() -> str:
+    return ONNX_MODEL or os.path.splitext(get_serving_paths(MODEL_DIR, CHECKPOINT)[0])[0] + ".onnx"
+
+
+def _load_onnx_model(timings: Dict[str, float]):
+    from saicinpainting.inference.onnx_backend import OnnxInpaintingModel, export_onnx
+
+    onnx_path = _get_onnx_path()
+    if not os.path.exists(onnx_path):
+        model = _load_serving_model(timings)
+        started_at = time.perf_counter()
+        export_onnx(model.freeze(), onnx_path, fft="matmul")
+        timings["export"] = time.perf_counter() - started_at
+        del model
+
+    started_at = time.perf_counter()
+    model = OnnxInpaintingModel(onnx_path, threads=ORT_THREADS)
+    timings["load_onnx"] = time.perf_counter() - started_at
+    return model
+
+
+def _compile_model(model, timings: Dict[str, float]):
+    from saicinpainting.inference.compiled import CompiledInpaintingModel, load_compile_cache, parse_shapes, \
+        save_compile_cache
+
+    started_at = time.perf_counter()
+    load_compile_cache(COMPILE_CACHE_DIR)
+    model = CompiledInpaintingModel(model, parse_shapes(COMPILE_SHAPES), COMPILE_BATCH_SIZES, mode=COMPILE_MODE)
+    print(f"[INFO] Compile warm-up (s): {model.warm_up(device=DEVICE)}")
+    save_compile_cache(COMPILE_CACHE_DIR)
+    timings["compile"] = time.perf_counter() - started_at
+    return model
+
+
+def load_model():
+    timings = {"imports": time.perf_counter() - _IMPORT_STARTED_AT}
+    if QUANTIZED and not (BACKEND == "torch" and SERVING_WEIGHTS):
+        raise ValueError("QUANTIZED=1 requires BACKEND=torch and SERVING_WEIGHTS=1")
+    if QUANTIZED and PRECISION != "fp32":
+        raise ValueError("QUANTIZED=1 runs int8 convs, PRECISION must be fp32")
+    if BACKEND == "onnxruntime":
+        model = _load_onnx_model(timings)
+    elif BACKEND == "torch":
+        model = _load_serving_model(timings) if SERVING_WEIGHTS else _load_legacy_model(timings)
+    else:
+        raise ValueError(f"Unknown BACKEND {BACKEND}, expected torch or onnxruntime")
+
+    started_at = time.perf_counter()
     model.freeze()
     model.to(torch.device(DEVICE))
+    timings["freeze"] = time.perf_counter() - started_at
+
+    if BACKEND == "torch" and OPTIMIZE and not QUANTIZED:
+        started_at = time.perf_counter()
+        optimize_for_inference(model.generator)
+        timings["optimize"] = time.perf_counter() - started_at
+    if BACKEND == "torch":
+        model = apply_precision(model, PRECISION, CHANNELS_LAST, device_type=torch.device(DEVICE).type)
+    if COMPILE:
+        if BACKEND != "torch":
+            raise ValueError("COMPILE=1 requires BACKEND=torch")
+        model = _compile_model(model, timings)
+
+    timings["total"] = time.perf_counter() - _IMPORT_STARTED_AT
+    STARTUP_TIMINGS.update({name: round(value, 3) for name, value in timings.items()})
+    print(f"[INFO] Startup timings (s): {STARTUP_TIMINGS}")
     return model
 
 
+def _get_checkpoint_id() -> str:
+    """Name, size and mtime of the loaded weights, so that cached results are not served for another checkpoint."""
+    if BACKEND == "onnxruntime":
+        path = _get_onnx_path()
+    elif QUANTIZED:
+        path = _get_quantized_path()
+    elif SERVING_WEIGHTS:
+        path = get_serving_paths(MODEL_DIR, CHECKPOINT)[0]
+    else:
+        path = os.path.join(MODEL_DIR, "models", CHECKPOINT)
+    stat = os.stat(path)
+    variant = BACKEND + (":int8" if QUANTIZED else "") + (f":{PRECISION}" if PRECISION != "fp32" else "")
+    if BACKEND == "torch":
+        # folded BatchNorm, memory format and compiled kernels change the output in the last bits
+        variant += (":optimized" if OPTIMIZE and not QUANTIZED else "") + (":channels_last" if CHANNELS_LAST else "")
+        if COMPILE:
+            variant += f":compiled={COMPILE_SHAPES}/{','.join(map(str, COMPILE_BATCH_SIZES))}/{COMPILE_MODE}"
+    return f"{variant}:{CHECKPOINT}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+STARTUP_TIMINGS = {}
 INPAINTER = load_model()
+COMPILED = INPAINTER if COMPILE else None
+CHECKPOINT_ID = _get_checkpoint_id()
+ENCODE_POOL = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+RESULT_CACHE = ResultCache(int(CACHE_MB * 1024 * 1024), CACHE_DIR or None, int(CACHE_DISK_MB * 1024 * 1024))
+IN_FLIGHT = SingleFlight() if COALESCE else None
+# after the model is loaded, so that the capacity measured at start is what is left for activations
+MEMORY = MemoryAdmission(MemoryModel.load(MEMORY_MODEL), DEVICE, int(MEMORY_HEADROOM_MB * 1024 * 1024),
+                         ADMISSION_TIMEOUT) if ADMISSION else None
+if MEMORY is not None:
+    print(f"[INFO] Memory admission: {MEMORY.model}, {MEMORY.capacity / 2 ** 20:.0f} MB for model runs")
 
 
-def handler(event: Dict[str, Any]) -> Dict[str, Any]:
-    inp = event.get("input", {})
+def _fit_size(width: int, height: int, max_size: int):
+    """Downscale (width, height) to fit max_size and floor both sides to multiples of 8 (required by model)."""
+    if max(width, height) > max_size:
+        ratio = max_size / max(width, height)
+        width = int(width * ratio)
+        height = int(height * ratio)
+    return max(8, (width // 8) * 8), max(8, (height // 8) * 8)
 
-    try:
-        image = _read_image(inp["image"])  # RGB HxWx3 uint8
-        mask = _read_mask(inp["mask"], target_wh=(image.shape[1], image.shape[0]))  # HxW uint8
-        
-        # Processing parameters with defaults
-        blur_edges = inp.get("blur_edges", True)  # Размытие краев маски
-        blur_radius = inp.get("blur_radius", 5)   # Радиус размытия (1-15)
-        feather_amount = inp.get("feather_amount", 0.1)  # Смягчение переходов (0.0-0.5)
-        
-        # Обрабатываем маску для плавных переходов
-        if blur_edges:
-            mask = _process_mask(mask, blur_edges, blur_radius, feather_amount)
 
-        # Auto-resize for memory efficiency and ensure dimensions are multiples of 8
-        max_size = int(os.environ.get("MAX_SIZE", "1024"))  # Max dimension
-        orig_size = (image.shape[1], image.shape[0])
-        
-        print(f"[INFO] Input size: {orig_size}")
-        
-        # Calculate new dimensions
-        if max(orig_size) > max_size:
-            ratio = max_size / max(orig_size)
-            new_w = int(orig_size[0] * ratio)
-            new_h = int(orig_size[1] * ratio)
+def _parse_max_size(value: str):
+    return value if value == "auto" else int(value)
+
+
+def _get_max_size(width: int, height: int) -> int:
+    """MAX_SIZE, or with MAX_SIZE=auto the longest side at which this page fits the memory free at start."""
+    max_size = _parse_max_size(os.environ.get("MAX_SIZE", "1024"))  # Max dimension
+    if max_size != "auto":
+        return max_size
+    if MEMORY is None:
+        raise ValueError("MAX_SIZE=auto requires ADMISSION=1")
+    return max(ADMISSION_MIN_SIDE, MEMORY.get_max_side(height, width))
+
+
+def _get_admitted_size(width: int, height: int, batch_size: float = 1):
+    """
+    (width, height) downscaled further if the model run would not fit the memory budget even with no other run in
+    flight, and the (width, height) it was downscaled from or None; raises InsufficientMemory below ADMISSION_MIN_SIDE.
+    """
+    if MEMORY is None:
+        return (width, height), None
+    scale = MEMORY.get_scale(height, width, batch_size)
+    if scale >= 1:
+        return (width, height), None
+    side = int(max(width, height) * scale)
+    if side < ADMISSION_MIN_SIDE:
+        MEMORY.record("rejected")
+        raise InsufficientMemory(f"Not enough memory for {width}x{height} even at {ADMISSION_MIN_SIDE}px")
+    MEMORY.record("downscaled")
+    print(f"[INFO] Not enough memory for ({width}, {height}), downscaling to {side}px")
+    return _fit_size(width, height, side), (width, height)
+
+
+@contextlib.contextmanager
+def _admit(height: int, width: int, batch_size: float = 1):
+    """Reserve the predicted peak memory of a model run on padded HxW inputs while the block runs."""
+    if MEMORY is None:
+        yield
+        return
+    with MEMORY.reserve(height, width, batch_size) as waited:
+        add_stage_time("admission", waited * 1000)
+        yield
+
+
+def _make_batch(images, masks) -> Dict[str, torch.Tensor]:
+    """Build batch like in predict.py from same-sized RGB uint8 images and uint8 masks."""
+    image_f = np.stack(images).transpose(0, 3, 1, 2).astype("float32") / 255.0
+    mask_f = (np.stack(masks) > 0).astype("float32")[:, None]  # binarize
+
+    batch = {"image": torch.from_numpy(image_f), "mask": torch.from_numpy(mask_f)}
+    return move_to_device(batch, torch.device(DEVICE))
+
+
+def _to_uint8(images: torch.Tensor) -> np.ndarray:
+    res = images.permute(0, 2, 3, 1).detach().cpu().numpy()
+    return np.clip(res * 255, 0, 255).astype("uint8")
+
+
+def _run_inpainter_batch(images, masks):
+    """
+    Run INPAINTER on same-sized RGB uint8 images and uint8 masks as one batch, return Nx(HxWx3) uint8
+    and the compiled bucket the batch ran in (None for eager).
+    """
+    with stage("tensor_build"):
+        batch = _make_batch(images, masks)
+
+    with torch.no_grad(), stage("forward"):
+        batch["mask"] = (batch["mask"] > 0) * 1
+        out = INPAINTER(batch)
+
+    with stage("postprocess"):
+        return _to_uint8(out["inpainted"]), out.get("compiled_bucket")
+
+
+def _get_bucket(mask: np.ndarray):
+    return get_bucket_side(mask.shape[0], SHAPE_BUCKETS), get_bucket_side(mask.shape[1], SHAPE_BUCKETS)
+
+
+def _run_bucket(bucket, pairs):
+    """
+    Run (image, mask) pairs of one shape bucket as a single batch, return (inpainted RGB uint8 of the
+    original size, compiled bucket, stage timings of the batch) per pair.
+    Timings are collected here since SCHEDULER runs batches on its own thread.
+    """
+    bucket_h, bucket_w = bucket
+    if len(pairs) == 1:
+        # nothing to batch with, modulo padding is enough
+        bucket_h, bucket_w = ceil_modulo(pairs[0][1].shape[0], 8), ceil_modulo(pairs[0][1].shape[1], 8)
+    with collect_stages() as timings:
+        with stage("tensor_build"):
+            images = [pad_to_size(image, bucket_h, bucket_w) for image, _ in pairs]
+            masks = [pad_to_size(mask, bucket_h, bucket_w) for _, mask in pairs]
+        with _admit(bucket_h, bucket_w, len(pairs)):
+            preds, compiled = _run_inpainter_batch(images, masks)
+    return [(pred[:mask.shape[0], :mask.shape[1]], compiled, timings) for (_, mask), pred in zip(pairs, preds)]
+
+
+def _add_batch_timings(results):
+    """Add the stage timings of every distinct batch the results ran in to the current request."""
+    for timings in {id(timings): timings for _, _, timings in results}.values():
+        for name, ms in timings.items():
+            add_stage_time(name, ms)
+
+
+SCHEDULER = MicroBatchScheduler(_run_bucket, BATCH_SIZE, BATCH_TIMEOUT_MS / 1000.0) if BATCH_SIZE > 1 else None
+
+
+def _run_inpainter_many(pairs, batching=None, compiled=None):
+    """
+    Inpaint (image, mask) pairs of any sizes, running the ones that share a shape bucket as one batch.
+    With SCHEDULER they are also batched with inputs of concurrent requests; per-input batching
+    decisions are appended to the batching list and compiled buckets (None for eager) to the compiled list if given.
+    """
+    if SCHEDULER is not None:
+        requests = [SCHEDULER.submit(_get_bucket(mask), (image, mask)) for image, mask in pairs]
+        deadline = time.monotonic() + BATCH_RESULT_TIMEOUT
+        try:
+            results = [request.result(max(0.0, deadline - time.monotonic())) for request in requests]
+        except FuturesTimeoutError:
+            for request in requests:
+                request.cancel()  # the ones still queued are dropped, nobody waits for them any more
+            raise TimeoutError(f"Inpainting {len(requests)} input(s) took over {BATCH_RESULT_TIMEOUT:g}s "
+                               f"in the micro-batch scheduler")
+        if batching is not None:
+            batching.extend({"bucket": list(request.key), "batch_size": request.batch_size,
+                             "wait_ms": round(request.wait_time * 1000, 2)} for request in requests)
+        if compiled is not None:
+            compiled.extend(bucket for _, bucket, _ in results)
+        _add_batch_timings(results)
+        return [pred for pred, _, _ in results]
+
+    groups = {}
+    for i, (_, mask) in enumerate(pairs):
+        groups.setdefault(_get_bucket(mask), []).append(i)
+    results = [None] * len(pairs)
+    for bucket, indices in groups.items():
+        for i, result in zip(indices, _run_bucket(bucket, [pairs[i] for i in indices])):
+            results[i] = result
+    if batching is not None:
+        batching.extend({"bucket": list(bucket), "batch_size": len(indices), "wait_ms": 0.0}
+                        for bucket, indices in groups.items() for _ in indices)
+    if compiled is not None:
+        compiled.extend(bucket for _, bucket, _ in results)
+    _add_batch_timings(results)
+    return [pred for pred, _, _ in results]
+
+
+def _run_inpainter(image: np.ndarray, mask: np.ndarray, batching=None, compiled=None) -> np.ndarray:
+    """Run INPAINTER on RGB uint8 image and uint8 mask, return inpainted RGB uint8 of the same size."""
+    return _run_inpainter_many([(image, mask)], batching, compiled)[0]
+
+
+def _run_tiled(image: np.ndarray, mask: np.ndarray, compiled=None) -> np.ndarray:
+    """Run INPAINTER over the full-resolution page in overlapping feathered tiles."""
+    def run_model(batch):
+        with _admit(*batch["image"].shape[2:], batch["image"].shape[0]), stage("forward"):
+            batch = INPAINTER(batch)
+        if compiled is not None:
+            compiled.append(batch.get("compiled_bucket"))
+        return batch
+
+    with stage("tensor_build"):
+        batch = _make_batch([image], [mask])
+    res = tiled_inpaint(run_model, batch, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                        context_size=TILE_CONTEXT_SIZE or None)
+    with stage("postprocess"):
+        return _to_uint8(res)[0]
+
+
+def _run_refiner(image: np.ndarray, mask: np.ndarray, progress=None) -> np.ndarray:
+    """
+    Refine the prediction for RGB uint8 image and uint8 mask of multiple-of-8 sides, return inpainted RGB uint8.
+    progress is called with the scale and iteration of the refiner after every step, see refine_predict.
+    """
+    model = INPAINTER
+    while not hasattr(model, "concat_mask") and hasattr(model, "model"):
+        model = model.model  # refine the fp32 InpaintingModel under PrecisionModel or CompiledInpaintingModel
+    device = torch.device(DEVICE)
+    gpu_ids = f"{device.index or 0}," if device.type == "cuda" else ""
+
+    with stage("tensor_build"):
+        batch = _make_batch([image], [mask])
+        batch["unpad_to_size"] = [torch.tensor([image.shape[0]]), torch.tensor([image.shape[1]])]
+    with _admit(*image.shape[:2], REFINE_MEMORY_FACTOR), stage("refine"):
+        res = refine_predict(batch, model, gpu_ids=gpu_ids, modulo=8, n_iters=REFINE_ITERS, lr=0.002,
+                             min_side=512, max_scales=REFINE_MAX_SCALES, px_budget=1800000, progress=progress)
+    with stage("postprocess"):
+        return _to_uint8(res)[0]
+
+
+def _get_refine(inp: Dict[str, Any]) -> bool:
+    """Whether the request asks for refinement; it runs on the whole-page path of the torch model only."""
+    refine = bool(inp.get("refine", False))
+    if refine and (BACKEND != "torch" or QUANTIZED):
+        raise ValueError("refine requires BACKEND=torch and QUANTIZED=0")
+    if refine and (_parse_roi_mode(inp.get("roi_mode", ROI_MODE)) != "off" or bool(inp.get("tiled", TILED))):
+        raise ValueError("refine is not supported with roi_mode or tiled")
+    return refine
+
+
+def _parse_roi_mode(value) -> str:
+    if value is True:
+        return "bbox"
+    if value in (None, False, "", "0", "off"):
+        return "off"
+    value = "bbox" if value == "1" else str(value)
+    if value not in ("bbox", "components"):
+        raise ValueError(f"Unknown roi_mode {value}")
+    return value
+
+
+def _inpaint_rois(image: np.ndarray, mask: np.ndarray, bboxes, batching=None, compiled=None) -> np.ndarray:
+    """
+    Inpaint only the given disjoint crops and paste them back into the untouched original.
+    Crops are padded into SHAPE_BUCKETS shapes and every bucket runs as one batch.
+    """
+    pairs = []
+    with stage("resize"):
+        for bbox in bboxes:
+            crop_img = crop_roi(image, bbox)
+            crop_mask = crop_roi(mask, bbox)
+            crop_h, crop_w = crop_mask.shape[:2]
+            max_size = _get_max_size(crop_w, crop_h)
+            if max(crop_w, crop_h) > max_size:
+                # the ROI itself is too large, so run it downscaled and take only the masked pixels from the prediction
+                small_w, small_h = _fit_size(crop_w, crop_h, max_size)
+                crop_img = np.array(Image.fromarray(crop_img).resize((small_w, small_h), Image.LANCZOS))
+                crop_mask = np.array(Image.fromarray(crop_mask).resize((small_w, small_h), Image.NEAREST))
+            pairs.append((crop_img, crop_mask))
+
+    preds = _run_inpainter_many(pairs, batching, compiled)
+    with stage("postprocess"):
+        result = image.copy()
+        for bbox, pred in zip(bboxes, preds):
+            x0, y0, x1, y1 = bbox
+            if pred.shape[:2] != (y1 - y0, x1 - x0):
+                pred = cv2.resize(pred, (x1 - x0, y1 - y0), interpolation=cv2.INTER_CUBIC)
+                pred = np.where((crop_roi(mask, bbox) > 0)[..., None], pred, crop_roi(image, bbox))
+            result[y0:y1, x0:x1] = pred
+
+    return result
+
+
+def _get_cache_key(inp: Dict[str, Any], image: np.ndarray, mask: np.ndarray, mask_processing: Dict[str, Any],
+                   output: Dict[str, Any]) -> str:
+    """Hash of the decoded pixels and of every parameter the result depends on."""
+    roi_mode = _parse_roi_mode(inp.get("roi_mode", ROI_MODE))
+    params = {
+        "mask_processing": mask_processing,
+        # the torch blur of MASK_DEVICE is not bit-exact with the OpenCV one
+        "mask_device": MASK_DEVICE,
+        "output": output,
+        "max_size": _parse_max_size(os.environ.get("MAX_SIZE", "1024")),
+        "checkpoint": CHECKPOINT_ID,
+        "roi_mode": roi_mode,
+        # inputs that run in one batch (ROI crops, micro-batched requests) are padded to their shape bucket
+        "shape_buckets": SHAPE_BUCKETS,
+        "batch_size": BATCH_SIZE,
+    }
+    if params["max_size"] == "auto" and MEMORY is not None:
+        # the page size depends on the memory free at start, in steps of 256 MB
+        params["memory_capacity"] = MEMORY.capacity >> 28
+    if roi_mode != "off":
+        params["roi_margin"] = int(inp.get("roi_margin", ROI_MARGIN))
+        params["roi_merge_distance"] = int(inp.get("roi_merge_distance", ROI_MERGE_DISTANCE))
+    elif bool(inp.get("tiled", TILED)):
+        params["tiled"] = [TILE_SIZE, TILE_OVERLAP, TILE_CONTEXT_SIZE]
+    else:
+        if bool(inp.get("composite", COMPOSITE)):
+            params["composite"] = [COMPOSITE_DILATION, COMPOSITE_FEATHER]
+        if _get_refine(inp):
+            params["refine"] = [REFINE_ITERS, REFINE_MAX_SCALES]
+    return make_cache_key(list(image.shape), image.tobytes(), list(mask.shape), mask.tobytes(), params)
+
+
+def _get_cache_info(hit: bool, tier=None) -> Dict[str, Any]:
+    stats = RESULT_CACHE.stats()
+    return {"hit": hit, "tier": tier, "hits": stats["hits"], "misses": stats["misses"],
+            "memory_bytes": stats["memory_bytes"], "disk_bytes": stats["disk_bytes"]}
+
+
+def _get_cached_result(cache_key: str):
+    cached = RESULT_CACHE.get(cache_key)
+    if cached is None:
+        return None
+    data, metadata, tier = cached
+    print(f"[INFO] Result cache hit ({tier}): {cache_key}")
+    return {
+        "data": data,
+        "content_type": metadata["output"]["content_type"],
+        "metadata": {**metadata, "output": {**metadata["output"], "encode_ms": 0.0},
+                     "cache": _get_cache_info(True, tier)}
+    }
+
+
+def prepare_request(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Decode the image and mask of a request; no model work happens here, the mask is processed at model resolution
+    by inpaint_request. A result cache hit is returned as the ready "encoded" result of the request.
+    """
+    with collect_stages() as timings:
+        request = _prepare_request(inp)
+    if "encoded" in request:
+        request["encoded"]["metadata"]["timings"] = timings
+    else:
+        request["timings"] = timings
+    return request
+
+
+def _prepare_request(inp: Dict[str, Any]) -> Dict[str, Any]:
+    # bad options fail before any download, decoding or model work
+    output = get_output_options(inp, OUTPUT_FORMAT, PNG_COMPRESSION, JPEG_QUALITY)
+    _get_refine(inp)
+
+    # URL inputs are downloaded concurrently
+    started_at = time.perf_counter()
+    with stage("fetch"):
+        sources, fetch = FETCHER.fetch_all({"image": inp["image"], "mask": inp["mask"]})
+    if fetch:
+        fetch["wall_ms"] = round((time.perf_counter() - started_at) * 1000, 2)
+        print(f"[INFO] Fetched {len(fetch) - 1} URL input(s) in {fetch['wall_ms']} ms")
+
+    with stage("decode"):
+        image = _read_image(sources["image"])  # RGB HxWx3 uint8
+    with stage("read_mask"):
+        mask = _read_mask(sources["mask"], target_wh=(image.shape[1], image.shape[0]))  # HxW uint8
+
+    # Processing parameters with defaults
+    blur_edges = inp.get("blur_edges", True)  # Размытие краев маски
+    blur_radius = inp.get("blur_radius", 5)   # Радиус размытия (1-15)
+    feather_amount = inp.get("feather_amount", 0.1)  # Смягчение переходов (0.0-0.5)
+    mask_processing = {
+        "blur_edges": blur_edges,
+        "blur_radius": blur_radius,
+        "feather_amount": feather_amount
+    }
+
+    key = cache_key = None
+    use_cache = RESULT_CACHE.enabled and inp.get("cache", True)
+    if use_cache or IN_FLIGHT is not None:
+        with stage("cache"):
+            key = _get_cache_key(inp, image, mask, mask_processing, output)
+            encoded = _get_cached_result(key) if use_cache else None
+        if encoded is not None:
+            encoded["metadata"]["fetch"] = fetch or None
+            return {"input": inp, "encoded": encoded}
+        cache_key = key if use_cache else None
+
+    return {
+        "input": inp,
+        "image": image,
+        "mask": mask,
+        "mask_processing": mask_processing,
+        "output": output,
+        "fetch": fetch or None,
+        "cache_key": cache_key,
+        "key": key
+    }
+
+
+def inpaint_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run the model on a prepared request, return the RGB uint8 result and its metadata.
+    metadata["timings"] holds the ms spent in each pipeline stage so far.
+    """
+    with collect_stages(dict(request.get("timings", {}))):
+        return _inpaint_request(request)
+
+
+def _inpaint_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    inp, image, mask = request["input"], request["image"], request["mask"]
+
+    orig_size = (image.shape[1], image.shape[0])
+    roi_mode = _parse_roi_mode(inp.get("roi_mode", ROI_MODE))
+    tiled = bool(inp.get("tiled", TILED))
+    composite = None
+    refine = None
+    downscaled_from = None
+    cache_key = request["cache_key"]
+
+    print(f"[INFO] Input size: {orig_size}")
+
+    rois = None
+    batching = []
+    compiled = []  # per model call: compiled bucket or None for eager
+    if roi_mode != "off":
+        # crops are cut at native resolution, so the mask is processed at it too
+        mask = _process_mask(mask, request["mask_processing"])
+        roi_margin = int(inp.get("roi_margin", ROI_MARGIN))
+        if roi_mode == "components":
+            merge_distance = int(inp.get("roi_merge_distance", ROI_MERGE_DISTANCE))
+            rois = get_roi_bboxes(mask, roi_margin, merge_distance)
         else:
-            new_w = orig_size[0]
-            new_h = orig_size[1]
-        
-        # Always ensure dimensions are multiples of 8 (required by model)
-        new_w = (new_w // 8) * 8
-        new_h = (new_h // 8) * 8
-        
+            bbox = get_roi_bbox(mask, roi_margin)
+            rois = [] if bbox is None else [bbox]
+        print(f"[INFO] ROI mode {roi_mode}: {len(rois)} crop(s), margin={roi_margin}")
+        res = _inpaint_rois(image, mask, rois, batching, compiled)
+        rois = [list(bbox) for bbox in rois]
+    elif tiled:
+        print(f"[INFO] Tiled inference at full resolution: tile={TILE_SIZE}, overlap={TILE_OVERLAP}")
+        mask = _process_mask(mask, request["mask_processing"])
+        res = _run_tiled(image, mask, compiled)
+    else:
+        # Auto-resize for memory efficiency and ensure dimensions are multiples of 8
+        new_w, new_h = _fit_size(orig_size[0], orig_size[1], _get_max_size(*orig_size))
+        (new_w, new_h), downscaled_from = _get_admitted_size(new_w, new_h,
+                                                             REFINE_MEMORY_FACTOR if _get_refine(inp) else 1)
+        if downscaled_from is not None:
+            cache_key = None  # smaller than the same request gets with enough memory
+
         print(f"[INFO] Adjusted size: ({new_w}, {new_h}) - multiples of 8")
-        
+
+        full_image, full_mask = image, mask
+        scale = get_resize_scale(orig_size, (new_w, new_h))
+        resized = new_w != orig_size[0] or new_h != orig_size[1]
+
         # Resize if dimensions changed
-        if new_w != orig_size[0] or new_h != orig_size[1]:
+        if resized:
             print(f"[INFO] Resizing from {orig_size} to ({new_w}, {new_h})")
-            image_pil = Image.fromarray(image).resize((new_w, new_h), Image.LANCZOS)
-            mask_pil = Image.fromarray(mask).resize((new_w, new_h), Image.NEAREST)
-            image = np.array(image_pil)
-            mask = np.array(mask_pil)
+            with stage("resize"):
+                image = np.array(Image.fromarray(image).resize((new_w, new_h), Image.LANCZOS))
+                # area keeps strokes thinner than the downscale factor in the mask that is blurred below
+                interpolation = cv2.INTER_AREA if request["mask_processing"]["blur_edges"] else cv2.INTER_NEAREST
+                mask = cv2.resize(mask, (new_w, new_h), interpolation=interpolation)
         else:
             print(f"[INFO] No resize needed")
+        mask = _process_mask(mask, request["mask_processing"], scale)
+
+        if _get_refine(inp):
+            print(f"[INFO] Refining the prediction: {REFINE_ITERS} iteration(s) on up to {REFINE_MAX_SCALES} scale(s)")
+            res = _run_refiner(image, mask, request.get("progress"))
+            refine = {"n_iters": REFINE_ITERS, "max_scales": REFINE_MAX_SCALES}
+        else:
+            res = _run_inpainter(image, mask, batching, compiled)
 
-        # build batch like in predict.py
-        image_f = image.astype("float32") / 255.0
-        mask_f = (mask > 0).astype("float32")  # binarize
-
-        image_t = torch.from_numpy(np.transpose(image_f, (2, 0, 1))).unsqueeze(0)
-        mask_t = torch.from_numpy(mask_f)[None, None, ...]
-
-        batch = {"image": image_t, "mask": mask_t}
-        batch = move_to_device(batch, torch.device(DEVICE))
-
-        with torch.no_grad():
-            batch["mask"] = (batch["mask"] > 0) * 1
-            out = INPAINTER(batch)
-            res = out["inpainted"][0].permute(1, 2, 0).detach().cpu().numpy()
-
-        res = np.clip(res * 255, 0, 255).astype("uint8")
-        res_bgr = cv2.cvtColor(res, cv2.COLOR_RGB2BGR)
-
-        # save to temp file and return base64
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            cv2.imwrite(tmp.name, res_bgr)
-            with open(tmp.name, "rb") as f:
-                b64 = base64.b64encode(f.read()).decode("utf-8")
-        os.unlink(tmp.name)
-
-        return {
-            "status": "ok", 
-            "image_base64": b64,
-            "metadata": {
-                "input_size": orig_size,
-                "output_size": (res.shape[1], res.shape[0]),
-                "device": DEVICE,
-                "model": "lama_large_512px_anime_manga",
-                "mask_processing": {
-                    "blur_edges": blur_edges,
-                    "blur_radius": blur_radius,
-                    "feather_amount": feather_amount
-                }
-            }
+        if resized and bool(inp.get("composite", COMPOSITE)):
+            dilation, feather = get_composite_sizes(scale, COMPOSITE_DILATION, COMPOSITE_FEATHER)
+            with stage("composite"):
+                # the model inpainted the processed mask, whose blur reaches past the raw strokes
+                region = get_composite_mask(full_mask, mask)
+                res, mask, crops = composite_full_res(full_image, region, res, dilation, feather)
+            composite = {"scale": round(scale, 4), "dilation": dilation, "feather": feather, "crops": crops}
+            print(f"[INFO] Composited {crops} crop(s) into the full-resolution page")
+
+    return {
+        "image": res,
+        "mask": mask,  # at the resolution of res, for patch output
+        "output": request["output"],
+        "cache_key": cache_key,
+        "metadata": {
+            "input_size": orig_size,
+            "output_size": (res.shape[1], res.shape[0]),
+            "device": DEVICE,
+            "backend": BACKEND,
+            "quantized": QUANTIZED,
+            "precision": PRECISION,
+            "channels_last": CHANNELS_LAST,
+            "model": "lama_large_512px_anime_manga",
+            "roi_mode": roi_mode,
+            "rois": rois,
+            "tiled": tiled,
+            "composite": composite,
+            "refine": refine,
+            "coalesced": False,
+            "admission": {
+                "enabled": MEMORY is not None,
+                "downscaled_from": downscaled_from,
+            },
+            "batching": {
+                "enabled": SCHEDULER is not None,
+                "inputs": batching,
+                "queue_depth": SCHEDULER.queue_depth() if SCHEDULER is not None else 0,
+            },
+            "compile": {
+                "enabled": COMPILED is not None,
+                "buckets": [list(bucket) if bucket is not None else None for bucket in compiled],
+                "hits": sum(bucket is not None for bucket in compiled),
+                "eager": sum(bucket is None for bucket in compiled),
+            },
+            "mask_processing": request["mask_processing"],
+            "fetch": request["fetch"],
+            "timings": get_stage_timings()
         }
+    }
+
+
+def encode_image(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Encode the inpainted image (or just its changed patch) in memory and store it in the result cache."""
+    started_at = time.perf_counter()
+    options = dict(result["output"])
+    fmt, patch_only = options.pop("format"), options.pop("patch")
+
+    image, patch = result["image"], None
+    if patch_only:
+        image, (x, y, width, height) = crop_patch(image, result["mask"])
+        patch = {"x": x, "y": y, "width": width, "height": height}
+    data, content_type = encode(image, fmt, **options)
+
+    encode_ms = round((time.perf_counter() - started_at) * 1000, 2)
+    metadata = {**result["metadata"], "output": {
+        "format": fmt,
+        "content_type": content_type,
+        "bytes": len(data),
+        "patch": patch,
+        "encode_ms": encode_ms,
+    }, "timings": {**result["metadata"].get("timings", {}), "encode": encode_ms}}
+    cache_key = result.get("cache_key")
+    if cache_key is not None:
+        RESULT_CACHE.put(cache_key, data, metadata)
+        metadata = {**metadata, "cache": _get_cache_info(False)}
+
+    return {
+        "data": data,
+        "content_type": content_type,
+        "metadata": metadata
+    }
+
+
+def to_response(encoded: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON response of the handler with the encoded image in base64."""
+    return {
+        "status": "ok",
+        "image_base64": base64.b64encode(encoded["data"]).decode("utf-8"),
+        "metadata": encoded["metadata"]
+    }
+
+
+def encode_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Encode the inpainted image into the base64 response."""
+    return to_response(encode_image(result))
+
+
+def coalesce_request(request: Dict[str, Any]):
+    """
+    None if the prepared request has to run, in which case release_request must follow, or the Future of the
+    identical request in flight whose encoded result this one shares (see get_coalesced_result).
+    """
+    if IN_FLIGHT is None or request.get("key") is None:
+        return None
+    leader = IN_FLIGHT.claim(request["key"])
+    if leader is not None:
+        print(f"[INFO] Coalesced with the identical request in flight: {request['key']}")
+    request["leader"] = leader is None
+    return leader
+
+
+def release_request(request: Dict[str, Any], encoded=None, error=None):
+    """Hand the encoded result or the error of a request that ran to the requests coalesced with it."""
+    if request.get("leader"):
+        IN_FLIGHT.release(request["key"], encoded, error)
+
+
+def get_coalesced_result(encoded: Dict[str, Any]) -> Dict[str, Any]:
+    return {**encoded, "metadata": {**encoded["metadata"], "coalesced": True}}
+
+
+def run_request(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """Whole pipeline of one request up to the encoded image bytes, without base64; raises on errors."""
+    request = prepare_request(inp)
+    if "encoded" in request:
+        return request["encoded"]
+    leader = coalesce_request(request)
+    if leader is not None:
+        return get_coalesced_result(leader.result())
+    try:
+        encoded = encode_image(inpaint_request(request))
+    except BaseException as e:
+        release_request(request, error=e)
+        raise
+    release_request(request, encoded)
+    return encoded
+
+
+def handler(event: Dict[str, Any]) -> Dict[str, Any]:
+    inp = event.get("input", {})
+
+    try:
+        return to_response(run_request(inp))
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+async def async_handler(event: Dict[str, Any]) -> Dict[str, Any]:
+    # run in threads so that RunPod can hand over concurrent jobs for SCHEDULER to batch,
+    # encoding on ENCODE_POOL frees the thread for the next inference meanwhile
+    inp = event.get("input", {})
+
+    try:
+        request = await asyncio.to_thread(prepare_request, inp)
+        if "encoded" in request:
+            return to_response(request["encoded"])
+        leader = coalesce_request(request)
+        if leader is not None:
+            return to_response(get_coalesced_result(await asyncio.wrap_future(leader)))
+        try:
+            result = await asyncio.to_thread(inpaint_request, request)
+            encoded = await asyncio.get_running_loop().run_in_executor(ENCODE_POOL, encode_image, result)
+        except BaseException as e:
+            release_request(request, error=e)
+            raise
+        release_request(request, encoded)
+        return to_response(encoded)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
 if os.environ.get("RUNPOD_SERVERLESS") or os.environ.get("RUNPOD_POD_ID"):
-    runpod.serverless.start({"handler": handler})
+    if SCHEDULER is not None:
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": lambda current: BATCH_SIZE})
+    else:
+        runpod.serverless.start({"handler": handler})
 else:
     print("[rp_handler_cpu] Loaded handler in local mode; not starting RunPod worker")
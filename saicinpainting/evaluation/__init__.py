@@ -2,11 +2,12 @@ import logging
 
 import torch
 
-from saicinpainting.evaluation.evaluator import InpaintingEvaluatorOnline, ssim_fid100_f1, lpips_fid100_f1
-from saicinpainting.evaluation.losses.base_loss import SSIMScore, LPIPSScore, FIDScore
-
 
 def make_evaluator(kind='default', ssim=True, lpips=True, fid=True, integral_kind=None, **kwargs):
+    # imported here so that saicinpainting.evaluation.data and .utils stay cheap to import for inference
+    from saicinpainting.evaluation.evaluator import InpaintingEvaluatorOnline, ssim_fid100_f1, lpips_fid100_f1
+    from saicinpainting.evaluation.losses.base_loss import SSIMScore, LPIPSScore, FIDScore
+
     logging.info(f'Make evaluator {kind}')
     device = "cuda" if torch.cuda.is_available() else "cpu"
     metrics = {}
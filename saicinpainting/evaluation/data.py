@@ -37,7 +37,15 @@ def pad_tensor_to_modulo(img, mod):
     batch_size, channels, height, width = img.shape
     out_height = ceil_modulo(height, mod)
     out_width = ceil_modulo(width, mod)
-    return F.pad(img, pad=(0, out_width - width, 0, out_height - height), mode='reflect')
+    return pad_tensor_to_size(img, out_height, out_width)
+
+
+def pad_tensor_to_size(img, out_height, out_width):
+    """Pads (B, C, H, W) img at the bottom and right, reflecting unless the pad exceeds the image, as for buckets"""
+    batch_size, channels, height, width = img.shape
+    pad = (0, out_width - width, 0, out_height - height)
+    mode = 'reflect' if out_width - width < width and out_height - height < height else 'replicate'
+    return F.pad(img, pad=pad, mode=mode)
 
 
 def scale_image(img, factor, interpolation=cv2.INTER_AREA):
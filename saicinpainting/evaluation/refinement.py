@@ -87,7 +87,7 @@ def _infer(
     image : torch.Tensor, mask : torch.Tensor, 
     forward_front : nn.Module, forward_rears : nn.Module, 
     ref_lower_res : torch.Tensor, orig_shape : tuple, devices : list, 
-    scale_ind : int, n_iters : int=15, lr : float=0.002):
+    scale_ind : int, n_iters : int=15, lr : float=0.002, progress=None, n_scales : int=None):
     """Performs inference with refinement at a given scale.
 
     Parameters
@@ -112,6 +112,11 @@ def _infer(
         number of iterations of refinement, by default 15
     lr : float, optional
         learning rate, by default 0.002
+    progress : callable, optional
+        called with a dict of scale, scales, iteration, iterations and loss after every iteration
+        instead of showing a tqdm progress bar, by default None
+    n_scales : int, optional
+        number of scales of the pyramid, only reported to progress, by default None
 
     Returns
     -------
@@ -136,7 +141,7 @@ def _infer(
 
     optimizer = Adam([z1,z2], lr=lr)
 
-    pbar = tqdm(range(n_iters), leave=False)
+    pbar = tqdm(range(n_iters), leave=False) if progress is None else range(n_iters)
     for idi in pbar:
         optimizer.zero_grad()
         input_feat = (z1,z2)
@@ -150,6 +155,8 @@ def _infer(
                 pred = output_feat
 
         if ref_lower_res is None:
+            if progress is not None:
+                progress(dict(scale=scale_ind+1, scales=n_scales, iteration=1, iterations=1, loss=None))
             break
         losses = {}
         ######################### multi-scale #############################
@@ -161,7 +168,10 @@ def _infer(
         losses["ms_l1"] = _l1_loss(pred, pred_downscaled, ref_lower_res, mask, mask_downscaled, image, on_pred=True)
 
         loss = sum(losses.values())
-        pbar.set_description("Refining scale {} using scale {} ...current loss: {:.4f}".format(scale_ind+1, scale_ind, loss.item()))
+        if progress is None:
+            pbar.set_description("Refining scale {} using scale {} ...current loss: {:.4f}".format(scale_ind+1, scale_ind, loss.item()))
+        else:
+            progress(dict(scale=scale_ind+1, scales=n_scales, iteration=idi+1, iterations=n_iters, loss=loss.item()))
         if idi < n_iters - 1:
             loss.backward()
             optimizer.step()
@@ -228,7 +238,7 @@ def _get_image_mask_pyramid(batch : dict, min_side : int, max_scales : int, px_b
 def refine_predict(
     batch : dict, inpainter : nn.Module, gpu_ids : str, 
     modulo : int, n_iters : int, lr : float, min_side : int, 
-    max_scales : int, px_budget : int
+    max_scales : int, px_budget : int, progress=None
     ):
     """Refines the inpainting of the network
 
@@ -252,6 +262,8 @@ def refine_predict(
         max number of downscaling scales for the image-mask pyramid
     px_budget : int
         pixels budget. Any image will be resized to satisfy height*width <= px_budget
+    progress : callable, optional
+        receives the refinement progress of every scale and iteration (see _infer) instead of tqdm
 
     Returns
     -------
@@ -260,10 +272,13 @@ def refine_predict(
     """
 
     assert not inpainter.training
-    assert not inpainter.add_noise_kwargs
+    assert not getattr(inpainter, 'add_noise_kwargs', None)
     assert inpainter.concat_mask
 
-    gpu_ids = [f'cuda:{gpuid}' for gpuid in gpu_ids.replace(" ","").split(",") if gpuid.isdigit()]
+    gpu_ids = [f'cuda:{gpuid}' for gpuid in str(gpu_ids).replace(" ","").split(",") if gpuid.isdigit()]
+    if not gpu_ids:
+        # no GPU ids given, refine on the CPU
+        gpu_ids = ['cpu']
     n_resnet_blocks = 0
     first_resblock_ind = 0
     found_first_resblock = False
@@ -305,7 +320,8 @@ def refine_predict(
         image, mask = move_to_device(image, devices[0]), move_to_device(mask, devices[0])
         if image_inpainted is not None:
             image_inpainted = move_to_device(image_inpainted, devices[-1])
-        image_inpainted = _infer(image, mask, forward_front, forward_rears, image_inpainted, orig_shape, devices, ids, n_iters, lr)
+        image_inpainted = _infer(image, mask, forward_front, forward_rears, image_inpainted, orig_shape, devices, ids, n_iters, lr,
+                                 progress, len(ls_images))
         image_inpainted = image_inpainted[:,:,:orig_shape[0], :orig_shape[1]]
         # detach everything to save resources
         image = image.detach().cpu()
@@ -0,0 +1,180 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ScheduledRequest:
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.wait_time = None
+        self.batch_size = None
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """Drops the request if its batch has not started, returns whether it did"""
+        return self.future.cancel()
+
+
+class MicroBatchScheduler:
+    """Collects concurrent requests and runs the ones sharing a key as a single batch
+
+    A batch is flushed once max_batch_size requests with the same key are queued or the oldest of them
+    has waited max_wait seconds. Batches run one at a time in a background thread through
+    run_batch(key, payloads) -> results, which must return one result per payload in the same order.
+    Cancelled requests are left out of their batch; if the thread dies, every outstanding request fails.
+    """
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.02):
+        assert max_batch_size >= 1, max_batch_size
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._pending = {}  # key -> list of ScheduledRequest in arrival order
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._batches = 0
+        self._requests = 0
+        self._batch_sizes = collections.Counter()
+        self._flush_reasons = collections.Counter()
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._last_batch = None
+
+        self._thread = threading.Thread(target=self._loop, name='micro-batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, key, payload):
+        request = ScheduledRequest(key, payload)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Scheduler is closed')
+            self._pending.setdefault(key, []).append(request)
+            self._cond.notify()
+        return request
+
+    def run(self, key, payload, timeout=None):
+        return self.submit(key, payload).result(timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(requests) for requests in self._pending.values())
+
+    def stats(self):
+        with self._cond:
+            return dict(queue_depth=sum(len(requests) for requests in self._pending.values()),
+                        max_batch_size=self.max_batch_size,
+                        max_wait_ms=self.max_wait * 1000,
+                        batches=self._batches,
+                        requests=self._requests,
+                        mean_batch_size=self._requests / self._batches if self._batches else 0.0,
+                        batch_sizes={str(size): count for size, count in sorted(self._batch_sizes.items())},
+                        flush_reasons=dict(self._flush_reasons),
+                        mean_wait_ms=self._total_wait * 1000 / self._requests if self._requests else 0.0,
+                        max_wait_seen_ms=self._max_wait_seen * 1000,
+                        last_batch=self._last_batch)
+
+    def _next_batch(self):
+        """Blocks until some batch is due, returns (key, requests, reason) or None when closed and drained"""
+        with self._cond:
+            while True:
+                for key in list(self._pending):
+                    live = [request for request in self._pending[key] if not request.future.cancelled()]
+                    if live:
+                        self._pending[key] = live
+                    else:
+                        del self._pending[key]
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+
+                key = next((k for k, requests in self._pending.items() if len(requests) >= self.max_batch_size), None)
+                if key is not None:
+                    reason = 'full'
+                else:
+                    # serve the key whose oldest request came first, so no bucket starves
+                    key = min(self._pending, key=lambda k: self._pending[k][0].enqueued_at)
+                    remaining = self._pending[key][0].enqueued_at + self.max_wait - time.monotonic()
+                    if remaining > 0 and not self._closed:
+                        self._cond.wait(remaining)
+                        continue
+                    reason = 'closed' if self._closed else 'deadline'
+
+                requests = self._pending[key]
+                batch = requests[:self.max_batch_size]
+                if len(requests) > len(batch):
+                    self._pending[key] = requests[len(batch):]
+                else:
+                    del self._pending[key]
+                return key, batch, reason
+
+    def _loop(self):
+        batch = []
+        try:
+            while True:
+                next_batch = self._next_batch()
+                if next_batch is None:
+                    return
+                key, batch, reason = next_batch
+                batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+
+                started_at = time.monotonic()
+                for request in batch:
+                    request.wait_time = started_at - request.enqueued_at
+                    request.batch_size = len(batch)
+                self._update_stats(key, batch, reason)
+
+                try:
+                    results = self.run_batch(key, [request.payload for request in batch])
+                    assert len(results) == len(batch), (len(results), len(batch))
+                except Exception as ex:
+                    LOGGER.warning(f'Batch {key} of {len(batch)} failed: {ex}')
+                    for request in batch:
+                        request.future.set_exception(ex)
+                    batch = []
+                    continue
+
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+                batch = []
+        except BaseException as ex:
+            # e.g. SystemExit or KeyboardInterrupt in run_batch: nothing would ever resolve these futures
+            LOGGER.error(f'Micro-batch scheduler stopped: {ex!r}', exc_info=True)
+            with self._cond:
+                self._closed = True
+                outstanding = batch + [request for requests in self._pending.values() for request in requests]
+                self._pending.clear()
+            error = RuntimeError(f'Micro-batch scheduler stopped: {ex!r}')
+            for request in outstanding:
+                if not request.future.done():
+                    request.future.set_exception(error)
+
+    def _update_stats(self, key, batch, reason):
+        with self._cond:
+            self._batches += 1
+            self._requests += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._flush_reasons[reason] += 1
+            for request in batch:
+                self._total_wait += request.wait_time
+                self._max_wait_seen = max(self._max_wait_seen, request.wait_time)
+            self._last_batch = dict(key=list(key) if isinstance(key, tuple) else key, size=len(batch), reason=reason)
@@ -0,0 +1,200 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts):
+    """Hex digest over byte strings and JSON-serializable parameters, in order"""
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if not isinstance(part, (bytes, bytearray, memoryview)):
+            part = json.dumps(part, sort_keys=True).encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'little'))  # so that parts can not run into each other
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class _DiskTier:
+    """Files <dir>/<key[:2]>/<key>.bin + .json evicted oldest-accessed first once over max_bytes
+
+    Only the index is guarded by the lock, files are read, written and removed outside of it.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> size, least recently used first
+        self.bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _paths(self, key):
+        subdir = os.path.join(self.path, key[:2])
+        return os.path.join(subdir, f'{key}.bin'), os.path.join(subdir, f'{key}.json')
+
+    def _scan(self):
+        found = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.bin'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name[:-len('.bin')], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.bytes += size
+        self._remove_files(self._evict())
+        if self.entries:
+            LOGGER.info(f'Disk cache {self.path}: {len(self.entries)} entries, {self.bytes} bytes')
+
+    def get(self, key):
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(data_path, 'rb') as f:
+                data = f.read()
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            os.utime(data_path)  # keeps the access order across restarts
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(key)
+            return None
+        except (OSError, ValueError) as ex:
+            LOGGER.warning(f'Dropping unreadable disk cache entry {key}: {ex}')
+            with self._lock:
+                self._forget(key)
+            self._remove_files([key])
+            return None
+        with self._lock:
+            # may have been written by another process sharing the directory
+            self._add(key, len(data))
+            evicted = self._evict()
+        self._remove_files(evicted)
+        return data, meta
+
+    def put(self, key, data, meta):
+        if len(data) > self.max_bytes:
+            return
+        data_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'  # concurrent writers of a key do not share files
+        try:
+            # metadata first, an entry counts as present once its .bin exists
+            for path, content, mode in ((meta_path, json.dumps(meta), 'w'), (data_path, data, 'wb')):
+                with open(path + suffix, mode) as f:
+                    f.write(content)
+                os.replace(path + suffix, path)
+        except OSError as ex:
+            LOGGER.warning(f'Could not write disk cache entry {key}: {ex}')
+            return
+        with self._lock:
+            self._add(key, len(data))
+            evicted = self._evict()
+        self._remove_files(evicted)
+
+    def _add(self, key, size):
+        self.bytes += size - self.entries.get(key, 0)
+        self.entries[key] = size
+        self.entries.move_to_end(key)
+
+    def _forget(self, key):
+        self.bytes -= self.entries.pop(key, 0)
+
+    def _evict(self):
+        """Drops the least recently used entries over max_bytes from the index, returns their keys"""
+        evicted = []
+        while self.bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self._forget(key)
+            evicted.append(key)
+        return evicted
+
+    def _remove_files(self, keys):
+        for key in keys:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return len(self.entries), self.bytes
+
+
+class ResultCache:
+    """Content-addressed cache of encoded results: an in-process LRU bounded by bytes and an optional disk tier
+
+    Values are (data, meta) pairs, where data is bytes counted against the size limits and meta is a small
+    JSON-serializable dict. Memory hits are served first; disk hits are promoted into memory.
+    """
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> (data, meta), least recently used first
+        self._bytes = 0
+        self._disk = _DiskTier(disk_dir, disk_max_bytes) if disk_dir else None
+        self._lock = threading.Lock()
+        self._hits = collections.Counter()
+        self._misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self._disk is not None
+
+    def get(self, key):
+        """Returns (data, meta, tier) with tier 'memory' or 'disk', or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits['memory'] += 1
+                return entry[0], entry[1], 'memory'
+        # disk reads do not hold up memory hits of other threads
+        entry = self._disk.get(key) if self._disk is not None else None
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits['disk'] += 1
+            self._put_memory(key, *entry)
+        return entry[0], entry[1], 'disk'
+
+    def put(self, key, data, meta):
+        with self._lock:
+            self._put_memory(key, data, meta)
+        if self._disk is not None:
+            self._disk.put(key, data, meta)
+
+    def _put_memory(self, key, data, meta):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[0])
+        self._entries[key] = (data, meta)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, (old_data, _) = self._entries.popitem(last=False)
+            self._bytes -= len(old_data)
+
+    def stats(self):
+        disk_entries, disk_bytes = self._disk.stats() if self._disk is not None else (0, 0)
+        with self._lock:
+            hits = sum(self._hits.values())
+            return dict(hits=hits,
+                        memory_hits=self._hits['memory'],
+                        disk_hits=self._hits['disk'],
+                        misses=self._misses,
+                        hit_rate=hits / (hits + self._misses) if hits + self._misses else 0.0,
+                        memory_entries=len(self._entries),
+                        memory_bytes=self._bytes,
+                        memory_max_bytes=self.max_bytes,
+                        disk_entries=disk_entries,
+                        disk_bytes=disk_bytes,
+                        disk_max_bytes=self._disk.max_bytes if self._disk is not None else 0)
@@ -0,0 +1,69 @@
+import logging
+import os
+
+import torch
+import yaml
+from omegaconf import OmegaConf
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_serving_paths(model_dir, checkpoint):
+    """Paths of the generator-only weights and the flattened config converted from model_dir/models/checkpoint"""
+    stem = os.path.splitext(checkpoint)[0]
+    return (os.path.join(model_dir, 'models', f'{stem}.generator.pt'),
+            os.path.join(model_dir, 'models', f'{stem}.serving.yaml'))
+
+
+def get_generator_state_dict(state):
+    """Generator weights from either a training checkpoint or a raw LaMa {'gen_state_dict': ...} one"""
+    if 'gen_state_dict' in state:
+        gen = state['gen_state_dict']
+        if hasattr(gen, 'state_dict'):
+            gen = gen.state_dict()
+        return dict(gen)
+    prefix = 'generator.'
+    return {k[len(prefix):]: v for k, v in state['state_dict'].items() if k.startswith(prefix)}
+
+
+def _atomic_write(path, write_fn):
+    tmp_path = path + '.tmp'
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def convert_checkpoint(train_config, checkpoint_path, weights_path, config_path):
+    """One-time conversion of a checkpoint into a memory-mappable generator-only file and a flattened config
+
+    Weights are stored with torch.save as contiguous tensors, so that load_generator_weights can map them
+    instead of unpickling copies. The config keeps only what inference needs, with interpolations resolved.
+    """
+    state = torch.load(checkpoint_path, map_location='cpu')
+    gen_state = {k: v.contiguous() for k, v in get_generator_state_dict(state).items()}
+    del state
+    _atomic_write(weights_path, lambda path: torch.save(gen_state, path))
+
+    serving_config = dict(
+        training_model=OmegaConf.to_container(train_config.training_model, resolve=True),
+        generator=OmegaConf.to_container(train_config.generator, resolve=True),
+        source_checkpoint=os.path.basename(checkpoint_path),
+    )
+
+    def write_config(path):
+        with open(path, 'w') as f:
+            yaml.safe_dump(serving_config, f, sort_keys=False)
+
+    _atomic_write(config_path, write_config)
+    LOGGER.info(f'Converted {checkpoint_path} into {weights_path} ({len(gen_state)} tensors) and {config_path}')
+
+
+def load_serving_config(config_path):
+    with open(config_path, 'r') as f:
+        return OmegaConf.create(yaml.safe_load(f))
+
+
+def load_generator_weights(generator, weights_path):
+    """Maps weights_path into memory and makes the generator parameters point to it without copying"""
+    state = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    generator.load_state_dict(state, strict=True, assign=True)
+    return generator
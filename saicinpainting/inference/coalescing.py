@@ -0,0 +1,42 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalescing of identical concurrent requests: the first one of a key computes, the ones arriving while it is
+    in flight wait for its result instead of computing it again. Unlike a result cache nothing is kept once the
+    leader is done, so it also covers cold bursts and requests that bypass the cache.
+    """
+    def __init__(self):
+        self._calls = {}  # key -> Future of the leader
+        self._lock = threading.Lock()
+        self._counts = dict(leaders=0, coalesced=0)
+
+    def claim(self, key):
+        """None if the caller is the leader of key and has to call release, else the Future of the leader"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._counts['coalesced'] += 1
+                return future
+            self._calls[key] = Future()
+            self._counts['leaders'] += 1
+            return None
+
+    def release(self, key, result=None, error=None):
+        """Hands the result (or the error) of the leader of key to its followers"""
+        with self._lock:
+            future = self._calls.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    @property
+    def coalesced(self):
+        return self._counts['coalesced']
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, in_flight=len(self._calls))
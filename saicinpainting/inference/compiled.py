@@ -0,0 +1,143 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import torch
+
+from saicinpainting.evaluation.data import pad_tensor_to_size
+
+LOGGER = logging.getLogger(__name__)
+
+ARTIFACTS_NAME = 'compile_artifacts.bin'
+
+
+def parse_shapes(value):
+    """'512x512,768x1024' -> [(512, 512), (768, 1024)] as (height, width)"""
+    return [tuple(int(side) for side in shape.split('x')) for shape in value.split(',') if shape]
+
+
+def _has_cache_artifacts():
+    """torch.compiler.save/load_cache_artifacts exist from torch 2.7, older versions only have the inductor cache"""
+    return hasattr(torch.compiler, 'save_cache_artifacts') and hasattr(torch.compiler, 'load_cache_artifacts')
+
+
+def load_compile_cache(cache_dir):
+    """Points the inductor cache at cache_dir and preloads the artifacts saved by save_compile_cache
+
+    Must run before the first compilation. Returns True if saved artifacts were found. Before torch 2.7 only the
+    inductor cache in cache_dir is used, which still skips codegen but not the tracing.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    path = os.path.join(cache_dir, ARTIFACTS_NAME)
+    if not _has_cache_artifacts() or not os.path.exists(path):
+        return False
+    with open(path, 'rb') as f:
+        torch.compiler.load_cache_artifacts(f.read())
+    LOGGER.info(f'Loaded compile artifacts from {path}')
+    return True
+
+
+def save_compile_cache(cache_dir):
+    """Saves the artifacts of everything compiled so far, so that the next start skips codegen and autotuning"""
+    if not _has_cache_artifacts():
+        return
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return
+    data, _ = artifacts
+    path = os.path.join(cache_dir, ARTIFACTS_NAME)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    LOGGER.info(f'Saved {len(data)} bytes of compile artifacts to {path}')
+
+
+class CompiledInpaintingModel:
+    """Runs a model with forward(batch) semantics through torch.compile for a fixed set of shape buckets
+
+    Each batch is padded up to the smallest warmed-up (height, width) bucket that fits it and the outputs are
+    cropped back, so a handful of static-shape graphs serve every page size. Inputs larger than every bucket, or
+    with a batch size that was not warmed up, run the eager model instead: nothing is compiled while serving.
+    batch['compiled_bucket'] is set to the bucket used, or None for the eager fallback.
+    """
+    def __init__(self, model, shapes, batch_sizes=(1,), mode=None):
+        self.model = model
+        self.shapes = sorted(set(shapes), key=lambda shape: (shape[0] * shape[1], shape))
+        self.batch_sizes = sorted(set(batch_sizes))
+        self.compiled = torch.compile(model, dynamic=False, mode=mode)
+        self.warm = set()  # (batch size, height, width) that have a graph
+
+        # dynamo keeps at most cache_size_limit graphs per function before falling back to eager itself
+        limit = len(self.shapes) * len(self.batch_sizes) + 1
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, limit)
+
+        self._lock = threading.Lock()
+        self._calls = collections.Counter()
+
+    @property
+    def generator(self):
+        return self.model.generator
+
+    def get_bucket(self, batch_size, height, width):
+        """(height, width) of the compiled bucket an input runs in, None if it falls back to eager"""
+        for bucket_height, bucket_width in self.shapes:
+            if height <= bucket_height and width <= bucket_width \
+                    and (batch_size, bucket_height, bucket_width) in self.warm:
+                return bucket_height, bucket_width
+        return None
+
+    @torch.no_grad()
+    def warm_up(self, device='cpu'):
+        """Compiles every bucket for every batch size, returns {'<batch>x<height>x<width>': seconds}"""
+        timings = {}
+        for batch_size in self.batch_sizes:
+            for height, width in self.shapes:
+                image = torch.rand(batch_size, 3, height, width, device=device)
+                mask = (torch.rand(batch_size, 1, height, width, device=device) > 0.5).float()
+                started_at = time.perf_counter()
+                self.compiled(dict(image=image, mask=mask))
+                timings[f'{batch_size}x{height}x{width}'] = round(time.perf_counter() - started_at, 3)
+                self.warm.add((batch_size, height, width))
+                LOGGER.info(f'Compiled bucket {height}x{width}, batch {batch_size}')
+        return timings
+
+    def __call__(self, batch):
+        image = batch['image']
+        batch_size, _, height, width = image.shape
+        bucket = self.get_bucket(batch_size, height, width)
+        with self._lock:
+            self._calls['{}x{}'.format(*bucket) if bucket is not None else 'eager'] += 1
+
+        if bucket is None:
+            batch = self.model(batch)
+        else:
+            # graphs are specialized on strides as well, warm-up inputs are contiguous float32
+            mask = batch['mask'].to(image.dtype)
+            output = self.compiled(dict(image=pad_tensor_to_size(image, *bucket).contiguous(),
+                                        mask=pad_tensor_to_size(mask, *bucket).contiguous()))
+            for key in ('predicted_image', 'inpainted'):
+                batch[key] = output[key][:, :, :height, :width]
+        batch['compiled_bucket'] = bucket
+        return batch
+
+    def freeze(self):
+        self.model.freeze()
+        return self
+
+    def to(self, device):
+        self.model.to(device)
+        return self
+
+    def stats(self):
+        with self._lock:
+            calls = dict(self._calls)
+        eager = calls.pop('eager', 0)
+        return dict(buckets=['{}x{}'.format(*shape) for shape in self.shapes],
+                    batch_sizes=self.batch_sizes,
+                    warm=len(self.warm),
+                    compiled_calls=sum(calls.values()),
+                    eager_calls=eager,
+                    calls_by_bucket=calls)
@@ -0,0 +1,71 @@
+import math
+
+import cv2
+import numpy as np
+
+from saicinpainting.inference.roi import crop_roi, get_roi_bboxes
+
+
+def get_composite_sizes(scale, dilation=0, feather=0):
+    """(dilation, feather) in full-resolution pixels, 0 picks one and two model pixels at this downscale"""
+    return dilation or int(math.ceil(1 / scale)), feather or int(math.ceil(2 / scale))
+
+
+def get_composite_mask(full_mask, model_mask):
+    """HxW uint8 full-resolution region the model inpainted: the original full_mask joined with the processed
+    hxw model_mask it ran on, which the blur grows, binarized as the model does and upscaled"""
+    height, width = full_mask.shape[:2]
+    inpainted = (model_mask > 0).astype(np.uint8) * np.uint8(255)
+    return np.maximum(full_mask, cv2.resize(inpainted, (width, height), interpolation=cv2.INTER_NEAREST))
+
+
+def _upsample_crop(pred, bbox, full_size):
+    """Bilinear upsample of just the bbox of the full_size (width, height) page out of the low-res pred,
+    sampling the same points as cv2.resize of the whole prediction would"""
+    x0, y0, x1, y1 = bbox
+    scale_x, scale_y = pred.shape[1] / full_size[0], pred.shape[0] / full_size[1]
+    map_x = ((np.arange(x0, x1, dtype=np.float32) + 0.5) * scale_x - 0.5)[None, :].repeat(y1 - y0, 0)
+    map_y = ((np.arange(y0, y1, dtype=np.float32) + 0.5) * scale_y - 0.5)[:, None].repeat(x1 - x0, 1)
+    return cv2.remap(pred, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def _get_alpha(mask, dilation, feather):
+    """Blend weight of the prediction: 1 on the dilated mask, fading to 0 over feather pixels around it"""
+    hard = mask > 0
+    if dilation > 0:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * dilation + 1, 2 * dilation + 1))
+        hard = cv2.dilate(hard.astype(np.uint8), kernel) > 0
+    alpha = hard.astype(np.float32)
+    if feather > 0:
+        # the fade is outside the dilated mask, so it never lets original pixels through inside of it
+        alpha = cv2.GaussianBlur(alpha, (0, 0), sigmaX=feather / 2.0, borderType=cv2.BORDER_REFLECT)
+        alpha = np.maximum(alpha * 2.0, hard)
+        np.clip(alpha, 0, 1, out=alpha)
+    return alpha
+
+
+def composite_full_res(image, mask, pred, dilation, feather, merge_distance=32):
+    """
+    Pastes a low-resolution prediction back into the full-resolution page it was computed from.
+
+    image and mask are the original HxWx3 and HxW uint8 page and mask, pred the hxwx3 uint8 model output for the
+    downscaled page. Only crops around the mask components are upsampled and blended with a weight that is 1 on
+    the mask dilated by dilation pixels and fades out over feather pixels, so the cost follows the mask area and
+    everything else keeps the original pixels.
+
+    Returns the composited page, a HxW uint8 mask of the pixels that changed and the number of crops.
+    """
+    height, width = mask.shape[:2]
+    result = image.copy()
+    changed = np.zeros((height, width), np.uint8)
+    # the Gaussian fade reaches ~1.5 feather beyond the dilated mask, crops have to contain all of it
+    bboxes = get_roi_bboxes(mask, dilation + 2 * feather + 1, merge_distance, modulo=1)
+    for bbox in bboxes:
+        x0, y0, x1, y1 = bbox
+        alpha = _get_alpha(crop_roi(mask, bbox), dilation, feather)[..., None]
+        upsampled = _upsample_crop(pred, bbox, (width, height)).astype(np.float32)
+        original = crop_roi(image, bbox).astype(np.float32)
+        blended = original + alpha * (upsampled - original)
+        result[y0:y1, x0:x1] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+        changed[y0:y1, x0:x1] = (alpha[..., 0] > 0) * np.uint8(255)
+    return result, changed, len(bboxes)
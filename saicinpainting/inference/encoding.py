@@ -0,0 +1,92 @@
+import cv2
+
+from saicinpainting.inference.roi import crop_roi, get_mask_bbox
+
+ENCODERS = {}  # name -> (encode_fn(bgr_image, **options) -> bytes, content type)
+
+
+def register_encoder(name, content_type):
+    def decorator(encode_fn):
+        ENCODERS[name] = (encode_fn, content_type)
+        return encode_fn
+    return decorator
+
+
+def _imencode(ext, image, params):
+    ok, buf = cv2.imencode(ext, image, params)
+    if not ok:
+        raise RuntimeError(f'Could not encode {image.shape} image to {ext}')
+    return buf.tobytes()
+
+
+@register_encoder('png', 'image/png')
+def encode_png(image, png_compression=1, **kwargs):
+    return _imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)])
+
+
+@register_encoder('webp', 'image/webp')
+def encode_webp(image, **kwargs):
+    # quality above 100 selects lossless WebP
+    return _imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, 101])
+
+
+@register_encoder('jpeg', 'image/jpeg')
+def encode_jpeg(image, jpeg_quality=95, **kwargs):
+    return _imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+
+
+def encode(image, fmt='png', **options):
+    """Encodes an RGB uint8 image in memory, returns (bytes, content type)
+
+    options are passed to the encoder, e.g. png_compression (0..9) for png or jpeg_quality (1..100) for jpeg
+    """
+    if fmt not in ENCODERS:
+        raise ValueError(f'Unknown output format {fmt}, expected one of {", ".join(ENCODERS)}')
+    encode_fn, content_type = ENCODERS[fmt]
+    return encode_fn(cv2.cvtColor(image, cv2.COLOR_RGB2BGR), **options), content_type
+
+
+def _get_int_option(inp, name, default, low, high):
+    value = inp.get(name, default)
+    try:
+        if isinstance(value, bool) or int(value) != float(value):
+            raise ValueError
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an integer from {low} to {high}, got {value!r}')
+    if not low <= value <= high:
+        raise ValueError(f'{name} must be an integer from {low} to {high}, got {value}')
+    return value
+
+
+def get_output_options(inp, default_format='png', png_compression=1, jpeg_quality=95):
+    """Output options of a request: "output_format", "png_compression", "jpeg_quality" and "output" (full or patch)
+
+    Returns dict(format=..., patch=...) with the options of the format's encoder, the other parameters being the
+    defaults of the server. Unknown formats and out of range values raise ValueError.
+    """
+    fmt = str(inp.get('output_format', default_format)).lower()
+    fmt = 'jpeg' if fmt == 'jpg' else fmt
+    if fmt not in ENCODERS:
+        raise ValueError(f'Unknown output_format {fmt}, expected one of {", ".join(ENCODERS)}')
+    output = inp.get('output', 'full')
+    if output not in ('full', 'patch'):
+        raise ValueError(f'Unknown output {output}, expected full or patch')
+    options = {'format': fmt, 'patch': output == 'patch'}
+    if fmt == 'png':
+        options['png_compression'] = _get_int_option(inp, 'png_compression', png_compression, 0, 9)
+    elif fmt == 'jpeg':
+        options['jpeg_quality'] = _get_int_option(inp, 'jpeg_quality', jpeg_quality, 1, 100)
+    return options
+
+
+def crop_patch(image, mask):
+    """Crops the rectangle around the nonzero mask pixels, the only ones inpainting changes
+
+    Returns the patch and its rectangle as (x, y, width, height), the whole image if the mask is empty.
+    """
+    bbox = get_mask_bbox(mask)
+    if bbox is None:
+        bbox = (0, 0, image.shape[1], image.shape[0])
+    x0, y0, x1, y1 = bbox
+    return crop_roi(image, bbox), (x0, y0, x1 - x0, y1 - y0)
@@ -0,0 +1,80 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import ImageFile
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_url(data):
+    return isinstance(data, str) and (data.startswith('http://') or data.startswith('https://'))
+
+
+class UrlFetcher:
+    """Downloads inputs over a shared keep-alive session, several at a time
+
+    Bodies are streamed in chunk_size pieces and the download is aborted once it exceeds max_bytes. With
+    progressive=True chunks are fed to a PIL parser as they arrive, so the image is decoded while it downloads,
+    and fetch returns a PIL image instead of bytes.
+    """
+    def __init__(self, pool_size=8, timeout=60, max_bytes=64 * 1024 * 1024, retries=1, progressive=False,
+                 chunk_size=256 * 1024):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.progressive = progressive
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='fetch')
+
+    def fetch(self, url, progressive=None):
+        """Returns (bytes or PIL image, timings dict)"""
+        progressive = self.progressive if progressive is None else progressive
+        started_at = time.perf_counter()
+        with self.session.get(url, timeout=self.timeout, stream=True) as resp:
+            resp.raise_for_status()
+            length = int(resp.headers.get('Content-Length') or 0)
+            if length > self.max_bytes:
+                raise ValueError(f'{url} is {length} bytes, more than the {self.max_bytes} allowed')
+            headers_at = time.perf_counter()
+
+            parser = ImageFile.Parser() if progressive else None
+            chunks = []
+            size = 0
+            for chunk in resp.iter_content(self.chunk_size):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(f'{url} is more than the {self.max_bytes} bytes allowed')
+                if parser is not None:
+                    parser.feed(chunk)
+                else:
+                    chunks.append(chunk)
+        result = parser.close() if parser is not None else b''.join(chunks)
+
+        finished_at = time.perf_counter()
+        return result, dict(ttfb_ms=round((headers_at - started_at) * 1000, 2),
+                            total_ms=round((finished_at - started_at) * 1000, 2),
+                            bytes=size,
+                            progressive=progressive)
+
+    def fetch_all(self, sources):
+        """Fetches the URL values of a dict concurrently, other values are kept as is
+
+        Returns (dict with fetched values, {name: timings} of the fetched ones)
+        """
+        futures = {name: self.pool.submit(self.fetch, value) for name, value in sources.items() if is_url(value)}
+        resolved = dict(sources)
+        timings = {}
+        for name, future in futures.items():
+            resolved[name], timings[name] = future.result()
+        return resolved, timings
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,131 @@
+"""Request parsing of the local HTTP API, apart from local_api so that it can be used without loading a model"""
+
+import asyncio
+import json
+from email.parser import BytesParser
+from email.policy import HTTP
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+
+class HttpError(Exception):
+    def __init__(self, status, error, error_type=None):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+        self.error_type = error_type or error  # label of the errors counter, error may be a free-form message
+
+
+def parse_request_line(line):
+    """(method, target, version) of an HTTP request line, empty method and target if it is malformed"""
+    parts = line.split(' ')
+    if len(parts) != 3 or not parts[0] or not parts[1] or not parts[2].startswith('HTTP/'):
+        return '', '', 'HTTP/1.1'
+    return parts[0], parts[1], parts[2]
+
+
+async def _read_chunked(reader, max_bytes):
+    """Body sent with Transfer-Encoding: chunked, trailer fields are skipped"""
+    body = bytearray()
+    while True:
+        try:
+            size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0].strip(), 16)
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_chunk')
+        if size == 0:
+            break
+        if len(body) + size > max_bytes:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'body_too_large')
+        body += await reader.readexactly(size)
+        if await reader.readexactly(2) != b'\r\n':
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_chunk')
+    while await reader.readuntil(b'\r\n') != b'\r\n':
+        pass
+    return bytes(body)
+
+
+async def read_body(reader, writer, headers, max_bytes):
+    """Body of Content-Length or chunked Transfer-Encoding, answering Expect: 100-continue before reading it"""
+    chunked = False
+    if 'transfer-encoding' in headers:
+        if headers['transfer-encoding'].lower() != 'chunked':
+            raise HttpError(HTTPStatus.NOT_IMPLEMENTED, 'unsupported_transfer_encoding')
+        chunked = True
+    else:
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_content_length')
+        if length > max_bytes:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'body_too_large')
+        if not length:
+            return b''
+
+    expect = headers.get('expect', '').lower()
+    if expect:
+        if expect != '100-continue':
+            raise HttpError(HTTPStatus.EXPECTATION_FAILED, 'expectation_failed')
+        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        await writer.drain()
+    return await _read_chunked(reader, max_bytes) if chunked else await reader.readexactly(length)
+
+
+def parse_json_input(body, required=False):
+    """The "input" object of a JSON body {"input": {...}}, {} if the body or its input is missing and not required
+
+    Bodies that are not JSON objects and inputs that are not objects are answered with 400 invalid_json.
+    """
+    try:
+        payload = json.loads(body.decode('utf-8') if body else '{}')
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_json')
+    if not isinstance(payload, dict):
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_json')
+    inp = payload.get('input', None if required else {})
+    if not isinstance(inp, dict):
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_json')
+    return inp
+
+
+def _parse_field(value):
+    """Form and query fields are JSON scalars when they parse as such (5, 0.1, false), strings otherwise"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_binary_request(headers, query, body):
+    """
+    Input of POST /inpaint without base64: either multipart/form-data with "image" and "mask" file parts
+    and other parameters as fields, or a raw body of the image bytes immediately followed by the mask bytes,
+    split at the X-Image-Length header, with parameters in the query string.
+    """
+    inp = {name: _parse_field(value) for name, value in parse_qsl(query)}
+    content_type = headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body)
+        if not message.is_multipart():
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_multipart')
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            data = part.get_payload(decode=True) or b''
+            if name in ('image', 'mask'):
+                inp[name] = data
+            elif name:
+                inp[name] = _parse_field(data.decode('utf-8'))
+    else:
+        try:
+            image_length = int(headers['x-image-length'])
+        except (KeyError, ValueError):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'missing_image_length')
+        if not 0 < image_length < len(body):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'invalid_image_length')
+        body = memoryview(body)
+        inp['image'], inp['mask'] = body[:image_length], body[image_length:]
+
+    if not isinstance(inp.get('image'), (bytes, memoryview)) or not isinstance(inp.get('mask'), (bytes, memoryview)):
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'missing_image_or_mask')
+    return inp
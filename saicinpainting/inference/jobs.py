@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """State of one asynchronous request: queued -> running -> done or error"""
+    def __init__(self, job_id, payload=None, created_at=None):
+        self.id = job_id
+        self.payload = payload  # input of the request, dropped once it starts running
+        self.status = 'queued'
+        self.created_at = created_at or time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {'stage': 'queued'}
+        self.timings = {}
+        self.error = None
+        self.metadata = None
+        self.content_type = None
+        self.data = None  # encoded result, None until done or while it is only on disk
+        self.persisted = False
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'error')
+
+    def to_dict(self):
+        return dict(id=self.id, status=self.status, progress=self.progress, timings=self.timings,
+                    created_at=self.created_at, started_at=self.started_at, finished_at=self.finished_at,
+                    error=self.error, metadata=self.metadata)
+
+    @classmethod
+    def from_dict(cls, state):
+        job = cls(state['id'], created_at=state['created_at'])
+        for name in ('status', 'progress', 'timings', 'started_at', 'finished_at', 'error', 'metadata'):
+            setattr(job, name, state[name])
+        job.content_type = state.get('content_type')
+        job.persisted = True
+        return job
+
+
+class JobStore:
+    """Jobs of the async API: at most max_pending queued or running, finished ones kept for ttl seconds
+
+    With persist_dir, finished jobs are written to <dir>/<id>.json (+ <id>.bin with the encoded result) and
+    loaded back on start, so results survive a restart of the server. Queued and running jobs are not persisted.
+    clock returns the wall time of the job timestamps and expiry, time.time by default.
+    """
+    def __init__(self, max_pending, ttl, persist_dir=None, clock=time.time):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        self.clock = clock
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._counts = dict(submitted=0, done=0, error=0, evicted=0, rejected=0)
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+            self._load()
+
+    def _paths(self, job_id):
+        return os.path.join(self.persist_dir, f'{job_id}.json'), os.path.join(self.persist_dir, f'{job_id}.bin')
+
+    def _load(self):
+        now = self.clock()
+        for entry in os.scandir(self.persist_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    job = Job.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError) as ex:
+                LOGGER.warning(f'Dropping unreadable job {entry.name}: {ex}')
+                self._remove_files(entry.name[:-len('.json')])
+                continue
+            if job.finished_at + self.ttl < now:
+                self._remove_files(job.id)
+            else:
+                self._jobs[job.id] = job
+        if self._jobs:
+            LOGGER.info(f'Loaded {len(self._jobs)} finished job(s) from {self.persist_dir}')
+
+    def _remove_files(self, job_id):
+        for path in self._paths(job_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _write(self, job):
+        json_path, data_path = self._paths(job.id)
+        state = dict(job.to_dict(), content_type=job.content_type)
+        try:
+            # result first, a job counts as persisted once its .json exists
+            contents = ((data_path, job.data, 'wb'),) if job.data is not None else ()
+            for path, content, mode in contents + ((json_path, json.dumps(state), 'w'),):
+                with open(path + '.tmp', mode) as f:
+                    f.write(content)
+                os.replace(path + '.tmp', path)
+            job.persisted = True
+        except (OSError, TypeError, ValueError) as ex:
+            LOGGER.warning(f'Could not persist job {job.id}: {ex}')
+
+    def pending(self):
+        with self._lock:
+            return sum(not job.finished for job in self._jobs.values())
+
+    def create(self, payload):
+        """New queued job, raises JobQueueFull if max_pending jobs are already queued or running"""
+        with self._lock:
+            if sum(not job.finished for job in self._jobs.values()) >= self.max_pending:
+                self._counts['rejected'] += 1
+                raise JobQueueFull()
+            job = Job(uuid.uuid4().hex, payload, self.clock())
+            self._jobs[job.id] = job
+            self._counts['submitted'] += 1
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished and job.finished_at + self.ttl < self.clock():
+                self._evict(job)
+                return None
+            return job
+
+    def get_result(self, job):
+        """(data, content_type) of a done job, read from disk if it was loaded from the persist dir"""
+        data = job.data
+        if data is None and job.persisted:
+            with open(self._paths(job.id)[1], 'rb') as f:
+                data = f.read()
+        return data, job.content_type
+
+    def start(self, job):
+        with self._lock:
+            job.payload = None
+            job.status = 'running'
+            job.started_at = self.clock()
+
+    def set_progress(self, job, **progress):
+        """Merges progress into the job progress, may be called from any thread"""
+        with self._lock:
+            job.progress = {**job.progress, **progress}
+
+    def finish(self, job, encoded):
+        with self._lock:
+            job.status = 'done'
+            job.finished_at = self.clock()
+            job.progress = {**job.progress, 'stage': 'done'}
+            job.data, job.content_type, job.metadata = encoded['data'], encoded['content_type'], encoded['metadata']
+            job.timings = encoded['metadata'].get('timings', job.timings)
+            self._counts['done'] += 1
+        if self.persist_dir:
+            self._write(job)
+            if job.persisted:
+                job.data = None  # served from disk from now on
+
+    def fail(self, job, error):
+        with self._lock:
+            job.payload = None
+            job.status = 'error'
+            job.finished_at = self.clock()
+            job.error = error
+            self._counts['error'] += 1
+        if self.persist_dir:
+            self._write(job)
+
+    def _evict(self, job):
+        del self._jobs[job.id]
+        self._counts['evicted'] += 1
+        if job.persisted:
+            self._remove_files(job.id)
+
+    def evict_expired(self):
+        """Drops the finished jobs older than ttl, from memory and disk; returns how many"""
+        now = self.clock()
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished and job.finished_at + self.ttl < now]
+            for job in expired:
+                self._evict(job)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            return dict(self._counts,
+                        queued=statuses.count('queued'),
+                        running=statuses.count('running'),
+                        finished=statuses.count('done') + statuses.count('error'),
+                        max_pending=self.max_pending,
+                        ttl=self.ttl,
+                        persist_dir=self.persist_dir)
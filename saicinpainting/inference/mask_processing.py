@@ -0,0 +1,88 @@
+"""Mask edge blurring of the serving handler, done at model resolution with separable, cached kernels
+
+The handler softens the mask edges with a Gaussian and then a box filter; since the model binarizes the mask
+with > 0, this grows the mask by a few pixels so that the inpainting covers stroke anti-aliasing. Both filters
+are separable and run here on the mask after it is resized to the model input size, with blur_radius scaled by
+the resize factor so that the feather keeps its width relative to the page.
+"""
+
+import functools
+import math
+
+import cv2
+import numpy as np
+
+
+def get_filter_sizes(blur_radius, feather_amount, scale=1.0):
+    """(Gaussian sigma, box kernel size or 0) in pixels of a mask resized by scale"""
+    sigma = blur_radius / 3.0 * scale
+    box_size = 0
+    if feather_amount > 0:
+        box_size = max(1, int(round(max(3, int(blur_radius * feather_amount)) * scale)))
+    return sigma, box_size if box_size > 1 else 0
+
+
+@functools.lru_cache(maxsize=64)
+def get_gaussian_kernel(sigma):
+    """1D Gaussian truncated at 4 sigma like scipy.ndimage.gaussian_filter, float32"""
+    radius = int(4.0 * sigma + 0.5)
+    if sigma <= 0 or radius == 0:
+        return np.ones(1, np.float32)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def process_mask(mask, blur_radius=5, feather_amount=0.1, scale=1.0):
+    """Blurred HxW uint8 mask from an HxW uint8 0..255 mask, see the module docstring"""
+    sigma, box_size = get_filter_sizes(blur_radius, feather_amount, scale)
+    kernel = get_gaussian_kernel(sigma)
+    # one float32 copy at model resolution, both passes are separable and in place
+    processed = mask.astype(np.float32) * (1 / 255.0)
+    if len(kernel) > 1:
+        # BORDER_REFLECT is the 'reflect' mode of ndimage.gaussian_filter
+        cv2.sepFilter2D(processed, -1, kernel, kernel, dst=processed, borderType=cv2.BORDER_REFLECT)
+    if box_size:
+        cv2.blur(processed, (box_size, box_size), dst=processed)
+    return np.clip(processed * 255.0, 0, 255).astype(np.uint8)
+
+
+def _separable_filter(x, taps):
+    """Correlates the last two dims of x with the 1D taps, as sums of shifted views (no conv kernel launch per tap
+    on a single channel, which is slow on CPU)"""
+    import torch.nn.functional as F
+
+    size = len(taps)
+    if size == 1:
+        return x
+    height, width = x.shape[-2:]
+    # same anchor as OpenCV, the centre or the right one of the two middle taps
+    before, after = size // 2, (size - 1) // 2
+    # reflect padding can not be wider than the input, replicate takes over on tiny masks
+    mode = 'reflect' if min(height, width) > before else 'replicate'
+    x = F.pad(x, (before, after, before, after), mode=mode)
+    rows = x[..., :width] * taps[0]
+    for i in range(1, size):
+        rows.add_(x[..., i:i + width], alpha=taps[i])
+    result = rows[..., :height, :] * taps[0]
+    for i in range(1, size):
+        result.add_(rows[..., i:i + height, :], alpha=taps[i])
+    return result
+
+
+def process_mask_tensor(masks, blur_radius=5, feather_amount=0.1, scale=1.0):
+    """process_mask for a Bx1xHxW float tensor of masks in 0..1 on any device, returns the same in 0..1
+
+    The result is quantized like the uint8 masks of process_mask, so both binarize to the same pixels up to the
+    border handling (reflect101 here instead of symmetric reflection) and float rounding.
+    """
+    sigma, box_size = get_filter_sizes(blur_radius, feather_amount, scale)
+    processed = _separable_filter(masks, get_gaussian_kernel(sigma).tolist())
+    if box_size:
+        processed = _separable_filter(processed, [1.0 / box_size] * box_size)
+    return processed.mul(255.0).clamp_(0, 255).floor_().div_(255.0)
+
+
+def get_resize_scale(orig_size, new_size):
+    """Resize factor of (width, height) orig_size to new_size, for the scale of process_mask"""
+    return math.sqrt((new_size[0] * new_size[1]) / (orig_size[0] * orig_size[1]))
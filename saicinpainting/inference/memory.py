@@ -0,0 +1,207 @@
+"""Memory cost model of the generator and admission of model runs against the free memory
+
+The activations and FFT buffers of every generator block scale with the padded H*W of the input, so the peak
+memory of one forward pass is modelled as fixed_bytes + bytes_per_pixel * batch_size * H * W, with coefficients
+fitted by bin/calibrate_memory.py. MemoryAdmission reserves that peak for every model run against the budget
+measured once the model is loaded: a run that fits next to the runs in flight starts, one that would fit once they
+are done waits for them, and a page that can not fit at all is downscaled (or rejected below a minimum size).
+"""
+
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+DECISIONS = ('admitted', 'queued', 'downscaled', 'rejected')
+
+# fp32 CPU forward of big-lama with folded BatchNorm, peak RSS growth over the loaded model; calibrate your own
+DEFAULT_BYTES_PER_PIXEL = 1200
+DEFAULT_FIXED_BYTES = 64 * 2 ** 20
+
+
+class InsufficientMemory(Exception):
+    pass
+
+
+class MemoryModel:
+    """Predicted peak bytes of a generator forward pass for a batch of padded HxW inputs"""
+    def __init__(self, bytes_per_pixel=DEFAULT_BYTES_PER_PIXEL, fixed_bytes=DEFAULT_FIXED_BYTES, modulo=8,
+                 info=None):
+        self.bytes_per_pixel = float(bytes_per_pixel)
+        self.fixed_bytes = float(fixed_bytes)
+        self.modulo = modulo
+        self.info = info or {}  # device, precision and points of the calibration
+
+    def __repr__(self):
+        return f'MemoryModel({self.bytes_per_pixel:.0f} B/px + {self.fixed_bytes / 2 ** 20:.0f} MB)'
+
+    def get_padded_pixels(self, height, width):
+        return (-(-height // self.modulo) * self.modulo) * (-(-width // self.modulo) * self.modulo)
+
+    def peak_bytes(self, height, width, batch_size=1):
+        return int(self.fixed_bytes + self.bytes_per_pixel * batch_size * self.get_padded_pixels(height, width))
+
+    def max_pixels(self, budget_bytes, batch_size=1):
+        """Largest padded H*W per input whose batch fits budget_bytes, 0 if none does"""
+        return max(0, int((budget_bytes - self.fixed_bytes) / (self.bytes_per_pixel * batch_size)))
+
+    @classmethod
+    def fit(cls, points, modulo=8, **info):
+        """
+        Least-squares fit on dicts of height, width, batch_size and peak_bytes, with fixed_bytes then raised
+        so that no measured point is above the model
+        """
+        padded_pixels = cls(modulo=modulo).get_padded_pixels
+        pixels = np.array([p['batch_size'] * padded_pixels(p['height'], p['width']) for p in points], np.float64)
+        peaks = np.array([p['peak_bytes'] for p in points], np.float64)
+        if len(points) > 1 and np.ptp(pixels) > 0:
+            bytes_per_pixel, _ = np.polyfit(pixels, peaks, 1)
+        else:
+            bytes_per_pixel = peaks.max() / pixels.max()
+        bytes_per_pixel = max(float(bytes_per_pixel), 1.0)
+        fixed_bytes = max(0.0, float((peaks - bytes_per_pixel * pixels).max()))
+        return cls(bytes_per_pixel, fixed_bytes, modulo, dict(info, points=list(points)))
+
+    def to_dict(self):
+        return dict(bytes_per_pixel=self.bytes_per_pixel, fixed_bytes=self.fixed_bytes, modulo=self.modulo,
+                    info=self.info)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """The calibrated model of path, the default one if path does not exist"""
+        if not path or not os.path.exists(path):
+            LOGGER.warning(f'No calibrated memory model at {path}, using the default coefficients, '
+                           f'run bin/calibrate_memory.py')
+            return cls()
+        with open(path) as f:
+            state = json.load(f)
+        return cls(state['bytes_per_pixel'], state['fixed_bytes'], state.get('modulo', 8), state.get('info'))
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None  # 'max' for no limit
+
+
+def get_free_memory(device='cpu'):
+    """Free bytes for new allocations: MemAvailable, bounded by the cgroup limit of a container, or CUDA free memory"""
+    if str(device).startswith('cuda'):
+        import torch
+
+        return torch.cuda.mem_get_info(torch.device(device))[0]
+    free = None
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                free = int(line.split()[1]) * 1024
+                break
+    # cgroup v2, then v1
+    for limit_path, usage_path in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit, usage = _read_int(limit_path), _read_int(usage_path)
+        if limit is not None and usage is not None and limit < 2 ** 60:
+            free = min(free, limit - usage) if free is not None else limit - usage
+            break
+    return max(0, free or 0)
+
+
+class MemoryAdmission:
+    """
+    Reservations of the predicted peak memory of model runs, shared with forked worker processes.
+
+    capacity is the free memory minus headroom, measured when the admission is created (after the model is
+    loaded). A run is admitted once its peak fits capacity minus what the runs in flight have reserved. The free
+    memory is not read again for that, since it already reflects the allocations of the runs in flight, which
+    would count them twice. A run larger than capacity raises InsufficientMemory right away, one that waits
+    longer than timeout raises it too. get_scale tells how much to downscale a page beforehand so that it does
+    fit, and capacity is also the budget of MAX_SIZE=auto. get_free returns the free bytes, by default those of
+    device.
+    """
+    def __init__(self, model, device='cpu', headroom_bytes=512 * 2 ** 20, timeout=30.0, poll_interval=0.02,
+                 get_free=None):
+        self.model = model
+        self.device = device
+        self.headroom_bytes = headroom_bytes
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.get_free = get_free or (lambda: get_free_memory(device))
+        self._reserved = multiprocessing.Value('q', 0)  # bytes, created before fork so workers share it
+        self._counts = multiprocessing.Array('q', len(DECISIONS))
+        self.capacity = max(0, self.get_free() - headroom_bytes)
+
+    def get_budget(self):
+        """Bytes available to model runs once the ones in flight are done"""
+        return self.capacity
+
+    def record(self, decision):
+        """Counts an admission decision, one of DECISIONS"""
+        with self._counts.get_lock():
+            self._counts[DECISIONS.index(decision)] += 1
+
+    def get_scale(self, height, width, batch_size=1):
+        """Side scale <= 1 at which the input fits the current budget"""
+        budget = self.get_budget()
+        if self.model.peak_bytes(height, width, batch_size) <= budget:
+            return 1.0
+        return math.sqrt(self.model.max_pixels(budget, batch_size) / self.model.get_padded_pixels(height, width))
+
+    def get_max_side(self, height, width, budget=None):
+        """Longest side the HxW input may be resized to so that a single input fits budget (default: capacity)"""
+        pixels = self.model.max_pixels(self.capacity if budget is None else budget)
+        scale = min(1.0, math.sqrt(pixels / max(1, height * width)))
+        return int(max(height, width) * scale)
+
+    @contextmanager
+    def reserve(self, height, width, batch_size=1):
+        """Holds the reservation of a run while the block executes, yields the seconds waited for it"""
+        cost = self.model.peak_bytes(height, width, batch_size)
+        if cost > self.capacity:
+            self.record('rejected')
+            raise InsufficientMemory(f'{batch_size}x{height}x{width} needs ~{cost / 2 ** 20:.0f} MB, '
+                                     f'{self.capacity / 2 ** 20:.0f} MB available')
+        started_at = time.perf_counter()
+        queued = False
+        while True:
+            with self._reserved.get_lock():
+                if self._reserved.value + cost <= self.capacity:
+                    self._reserved.value += cost
+                    break
+            if time.perf_counter() - started_at > self.timeout:
+                self.record('rejected')
+                raise InsufficientMemory(f'Timed out after {self.timeout:g}s waiting for '
+                                         f'{cost / 2 ** 20:.0f} MB of memory')
+            if not queued:
+                queued = True
+                self.record('queued')
+            time.sleep(self.poll_interval)
+        self.record('admitted')
+        try:
+            yield time.perf_counter() - started_at
+        finally:
+            with self._reserved.get_lock():
+                self._reserved.value -= cost
+
+    def stats(self):
+        return dict(zip(DECISIONS, self._counts[:]),
+                    reserved_bytes=self._reserved.value,
+                    free_bytes=self.get_free(),
+                    capacity_bytes=self.capacity,
+                    headroom_bytes=self.headroom_bytes,
+                    bytes_per_pixel=round(self.model.bytes_per_pixel, 1),
+                    fixed_bytes=int(self.model.fixed_bytes))
@@ -0,0 +1,178 @@
+import bisect
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+
+# upper bounds in seconds, from decode of a small page to a full-resolution tiled run
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_STAGES = contextvars.ContextVar('inference_stages', default=None)
+
+
+@contextlib.contextmanager
+def collect_stages(timings=None):
+    """Collects the stage() timings of the code inside into a {stage: ms} dict, which is yielded"""
+    timings = {} if timings is None else timings
+    token = _STAGES.set(timings)
+    try:
+        yield timings
+    finally:
+        _STAGES.reset(token)
+
+
+def add_stage_time(name, ms):
+    timings = _STAGES.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + ms, 3)
+
+
+def get_stage_timings():
+    """Copy of the timings collected so far by the innermost collect_stages, {} outside of one"""
+    return dict(_STAGES.get() or {})
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Adds the time spent inside to the named stage of the innermost collect_stages, if any"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, (time.perf_counter() - started_at) * 1000)
+
+
+def get_rss_bytes(pid='self'):
+    """Resident set size of a process from /proc, 0 if it is not available"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn  # () -> value, or {label values tuple: value} with labels, evaluated at render time
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        if self.fn is not None:
+            value = self.fn()
+            values = value if isinstance(value, dict) else {(): value}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [(self.name, key, (), value) for key, value in sorted(values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, key, extra, value in self._samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', key, [('le', _format_value(bound))], cumulative))
+            samples.append((self.name + '_sum', key, (), total))
+            samples.append((self.name + '_count', key, (), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text exposition format
+
+    Gauges and counters may be given fn to be read at render time, e.g. from the stats() of another component.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), fn=None):
+        return self._add(Counter(name, documentation, labelnames, fn))
+
+    def gauge(self, name, documentation, labelnames=(), fn=None):
+        return self._add(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,69 @@
+import logging
+
+import torch
+import torch.nn as nn
+
+from saicinpainting.inference.checkpoint import load_generator_weights
+
+LOGGER = logging.getLogger(__name__)
+
+
+class InpaintingModel(nn.Module):
+    """Inference-only counterpart of DefaultInpaintingTrainingModule
+
+    Holds just the generator and keeps forward(batch) semantics: the generator gets the masked image
+    (with the mask concatenated if concat_mask), 'predicted_image' and 'inpainted' are added to the batch.
+    """
+    def __init__(self, generator, concat_mask=True):
+        super().__init__()
+        self.generator = generator
+        self.concat_mask = concat_mask
+
+    def forward(self, batch):
+        img = batch['image']
+        mask = batch['mask']
+
+        masked_img = img * (1 - mask)
+        if self.concat_mask:
+            masked_img = torch.cat([masked_img, mask], dim=1)
+
+        batch['predicted_image'] = self.generator(masked_img)
+        batch['inpainted'] = mask * batch['predicted_image'] + (1 - mask) * batch['image']
+        return batch
+
+    def freeze(self):
+        self.eval()
+        for param in self.parameters():
+            param.requires_grad = False
+        return self
+
+
+def make_generator(config):
+    # the generator modules are imported lazily, so importing this package stays cheap
+    from saicinpainting.training.modules import make_generator as make_training_generator
+    return make_training_generator(config, **config.generator)
+
+
+def build_model(config):
+    """InpaintingModel with randomly initialized generator from the training_model and generator sections of config"""
+    training_model = dict(config.training_model)
+    kind = training_model.get('kind', 'default')
+    if kind != 'default':
+        raise ValueError(f'Unknown trainer module {kind}')
+    if training_model.get('add_noise_kwargs') is not None:
+        raise ValueError('add_noise_kwargs is not supported by the inference-only model')
+
+    LOGGER.info(f'Make inference model, generator {config.generator.kind}')
+    return InpaintingModel(make_generator(config), concat_mask=training_model.get('concat_mask', True))
+
+
+def load_model(config, weights_path, device='cpu'):
+    """Frozen InpaintingModel with generator weights mapped from weights_path (see convert_checkpoint)
+
+    The model is built on the meta device, so no memory is allocated and no random init is run for weights
+    which are replaced right away.
+    """
+    with torch.device('meta'):
+        model = build_model(config)
+    load_generator_weights(model.generator, weights_path)
+    return model.freeze().to(torch.device(device))
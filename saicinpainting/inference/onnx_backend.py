@@ -0,0 +1,227 @@
+import contextlib
+import inspect
+import logging
+import math
+import time
+import types
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _dft_matrices(size, out_size, device, dtype):
+    """cos and sin of 2*pi*n*k/size for n < size, k < out_size as (size, out_size) matrices"""
+    n = torch.arange(size, device=device)
+    k = torch.arange(out_size, device=device)
+    # the product is reduced modulo size before going to float to keep the angles exact for large sizes
+    # (a tensor divisor, so that it stays symbolic in the exported graph)
+    angles = torch.remainder(n[:, None] * k[None, :], torch.full((), size, dtype=torch.int64, device=device))
+    angles = angles.to(dtype) * (2 * math.pi / size)
+    return torch.cos(angles), torch.sin(angles)
+
+
+def rfft2_matmul(x):
+    """torch.fft.rfftn(x, dim=(-2, -1), norm='ortho') as (real, imag) computed with DFT matrix products
+
+    Exports to plain MatMul/Cos/Sin ONNX ops and keeps working with dynamic height and width.
+    """
+    height, width = x.shape[-2:]
+    cos_w, sin_w = _dft_matrices(width, width // 2 + 1, x.device, x.dtype)
+    cos_h, sin_h = _dft_matrices(height, height, x.device, x.dtype)
+    real = torch.matmul(x, cos_w)
+    imag = -torch.matmul(x, sin_w)
+    # complex DFT along height: (cos_h - i sin_h) @ (real + i imag)
+    scale = 1 / torch.sqrt(torch.tensor(height * width, dtype=x.dtype, device=x.device))
+    return ((torch.matmul(cos_h, real) + torch.matmul(sin_h, imag)) * scale,
+            (torch.matmul(cos_h, imag) - torch.matmul(sin_h, real)) * scale)
+
+
+def irfft2_matmul(real, imag, size):
+    """torch.fft.irfftn(torch.complex(real, imag), s=size, dim=(-2, -1), norm='ortho') with DFT matrix products"""
+    height, width = size
+    freqs = real.shape[-1]
+    cos_h, sin_h = _dft_matrices(height, height, real.device, real.dtype)
+    # inverse complex DFT along height: (cos_h + i sin_h) @ (real + i imag)
+    real, imag = (torch.matmul(cos_h, real) - torch.matmul(sin_h, imag),
+                  torch.matmul(cos_h, imag) + torch.matmul(sin_h, real))
+
+    # the missing conjugate half of the spectrum counts twice, except for the DC and Nyquist frequencies
+    k = torch.arange(freqs, device=real.device)
+    weights = torch.where((k == 0) | (2 * k == width), 1.0, 2.0).to(real.dtype)
+    cos_w, sin_w = _dft_matrices(width, freqs, real.device, real.dtype)
+    output = torch.matmul(real * weights, cos_w.t()) - torch.matmul(imag * weights, sin_w.t())
+    return output / torch.sqrt(torch.tensor(height * width, dtype=real.dtype, device=real.device))
+
+
+def _fourier_unit_matmul_forward(self, x):
+    """FourierUnit.forward with rfftn/irfftn replaced by rfft2_matmul/irfft2_matmul"""
+    assert not self.ffc3d and self.fft_norm == 'ortho', 'only 2d ortho FFT has a matmul implementation'
+    batch = x.shape[0]
+
+    if self.spatial_scale_factor is not None:
+        orig_size = x.shape[-2:]
+        x = F.interpolate(x, scale_factor=self.spatial_scale_factor, mode=self.spatial_scale_mode, align_corners=False)
+
+    real, imag = rfft2_matmul(x)
+    ffted = torch.stack((real, imag), dim=2)  # (batch, c, 2, h, w/2+1)
+    ffted = ffted.reshape((batch, -1,) + ffted.shape[3:])
+
+    if self.spectral_pos_encoding:
+        height, width = ffted.shape[-2:]
+        coords_vert = torch.linspace(0, 1, height)[None, None, :, None].expand(batch, 1, height, width).to(ffted)
+        coords_hor = torch.linspace(0, 1, width)[None, None, None, :].expand(batch, 1, height, width).to(ffted)
+        ffted = torch.cat((coords_vert, coords_hor, ffted), dim=1)
+
+    if self.use_se:
+        ffted = self.se(ffted)
+
+    ffted = self.conv_layer(ffted)  # (batch, c*2, h, w/2+1)
+    ffted = self.relu(self.bn(ffted))
+
+    ffted = ffted.reshape((batch, -1, 2,) + ffted.shape[2:])  # (batch, c, 2, h, w/2+1)
+    output = irfft2_matmul(ffted[:, :, 0], ffted[:, :, 1], x.shape[-2:])
+
+    if self.spatial_scale_factor is not None:
+        output = F.interpolate(output, size=orig_size, mode=self.spatial_scale_mode, align_corners=False)
+
+    return output
+
+
+@contextlib.contextmanager
+def matmul_fft(model):
+    """Temporarily runs every FourierUnit of model with DFT matrix products instead of torch.fft"""
+    from saicinpainting.training.modules.ffc import FourierUnit
+
+    units = [module for module in model.modules() if isinstance(module, FourierUnit)]
+    for unit in units:
+        unit.forward = types.MethodType(_fourier_unit_matmul_forward, unit)
+    try:
+        yield model
+    finally:
+        for unit in units:
+            del unit.forward
+
+
+class ExportWrapper(nn.Module):
+    """Like JITWrapper in bin/to_jit.py: (image, mask) -> inpainted, for the InpaintingModel forward(batch)"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image, mask):
+        return self.model(dict(image=image, mask=mask))['inpainted']
+
+
+def _has_dynamo_exporter():
+    """torch.onnx.export takes dynamo= from torch 2.5, older versions only have the TorchScript exporter"""
+    return 'dynamo' in inspect.signature(torch.onnx.export).parameters
+
+
+def _check_dynamo_exporter():
+    if not _has_dynamo_exporter():
+        raise RuntimeError(f'fft="dft" needs the dynamo ONNX exporter of torch >= 2.5, not {torch.__version__}, '
+                           f'use fft="matmul"')
+    try:
+        import onnxscript  # noqa: F401
+    except ImportError:
+        raise RuntimeError('fft="dft" needs the onnx and onnxscript packages, use fft="matmul"')
+
+
+def export_onnx(model, path, fft='matmul', opset=None, sample_size=256):
+    """Exports model to ONNX with dynamic batch, height and width
+
+    fft='matmul' replaces torch.fft with DFT matrix products built from the input shape, which any runtime
+    supports, and goes through the TorchScript exporter with dynamic_axes (opset 17 by default). fft='dft' maps
+    torch.fft to the ONNX DFT op (opset >= 20), which only the dynamo exporter (torch >= 2.5, onnxscript) does.
+    """
+    assert fft in ('dft', 'matmul'), fft
+    wrapper = ExportWrapper(model).eval()
+    image = torch.rand(1, 3, sample_size, sample_size)
+    mask = (torch.rand(1, 1, sample_size, sample_size) > 0.5).float()
+    names = dict(input_names=['image', 'mask'], output_names=['inpainted'])
+
+    started_at = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(torch.no_grad())
+        if fft == 'matmul':
+            stack.enter_context(matmul_fft(model))
+            dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ('image', 'mask', 'inpainted')}
+            if _has_dynamo_exporter():
+                names['dynamo'] = False  # the default from torch 2.9
+            torch.onnx.export(wrapper, (image, mask), path, opset_version=opset or 17, dynamic_axes=dynamic_axes,
+                              **names)
+        else:
+            _check_dynamo_exporter()
+            batch = torch.export.Dim('batch', min=1, max=64)
+            height = torch.export.Dim('height', min=32, max=8192)
+            width = torch.export.Dim('width', min=32, max=8192)
+            dynamic_shapes = {'image': {0: batch, 2: height, 3: width}, 'mask': {0: batch, 2: height, 3: width}}
+            torch.onnx.export(wrapper, (image, mask), path, dynamo=True, opset_version=opset or 20,
+                              external_data=True, dynamic_shapes=dynamic_shapes, **names)
+    LOGGER.info(f'Exported {path} with {fft} FFT in {time.perf_counter() - started_at:.1f}s')
+    return path
+
+
+def make_session_options(threads=0):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if threads > 0:
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+    # buffers planned for one input size can not be reused for another with dynamic height and width
+    options.enable_mem_pattern = False
+    return options
+
+
+class OnnxInpaintingModel:
+    """ONNX Runtime session with the forward(batch) semantics of InpaintingModel"""
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+
+        self.path = path
+        self.session = ort.InferenceSession(path, make_session_options(threads), providers=['CPUExecutionProvider'])
+
+    def __call__(self, batch):
+        image = batch['image']
+        mask = batch['mask'].to(image.dtype)
+        inpainted, = self.session.run(['inpainted'], {'image': image.detach().cpu().numpy(),
+                                                      'mask': mask.detach().cpu().numpy()})
+        batch['inpainted'] = torch.from_numpy(inpainted).to(image.device)
+        return batch
+
+    def freeze(self):
+        return self
+
+    def to(self, device):
+        assert torch.device(device).type == 'cpu', 'ONNX backend runs on CPU only'
+        return self
+
+
+def check_parity(model, onnx_model, sizes, repeats=3, seed=0):
+    """Max abs difference and mean latency of the PyTorch and ONNX models on random inputs of each (h, w)"""
+    rng = np.random.RandomState(seed)
+    report = []
+    for height, width in sizes:
+        image = torch.from_numpy(rng.rand(1, 3, height, width).astype('float32'))
+        mask = torch.from_numpy((rng.rand(1, 1, height, width) > 0.7).astype('float32'))
+        timings = {}
+        outputs = {}
+        for name, fn in (('torch', model), ('onnx', onnx_model)):
+            with torch.no_grad():
+                fn(dict(image=image, mask=mask))  # warm-up
+                started_at = time.perf_counter()
+                for _ in range(repeats):
+                    outputs[name] = fn(dict(image=image, mask=mask))['inpainted']
+            timings[name] = (time.perf_counter() - started_at) / repeats
+        report.append(dict(size=(height, width),
+                           max_abs_diff=float((outputs['torch'] - outputs['onnx']).abs().max()),
+                           torch_ms=round(timings['torch'] * 1000, 1),
+                           onnx_ms=round(timings['onnx'] * 1000, 1)))
+    return report
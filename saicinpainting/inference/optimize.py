@@ -0,0 +1,160 @@
+import logging
+
+import torch
+import torch.nn as nn
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _get_bn_scale_shift(bn):
+    """Per-channel (scale, shift) with bn(x) == x * scale + shift in eval mode, None if bn can not be folded"""
+    if not isinstance(bn, nn.BatchNorm2d) or bn.running_mean is None or bn.training:
+        return None
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias
+    return scale.detach(), shift.detach()
+
+
+def _scale_conv(conv, scale, shift=None):
+    """Multiplies the output channels of conv by scale and adds shift to them, replacing the parameters"""
+    if isinstance(conv, nn.ConvTranspose2d):
+        assert conv.groups == 1, 'grouped transposed convs are not folded'
+        weight = conv.weight * scale[None, :, None, None]  # (in, out, kh, kw)
+    else:
+        weight = conv.weight * scale[:, None, None, None]  # (out, in / groups, kh, kw)
+    bias = conv.bias * scale if conv.bias is not None else None
+    if shift is not None:
+        bias = shift if bias is None else bias + shift
+    # new tensors rather than in-place updates, weights may be mapped read-only from the serving file
+    conv.weight = nn.Parameter(weight.detach(), requires_grad=False)
+    if bias is not None:
+        conv.bias = nn.Parameter(bias.detach(), requires_grad=False)
+
+
+def _is_conv(module):
+    return type(module) in (nn.Conv2d, nn.ConvTranspose2d)
+
+
+def fold_sequential(seq):
+    """Folds the BatchNorm2d layers that directly follow a conv in seq into it and removes them, in place
+
+    A ReLU or LeakyReLU that then follows the conv runs in place on its output, which nothing else reads.
+    """
+    folded = 0
+    i = 1
+    while i < len(seq):
+        scale_shift = _get_bn_scale_shift(seq[i]) if _is_conv(seq[i - 1]) else None
+        if scale_shift is None:
+            i += 1
+            continue
+        _scale_conv(seq[i - 1], *scale_shift)
+        del seq[i]
+        if i < len(seq) and type(seq[i]) in (nn.ReLU, nn.LeakyReLU):
+            seq[i].inplace = True
+        folded += 1
+    return folded
+
+
+class FoldedFFC_BN_ACT(nn.Module):
+    """Inference form of FFC_BN_ACT with bn_l/bn_g folded into the convs
+
+    Only the branches that exist for the block ratios run: no nn.Identity calls on the missing local or global
+    parts, no multiplication by the constant gate, and the two summands of each output are added in place.
+    """
+    def __init__(self, block):
+        super().__init__()
+        self.ffc = block.ffc
+        self.act_l = block.act_l
+        self.act_g = block.act_g
+
+    def forward(self, x):
+        ffc = self.ffc
+        x_l, x_g = x if type(x) is tuple else (x, 0)
+        out_xl, out_xg = 0, 0
+
+        if ffc.ratio_gout != 1:
+            out_xl = ffc.convl2l(x_l)
+            if ffc.global_in_num > 0:
+                out_xl += ffc.convg2l(x_g)
+            out_xl = self.act_l(out_xl)
+        if ffc.ratio_gout != 0:
+            out_xg = ffc.convl2g(x_l)
+            if ffc.global_in_num > 0:
+                out_xg += ffc.convg2g(x_g)
+            out_xg = self.act_g(out_xg)
+
+        return out_xl, out_xg
+
+
+def fold_ffc_bn_act(block):
+    """FoldedFFC_BN_ACT for block, or None if its layout is not supported and it is left as is"""
+    from saicinpainting.training.modules.ffc import SpectralTransform
+
+    ffc = block.ffc
+    if ffc.gated or ffc.ratio_gin == 1:
+        return None
+
+    # convs summed into each output: (first one, which gets the shift, the other one or None)
+    outputs = []
+    if ffc.ratio_gout != 1:
+        outputs.append((block.bn_l, ffc.convl2l, ffc.convg2l if ffc.global_in_num > 0 else None))
+    if ffc.ratio_gout != 0:
+        other = ffc.convg2g.conv2 if isinstance(ffc.convg2g, SpectralTransform) else ffc.convg2g
+        outputs.append((block.bn_g, ffc.convl2g, other if ffc.global_in_num > 0 else None))
+
+    folds = []
+    for bn, conv, other in outputs:
+        if isinstance(bn, nn.Identity):
+            continue
+        scale_shift = _get_bn_scale_shift(bn)
+        if scale_shift is None or not _is_conv(conv) or (other is not None and not _is_conv(other)):
+            return None
+        folds.append((scale_shift, conv, other))
+
+    for (scale, shift), conv, other in folds:
+        _scale_conv(conv, scale, shift)
+        if other is not None:
+            _scale_conv(other, scale)
+    return FoldedFFC_BN_ACT(block)
+
+
+@torch.no_grad()
+def optimize_for_inference(generator):
+    """Folds the eval-mode BatchNorm2d layers of an FFC generator into the preceding convs, in place
+
+    - FFC_BN_ACT blocks become FoldedFFC_BN_ACT, with bn_l/bn_g folded into both convs of each output,
+    - conv -> BatchNorm2d pairs of any Sequential (the SpectralTransform conv1 and the ConvTranspose2d +
+      up_norm_layer upsampler) lose the norm,
+    - FourierUnit folds bn into conv_layer on the spectrum.
+
+    ReLU is applied in place on the folded conv outputs but not fused into the convs: eager PyTorch has no float
+    conv + ReLU kernel to dispatch to, that fusion is left to COMPILE=1 (inductor).
+
+    Outputs match the original model up to float rounding. Run it before prepare_quantization, which then wraps
+    the folded convs. Returns the generator.
+    """
+    from saicinpainting.training.modules.ffc import FFC_BN_ACT, FourierUnit
+
+    counts = dict(ffc_bn_act=0, sequential=0, fourier_unit=0)
+    for module in list(generator.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, FFC_BN_ACT):
+                folded = fold_ffc_bn_act(child)
+                if folded is not None:
+                    setattr(module, name, folded)
+                    counts['ffc_bn_act'] += 1
+        if isinstance(module, nn.Sequential):
+            counts['sequential'] += fold_sequential(module)
+        if isinstance(module, FourierUnit) and _is_conv(module.conv_layer):
+            scale_shift = _get_bn_scale_shift(module.bn)
+            if scale_shift is not None:
+                _scale_conv(module.conv_layer, *scale_shift)
+                module.bn = nn.Identity()
+                counts['fourier_unit'] += 1
+
+    LOGGER.info(f'Folded BatchNorm2d: {counts}')
+    return generator
@@ -0,0 +1,64 @@
+import contextlib
+import logging
+
+import torch
+import torch.nn as nn
+
+LOGGER = logging.getLogger(__name__)
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16}
+
+
+def get_autocast_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expected one of {", ".join(PRECISIONS)}')
+    return PRECISIONS[precision]
+
+
+class PrecisionModel(nn.Module):
+    """Runs a model with forward(batch) semantics in channels_last layout and/or under autocast
+
+    The 4D weights and the image and mask of each batch are converted to torch.channels_last, the forward pass
+    runs under torch.autocast with dtype if given (FourierUnit keeps its FFTs in fp32), and the image outputs
+    are returned as contiguous float32.
+    """
+    def __init__(self, model, channels_last=False, dtype=None, device_type='cpu'):
+        super().__init__()
+        self.model = model
+        self.channels_last = channels_last
+        self.dtype = dtype
+        self.device_type = device_type
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+
+    @property
+    def generator(self):
+        return self.model.generator
+
+    def forward(self, batch):
+        if self.channels_last:
+            for key in ('image', 'mask'):
+                batch[key] = batch[key].contiguous(memory_format=torch.channels_last)
+
+        with contextlib.ExitStack() as stack:
+            if self.dtype is not None:
+                stack.enter_context(torch.autocast(device_type=self.device_type, dtype=self.dtype))
+            batch = self.model(batch)
+
+        for key in ('predicted_image', 'inpainted'):
+            if key in batch:
+                batch[key] = batch[key].float().contiguous()
+        return batch
+
+    def freeze(self):
+        self.model.freeze()
+        return self
+
+
+def apply_precision(model, precision='fp32', channels_last=False, device_type='cpu'):
+    """model wrapped in PrecisionModel if a non-default layout or precision is asked for, model itself otherwise"""
+    dtype = get_autocast_dtype(precision)
+    if dtype is None and not channels_last:
+        return model
+    LOGGER.info(f'Inference in {precision}, channels_last={channels_last}')
+    return PrecisionModel(model, channels_last=channels_last, dtype=dtype, device_type=device_type)
@@ -0,0 +1,206 @@
+import collections
+import json
+import logging
+import math
+import time
+
+import torch
+import torch.nn as nn
+
+LOGGER = logging.getLogger(__name__)
+
+LOCAL_BRANCHES = ('convl2l', 'convl2g', 'convg2l')
+SPECTRAL_BRANCHES = ('convg2g',)
+
+
+def _iter_tensors(value):
+    if torch.is_tensor(value):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _iter_tensors(item)
+
+
+def _get_shapes(value):
+    return [list(tensor.shape) for tensor in _iter_tensors(value)]
+
+
+def _get_fft_flops(x):
+    """rfftn + irfftn over the last two dims, ~2.5 N log2 N real flops each for N-point real transforms"""
+    n = x.shape[-1] * x.shape[-2]
+    return 2 * 2.5 * (x.numel() // n) * n * math.log2(max(n, 2))
+
+
+def estimate_flops(module, inputs, output):
+    """Flops of the module itself, not counting its children; 0 for containers and unknown modules"""
+    from saicinpainting.training.modules.ffc import FourierUnit
+
+    if isinstance(module, nn.Conv2d):
+        kernel_h, kernel_w = module.kernel_size
+        return 2 * output.numel() * module.in_channels // module.groups * kernel_h * kernel_w
+    if isinstance(module, nn.ConvTranspose2d):
+        kernel_h, kernel_w = module.kernel_size
+        return 2 * inputs[0].numel() * module.out_channels // module.groups * kernel_h * kernel_w
+    if isinstance(module, FourierUnit):
+        return _get_fft_flops(inputs[0])
+    if isinstance(module, (nn.BatchNorm2d, nn.ReLU, nn.LeakyReLU, nn.Tanh, nn.Sigmoid)):
+        return output.numel()
+    return 0
+
+
+def get_category(module):
+    """conv, fft, norm_act or other: what the self time of a module is spent on"""
+    from saicinpainting.training.modules.ffc import FourierUnit
+
+    if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)):
+        return 'conv'
+    if isinstance(module, FourierUnit):
+        # its children are the 1x1 conv on the spectrum and the norm, what remains is the transforms and reshapes
+        return 'fft'
+    if isinstance(module, (nn.BatchNorm2d, nn.ReLU, nn.LeakyReLU, nn.Tanh, nn.Sigmoid)):
+        return 'norm_act'
+    return 'other'
+
+
+def get_branch(name):
+    """local or spectral for modules inside an FFC branch, None elsewhere"""
+    parts = name.split('.')
+    for part in reversed(parts):
+        if part in SPECTRAL_BRANCHES:
+            return 'spectral'
+        if part in LOCAL_BRANCHES:
+            return 'local'
+    return None
+
+
+class LayerProfiler:
+    """Forward hooks on every module under generator.model recording wall time, flops and activation memory
+
+    Use it as a context manager around one generator forward; the hooks are removed on exit. Each module call
+    becomes an event with the inclusive and self (minus children) wall time, the estimated flops of the module
+    itself, the bytes of its output tensors and, on CUDA, the change of allocated memory. Events nest like the
+    calls, so they export directly as a Chrome trace or as folded stacks for flamegraph tools.
+    """
+    def __init__(self, generator, synchronize=None):
+        self.root = generator.model if hasattr(generator, 'model') else generator
+        self.names = {module: ('model.' + name if name else 'model') for name, module in self.root.named_modules()}
+        self.synchronize = synchronize if synchronize is not None else torch.cuda.is_available()
+        self.events = []
+        self._stack = []
+        self._handles = []
+        self._started_at = None
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, module, inputs):
+        self._sync()
+        memory = torch.cuda.memory_allocated() if self.synchronize else 0
+        self._stack.append(dict(module=module, start=time.perf_counter(), children=0.0, memory=memory))
+
+    def _hook(self, module, inputs, output):
+        self._sync()
+        end = time.perf_counter()
+        frame = self._stack.pop()
+        duration = end - frame['start']
+        if self._stack:
+            self._stack[-1]['children'] += duration
+        name = self.names[module]
+        self.events.append(dict(
+            name=name,
+            type=type(module).__name__,
+            category=get_category(module),
+            branch=get_branch(name),
+            depth=len(self._stack),
+            start_ms=(frame['start'] - self._started_at) * 1000,
+            total_ms=duration * 1000,
+            self_ms=(duration - frame['children']) * 1000,
+            flops=estimate_flops(module, inputs, output),
+            output_bytes=sum(tensor.numel() * tensor.element_size() for tensor in _iter_tensors(output)),
+            memory_delta_bytes=(torch.cuda.memory_allocated() - frame['memory']) if self.synchronize else None,
+            input_shapes=_get_shapes(inputs),
+            output_shapes=_get_shapes(output),
+        ))
+
+    def __enter__(self):
+        self.events = []
+        self._started_at = time.perf_counter()
+        for module in self.names:
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook))
+            self._handles.append(module.register_forward_hook(self._hook))
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._stack = []
+        self.events.sort(key=lambda event: event['start_ms'])
+
+    def summary(self):
+        """Totals of one profiled forward: time by category and by FFC branch, flops and activation memory"""
+        roots = [event for event in self.events if event['depth'] == 0]
+        by_category = collections.Counter()
+        for event in self.events:
+            by_category[event['category']] += event['self_ms']
+        # the outermost module of each branch, so nested modules are not counted twice
+        by_branch = collections.Counter()
+        for event in self.events:
+            branch = event['branch']
+            if branch is not None and event['name'].rsplit('.', 1)[-1] in LOCAL_BRANCHES + SPECTRAL_BRANCHES:
+                by_branch[branch] += event['total_ms']
+        fft_in_spectral = sum(event['self_ms'] for event in self.events
+                              if event['branch'] == 'spectral' and event['category'] == 'fft')
+        return dict(
+            total_ms=sum(event['total_ms'] for event in roots),
+            by_category_ms=dict(by_category),
+            local_ms=by_branch['local'],
+            spectral_ms=by_branch['spectral'],
+            spectral_fft_ms=fft_in_spectral,
+            gflops=sum(event['flops'] for event in self.events) / 1e9,
+            max_activation_bytes=max((event['output_bytes'] for event in self.events), default=0),
+            activation_bytes=sum(event['output_bytes'] for event in self.events if event['depth'] == 1),
+        )
+
+    def top(self, n=10, key='self_ms'):
+        """The n module calls with the largest key"""
+        return sorted(self.events, key=lambda event: event[key], reverse=True)[:n]
+
+    def to_chrome_trace(self):
+        """Trace Event Format dict, for chrome://tracing or ui.perfetto.dev"""
+        trace_events = []
+        for event in self.events:
+            trace_events.append(dict(
+                name=f'{event["name"].rsplit(".", 1)[-1]} ({event["type"]})',
+                cat=event['category'],
+                ph='X',
+                ts=event['start_ms'] * 1000,
+                dur=event['total_ms'] * 1000,
+                pid=0,
+                tid=0,
+                args=dict(module=event['name'], branch=event['branch'], flops=event['flops'],
+                          output_bytes=event['output_bytes'], input_shapes=event['input_shapes'],
+                          output_shapes=event['output_shapes']),
+            ))
+        return dict(traceEvents=trace_events, displayTimeUnit='ms')
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def to_folded_stacks(self):
+        """'frame;frame;frame self_us' lines of the folded stack format read by flamegraph.pl and speedscope"""
+        lines = []
+        stack = []
+        for event in self.events:
+            del stack[event['depth']:]
+            stack.append(f'{event["name"].rsplit(".", 1)[-1]}:{event["type"]}')
+            self_us = int(round(event['self_ms'] * 1000))
+            if self_us > 0:
+                lines.append(f'{";".join(stack)} {self_us}')
+        return lines
+
+    def export_folded_stacks(self, path):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.to_folded_stacks()) + '\n')
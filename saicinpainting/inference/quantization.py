@@ -0,0 +1,112 @@
+import io
+import logging
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.ao.quantization as tq
+import torch.nn as nn
+
+LOGGER = logging.getLogger(__name__)
+
+
+class QuantizedConvWrapper(nn.Module):
+    """Runs conv in int8 between float input and output, so the surrounding FFT, BN and activations stay float"""
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def get_quantizable_convs(generator):
+    """(parent, attribute name) of the FFC local/cross 3x3 convs and the 1x1 convs of the spectral branch"""
+    from saicinpainting.training.modules.ffc import FFC, FourierUnit, SpectralTransform
+
+    for module in generator.modules():
+        if isinstance(module, FFC):
+            names = ('convl2l', 'convl2g', 'convg2l')
+        elif isinstance(module, SpectralTransform):
+            yield module.conv1, '0'
+            names = ('conv2',)
+        elif isinstance(module, FourierUnit):
+            names = ('conv_layer',)
+        else:
+            continue
+        for name in names:
+            if isinstance(getattr(module, name), nn.Conv2d):
+                yield module, name
+
+
+def prepare_quantization(generator, backend='x86'):
+    """Wraps the quantizable convs of generator in place and inserts observers for calibration"""
+    torch.backends.quantized.engine = backend
+    qconfig = tq.get_default_qconfig(backend)
+    wrapped = 0
+    for parent, name in list(get_quantizable_convs(generator)):
+        wrapper = QuantizedConvWrapper(getattr(parent, name))
+        wrapper.qconfig = qconfig
+        setattr(parent, name, wrapper)
+        wrapped += 1
+    tq.prepare(generator, inplace=True)
+    LOGGER.info(f'Prepared {wrapped} convs for {backend} int8 quantization')
+    return generator
+
+
+def convert_quantization(generator):
+    """Replaces the observed convs with int8 ones using the ranges collected since prepare_quantization"""
+    return tq.convert(generator.eval(), inplace=True)
+
+
+@torch.no_grad()
+def quantize_model(model, calibration_batches, backend='x86'):
+    """Post-training static int8 quantization of model.generator, calibrated on batches of image and mask"""
+    prepare_quantization(model.generator, backend)
+    for batch in calibration_batches:
+        model(dict(batch))
+    convert_quantization(model.generator)
+    return model
+
+
+def make_quantized_structure(generator, backend='x86'):
+    """Turns a float generator into an int8 one with the same module layout, to load a saved int8 state dict into"""
+    prepare_quantization(generator, backend)
+    # observers without calibration give placeholder ranges, which load_state_dict replaces
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return convert_quantization(generator)
+
+
+def get_state_dict_size(module):
+    buf = io.BytesIO()
+    torch.save(module.state_dict(), buf)
+    return buf.tell()
+
+
+def psnr(pred, target):
+    mse = torch.mean((pred - target) ** 2).item()
+    return float('inf') if mse == 0 else 10 * np.log10(1 / mse)
+
+
+@torch.no_grad()
+def compare_models(reference, candidate, batches, lpips=None):
+    """Latency of both models and PSNR/LPIPS of the candidate output against the reference one, per batch"""
+    rows = []
+    for batch in batches:
+        outputs, timings = {}, {}
+        for name, model in (('reference', reference), ('candidate', candidate)):
+            started_at = time.perf_counter()
+            outputs[name] = model(dict(batch))['inpainted']
+            timings[name] = time.perf_counter() - started_at
+        row = dict(size=tuple(batch['image'].shape[2:]),
+                   reference_ms=timings['reference'] * 1000,
+                   candidate_ms=timings['candidate'] * 1000,
+                   psnr=psnr(outputs['candidate'], outputs['reference']))
+        if lpips is not None:
+            row['lpips'] = float(lpips(outputs['candidate'], outputs['reference']).mean())  # 0..1 images
+        rows.append(row)
+    return rows
@@ -0,0 +1,94 @@
+import cv2
+import numpy as np
+
+from saicinpainting.evaluation.data import ceil_modulo
+
+
+def get_mask_bbox(mask):
+    """Returns (x0, y0, x1, y1) of the non-zero pixels of a HxW mask, or None if the mask is empty"""
+    x, y, w, h = cv2.boundingRect((mask > 0).astype('uint8'))
+    if w == 0 or h == 0:
+        return None
+    return x, y, x + w, y + h
+
+
+def expand_bbox(bbox, margin, width, height, modulo=8):
+    """Grows bbox by margin pixels of context and snaps it outwards to the modulo grid of the full image.
+    Sides touching the image border are clipped, so the result is not guaranteed to be divisible by modulo there"""
+    x0, y0, x1, y1 = bbox
+    x0 = max(0, x0 - margin) // modulo * modulo
+    y0 = max(0, y0 - margin) // modulo * modulo
+    x1 = min(width, ceil_modulo(x1 + margin, modulo))
+    y1 = min(height, ceil_modulo(y1 + margin, modulo))
+    return x0, y0, x1, y1
+
+
+def get_roi_bbox(mask, margin, modulo=8):
+    """Context-padded, grid-snapped bbox around everything that has to be inpainted, or None for an empty mask"""
+    bbox = get_mask_bbox(mask)
+    if bbox is None:
+        return None
+    height, width = mask.shape[:2]
+    return expand_bbox(bbox, margin, width, height, modulo=modulo)
+
+
+def crop_roi(img, bbox):
+    x0, y0, x1, y1 = bbox
+    return img[y0:y1, x0:x1]
+
+
+def get_component_bboxes(mask):
+    """Returns (x0, y0, x1, y1) of every 8-connected component of the non-zero mask pixels"""
+    _, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype('uint8'), connectivity=8)
+    return [(x, y, x + w, y + h) for x, y, w, h in stats[1:, :4].tolist()]  # label 0 is background
+
+
+def _bboxes_are_close(a, b, distance):
+    return (a[0] - distance < b[2] and b[0] - distance < a[2] and
+            a[1] - distance < b[3] and b[1] - distance < a[3])
+
+
+def merge_close_bboxes(bboxes, distance):
+    """Greedily unions bboxes whose gap is below distance pixels until no pair can be merged"""
+    bboxes = list(bboxes)
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for bbox in bboxes:
+            for i, other in enumerate(result):
+                if _bboxes_are_close(bbox, other, distance):
+                    result[i] = (min(bbox[0], other[0]), min(bbox[1], other[1]),
+                                 max(bbox[2], other[2]), max(bbox[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(bbox)
+        bboxes = result
+    return bboxes
+
+
+def get_roi_bboxes(mask, margin, merge_distance, modulo=8):
+    """
+    Splits the mask into connected components, clusters the ones closer than merge_distance
+    and returns non-overlapping context-padded, grid-snapped bboxes, one per cluster
+    """
+    height, width = mask.shape[:2]
+    bboxes = merge_close_bboxes(get_component_bboxes(mask), merge_distance)
+    bboxes = [expand_bbox(bbox, margin, width, height, modulo=modulo) for bbox in bboxes]
+    # context margins of neighbouring clusters may still overlap, paste-back requires disjoint crops
+    return sorted(merge_close_bboxes(bboxes, 0), key=lambda b: (b[1], b[0]))
+
+
+def get_bucket_side(side, buckets, modulo=8):
+    """Smallest bucket that fits side, or side rounded up to modulo if it exceeds all of them"""
+    for bucket in sorted(buckets):
+        if side <= bucket:
+            return bucket
+    return ceil_modulo(side, modulo)
+
+
+def pad_to_size(img, height, width):
+    """Symmetric-pads a HxW or HxWxC array at the bottom and right to (height, width)"""
+    pad = [(0, height - img.shape[0]), (0, width - img.shape[1])] + [(0, 0)] * (img.ndim - 2)
+    return np.pad(img, pad, mode='symmetric')
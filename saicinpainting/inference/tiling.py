@@ -0,0 +1,118 @@
+import torch
+import torch.nn.functional as F
+
+from saicinpainting.evaluation.data import ceil_modulo, pad_tensor_to_modulo
+
+
+def get_tile_starts(size, tile_size, overlap):
+    """Start offsets of tiles covering [0, size) with at least overlap pixels shared by neighbours"""
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)  # last tile is aligned to the border instead of sticking out
+    return starts
+
+
+def get_tile_boxes(height, width, tile_size, overlap):
+    """(y0, x0, y1, x1) of overlapping tiles covering a height x width image, in row-major order"""
+    assert 0 <= overlap < tile_size, (overlap, tile_size)
+    return [(y0, x0, min(height, y0 + tile_size), min(width, x0 + tile_size))
+            for y0 in get_tile_starts(height, tile_size, overlap)
+            for x0 in get_tile_starts(width, tile_size, overlap)]
+
+
+def _make_ramp(size, overlap, ramp_start, ramp_end):
+    weights = torch.ones(size)
+    overlap = min(overlap, size)
+    if overlap > 0:
+        ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+        if ramp_start:
+            weights[:overlap] = ramp
+        if ramp_end:
+            weights[-overlap:] = torch.minimum(weights[-overlap:], ramp.flip(0))
+    return weights
+
+
+def make_tile_weights(box, height, width, overlap):
+    """Feathered (1, 1, h, w) blending weights, ramping to 0 towards the sides shared with neighbour tiles"""
+    y0, x0, y1, x1 = box
+    weights_y = _make_ramp(y1 - y0, overlap, y0 > 0, y1 < height)
+    weights_x = _make_ramp(x1 - x0, overlap, x0 > 0, x1 < width)
+    return torch.minimum(weights_y[:, None], weights_x[None, :])[None, None]
+
+
+def _predict(model, image, mask, modulo):
+    height, width = image.shape[2:]
+    batch = dict(image=pad_tensor_to_modulo(image, modulo), mask=pad_tensor_to_modulo(mask, modulo))
+    return model(batch)['inpainted'][:, :, :height, :width]
+
+
+def _lowpass(img, low_size):
+    return F.interpolate(F.interpolate(img, size=low_size, mode='area'),
+                         size=img.shape[2:], mode='bilinear', align_corners=False)
+
+
+@torch.no_grad()
+def tiled_inpaint(model, batch, tile_size=512, overlap=64, context_size=512, modulo=8):
+    """Inpaints a (1, C, H, W) image of any size with peak activation memory bounded by tile_size
+
+    Parameters
+    ----------
+    model : callable
+        inpainting module taking a batch dict with image and binary mask and returning it with 'inpainted'
+    batch : dict
+        'image' of size (1, 3, H, W) in 0..1 and 'mask' of size (1, 1, H, W)
+    tile_size : int
+        side of the square tiles the generator runs on, multiple of modulo
+    overlap : int
+        number of pixels neighbouring tiles share, blended with linear feathering
+    context_size : int, optional
+        the whole image is first inpainted downscaled to fit this size and the low frequencies of every tile
+        are taken from this pass, so that FFC global branches of different tiles agree. None disables it
+    modulo : int
+        generator input size divisor
+
+    Returns
+    -------
+    torch.Tensor
+        inpainted image of size (1, 3, H, W)
+    """
+    assert tile_size % modulo == 0, f'tile_size={tile_size} must be divisible by {modulo}'
+    image = batch['image']
+    mask = (batch['mask'] > 0).to(image.dtype)
+    height, width = image.shape[2:]
+
+    if max(height, width) <= tile_size:
+        return _predict(model, image, mask, modulo)
+
+    coarse = None
+    if context_size is not None:
+        ratio = context_size / max(height, width)
+        low_size = (max(modulo, ceil_modulo(int(height * ratio), modulo)),
+                    max(modulo, ceil_modulo(int(width * ratio), modulo)))
+        low_image = F.interpolate(image, size=low_size, mode='area')
+        low_mask = (F.interpolate(mask, size=low_size, mode='area') > 0).to(image.dtype)
+        coarse = F.interpolate(_predict(model, low_image, low_mask, modulo), size=(height, width),
+                               mode='bilinear', align_corners=False)
+
+    result = torch.zeros_like(image)
+    weights_sum = torch.zeros_like(mask)
+    for box in get_tile_boxes(height, width, tile_size, overlap):
+        y0, x0, y1, x1 = box
+        tile_mask = mask[:, :, y0:y1, x0:x1]
+        if not tile_mask.any():
+            continue  # nothing to inpaint, the known pixels are copied below
+
+        tile = _predict(model, image[:, :, y0:y1, x0:x1], tile_mask, modulo)
+        if coarse is not None:
+            # keep details of the tile but take the global structure from the whole-image pass
+            tile_low_size = (max(1, round((y1 - y0) * ratio)), max(1, round((x1 - x0) * ratio)))
+            tile = tile - _lowpass(tile, tile_low_size) + _lowpass(coarse[:, :, y0:y1, x0:x1], tile_low_size)
+
+        tile_weights = make_tile_weights(box, height, width, overlap).to(image)
+        result[:, :, y0:y1, x0:x1] += tile * tile_weights
+        weights_sum[:, :, y0:y1, x0:x1] += tile_weights
+
+    result = result / weights_sum.clamp_min(1e-8)
+    return (mask * result + (1 - mask) * image).clamp(0, 1)
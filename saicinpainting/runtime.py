@@ -0,0 +1,180 @@
+"""Process-level CPU runtime settings: threads, CPU pinning and the memory allocator
+
+Settings come from a JSON file written by bin/tune_runtime.py (RUNTIME_CONFIG) overridden by env:
+  RUNTIME_THREADS          intra-op threads, 0 for one per usable CPU; when it is not set, OMP_NUM_THREADS or
+                           MKL_NUM_THREADS of the operator take precedence over the file and are left as they are
+  RUNTIME_INTEROP_THREADS  inter-op threads, 0 to keep the torch default
+  RUNTIME_CPUS             CPUs to pin the process to, e.g. 0-7,16-23
+  RUNTIME_NUMA_NODE        NUMA node to pin the process to (its CPUs; memory follows by first touch)
+  RUNTIME_ALLOCATOR        system, jemalloc or tcmalloc; the library is preloaded by re-executing the process
+
+This module does not import torch at import time, so that configure_runtime can run before numpy, OpenCV and
+torch create their thread pools.
+"""
+
+import glob
+import json
+import logging
+import os
+import sys
+
+LOGGER = logging.getLogger(__name__)
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS')
+ALLOCATOR_PATTERNS = {'jemalloc': 'libjemalloc.so*', 'tcmalloc': 'libtcmalloc*.so*'}
+LIBRARY_DIRS = ['/usr/lib/x86_64-linux-gnu', '/usr/lib/aarch64-linux-gnu', '/usr/lib64', '/usr/lib',
+                '/usr/local/lib', os.path.join(sys.prefix, 'lib')]
+_PRELOADED_FLAG = 'RUNTIME_ALLOCATOR_PRELOADED'
+
+
+def parse_cpu_list(value):
+    """'0-3,8' -> [0, 1, 2, 3, 8], the format of /sys cpulist files and taskset"""
+    cpus = []
+    for part in value.strip().split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def get_numa_node_cpus(node):
+    with open(f'/sys/devices/system/node/node{node}/cpulist') as f:
+        return parse_cpu_list(f.read())
+
+
+def get_numa_nodes():
+    return sorted(int(os.path.basename(path)[4:]) for path in glob.glob('/sys/devices/system/node/node[0-9]*'))
+
+
+def find_allocator(name):
+    """Path of the jemalloc or tcmalloc shared library, None if it is not installed"""
+    for lib_dir in LIBRARY_DIRS:
+        paths = sorted(glob.glob(os.path.join(lib_dir, ALLOCATOR_PATTERNS[name])))
+        if paths:
+            return paths[0]
+    return None
+
+
+def get_loaded_allocator():
+    """jemalloc or tcmalloc if one of them is mapped into this process, system otherwise"""
+    try:
+        with open('/proc/self/maps') as f:
+            maps = f.read()
+    except OSError:
+        return 'system'
+    for name in ALLOCATOR_PATTERNS:
+        if f'lib{name}' in maps:
+            return name
+    return 'system'
+
+
+def get_env_threads():
+    """Thread count of the first of THREAD_ENV_VARS set to a positive number, the outer level of nested OpenMP
+    lists such as 4,2; None if none is"""
+    for name in THREAD_ENV_VARS:
+        value = os.environ.get(name, '').split(',', 1)[0].strip()
+        if not value:
+            continue
+        try:
+            threads = int(value)
+        except ValueError:
+            LOGGER.warning(f'Ignoring {name}={os.environ[name]}, not a number of threads')
+            continue
+        if threads > 0:
+            return threads
+    return None
+
+
+def get_runtime_config(default_threads=0, default_interop_threads=0):
+    """Runtime settings from the RUNTIME_CONFIG file and env, see the module docstring"""
+    config = dict(threads=default_threads, interop_threads=default_interop_threads, cpus=None, numa_node=None,
+                  allocator='system')
+    path = os.environ.get('RUNTIME_CONFIG', '')
+    if path:
+        with open(path) as f:
+            tuned = json.load(f)
+        config.update((key, tuned[key]) for key in config if key in tuned)
+
+    env = os.environ
+    env_threads = get_env_threads()
+    if env.get('RUNTIME_THREADS'):
+        config['threads'] = int(env['RUNTIME_THREADS'])
+    elif env_threads:
+        config['threads'] = env_threads
+    if env.get('RUNTIME_INTEROP_THREADS'):
+        config['interop_threads'] = int(env['RUNTIME_INTEROP_THREADS'])
+    if env.get('RUNTIME_CPUS'):
+        config['cpus'] = env['RUNTIME_CPUS']
+    if env.get('RUNTIME_NUMA_NODE'):
+        config['numa_node'] = int(env['RUNTIME_NUMA_NODE'])
+    if env.get('RUNTIME_ALLOCATOR'):
+        config['allocator'] = env['RUNTIME_ALLOCATOR']
+    if config['allocator'] not in ('system',) + tuple(ALLOCATOR_PATTERNS):
+        raise ValueError(f'Unknown allocator {config["allocator"]}, expected system, jemalloc or tcmalloc')
+    return config
+
+
+def _preload_allocator(name):
+    """Re-executes the process with the allocator in LD_PRELOAD; returns only if that is not possible"""
+    path = find_allocator(name)
+    if path is None:
+        LOGGER.warning(f'{name} is requested but not installed, using the system allocator')
+        return
+    if os.environ.get(_PRELOADED_FLAG) == '1':
+        LOGGER.warning(f'{name} was preloaded from {path} but is not mapped, using the system allocator')
+        return
+    if not sys.argv or not sys.argv[0] or sys.argv[0] == '-c':
+        LOGGER.warning(f'Can not re-execute this process to preload {name}, set LD_PRELOAD={path} instead')
+        return
+    env = dict(os.environ, LD_PRELOAD=' '.join(filter(None, [path, os.environ.get('LD_PRELOAD')])))
+    env[_PRELOADED_FLAG] = '1'
+    LOGGER.info(f'Re-executing with LD_PRELOAD={path}')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+
+def configure_runtime(config):
+    """Applies config to this process and returns what is in effect, for startup logs and stats
+
+    Call it as early as possible: the allocator can only be switched by re-executing the process, thread env vars
+    only affect libraries that have not started their pools yet, and torch inter-op threads can be set only once.
+    """
+    if config['allocator'] != 'system' and get_loaded_allocator() != config['allocator']:
+        _preload_allocator(config['allocator'])
+
+    cpus = None
+    if config['numa_node'] is not None:
+        cpus = get_numa_node_cpus(config['numa_node'])
+    elif config['cpus']:
+        cpus = parse_cpu_list(config['cpus']) if isinstance(config['cpus'], str) else list(config['cpus'])
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    usable_cpus = sorted(os.sched_getaffinity(0))
+
+    threads = config['threads'] or len(usable_cpus)
+    # the operator's thread env vars stay as they are, only RUNTIME_THREADS replaces them
+    overwrite = bool(os.environ.get('RUNTIME_THREADS'))
+    for name in THREAD_ENV_VARS:
+        if overwrite or not os.environ.get(name):
+            os.environ[name] = str(threads)
+
+    import torch
+    torch.set_num_threads(threads)
+    if config['interop_threads']:
+        try:
+            torch.set_num_interop_threads(config['interop_threads'])
+        except RuntimeError as ex:
+            # already set, or inter-op work has already started
+            LOGGER.warning(f'Could not set inter-op threads: {ex}')
+
+    applied = dict(threads=torch.get_num_threads(),
+                   interop_threads=torch.get_num_interop_threads(),
+                   cpus=usable_cpus,
+                   numa_node=config['numa_node'],
+                   numa_nodes=len(get_numa_nodes()),
+                   allocator=get_loaded_allocator())
+    LOGGER.info(f'Runtime: {applied}')
+    return applied
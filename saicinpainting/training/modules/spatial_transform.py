@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from kornia.geometry.transform import rotate
 
 
 class LearnableSpatialTransformWrapper(nn.Module):
@@ -24,6 +23,8 @@ class LearnableSpatialTransformWrapper(nn.Module):
             raise ValueError(f'Unexpected input type {type(x)}')
 
     def transform(self, x):
+        from kornia.geometry.transform import rotate  # kornia is slow to import and only needed in training configs
+
         height, width = x.shape[2:]
         pad_h, pad_w = int(height * self.pad_coef), int(width * self.pad_coef)
         x_padded = F.pad(x, [pad_w, pad_w, pad_h, pad_h], mode='reflect')
@@ -31,6 +32,8 @@ class LearnableSpatialTransformWrapper(nn.Module):
         return x_padded_rotated
 
     def inverse_transform(self, y_padded_rotated, orig_x):
+        from kornia.geometry.transform import rotate
+
         height, width = orig_x.shape[2:]
         pad_h, pad_w = int(height * self.pad_coef), int(width * self.pad_coef)
 
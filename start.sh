@@ -8,6 +8,7 @@ if [[ "${RUNPOD_SERVERLESS:-}" != "" || "${RUNPOD_POD_ID:-}" != "" ]]; then
   echo "[start.sh] Starting Runpod Serverless handler"
   exec python3 /app/rp_handler_cpu.py
 else
-  echo "[start.sh] Local mode: starting HTTP API on :8080"
+  # WORKERS > 1 forks inference processes sharing the model weights (see local_api.py)
+  echo "[start.sh] Local mode: starting HTTP API on :8080 with ${WORKERS:-1} inference worker(s)"
   exec python3 /app/local_api.py
 fi
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+
+from saicinpainting.inference.batching import MicroBatchScheduler
+
+
+class Recorder:
+    """run_batch that records the batches it gets and returns the payloads doubled"""
+    def __init__(self, fail_keys=()):
+        self.batches = []
+        self.fail_keys = fail_keys
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, key, payloads):
+        self.release.wait()
+        self.batches.append((key, list(payloads)))
+        if key in self.fail_keys:
+            raise ValueError(f'bad batch {key}')
+        return [payload * 2 for payload in payloads]
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(run_batch, max_batch_size, max_wait):
+        scheduler = MicroBatchScheduler(run_batch, max_batch_size, max_wait)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.close()
+
+
+def test_flushes_when_full(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, max_batch_size=3, max_wait=60.0)
+    requests = [scheduler.submit('a', i) for i in range(3)]
+    # far below max_wait, so only the full batch can have triggered the run
+    assert [request.result(timeout=5) for request in requests] == [0, 2, 4]
+    assert run_batch.batches == [('a', [0, 1, 2])]
+    assert all(request.batch_size == 3 for request in requests)
+    assert scheduler.stats()['flush_reasons'] == {'full': 1}
+
+
+def test_flushes_on_deadline(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, max_batch_size=8, max_wait=0.05)
+    started_at = time.monotonic()
+    requests = [scheduler.submit('a', i) for i in range(2)]
+    assert [request.result(timeout=5) for request in requests] == [0, 2]
+    assert time.monotonic() - started_at >= 0.05
+    assert run_batch.batches == [('a', [0, 1])]
+    assert scheduler.stats()['flush_reasons'] == {'deadline': 1}
+
+
+def test_batches_only_requests_with_the_same_key(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, max_batch_size=2, max_wait=0.05)
+    requests = [scheduler.submit(key, i) for i, key in enumerate('abab')]
+    assert [request.result(timeout=5) for request in requests] == [0, 2, 4, 6]
+    assert sorted(run_batch.batches) == [('a', [0, 2]), ('b', [1, 3])]
+
+
+def test_splits_a_backlog_into_full_batches(make_scheduler):
+    run_batch = Recorder()
+    run_batch.release.clear()  # hold the first batch so that the rest queue up behind it
+    scheduler = make_scheduler(run_batch, max_batch_size=2, max_wait=0.01)
+    first = scheduler.submit('a', 0)
+    time.sleep(0.05)
+    requests = [scheduler.submit('a', i) for i in range(1, 6)]
+    run_batch.release.set()
+    assert [request.result(timeout=5) for request in [first] + requests] == [0, 2, 4, 6, 8, 10]
+    assert [payloads for _, payloads in run_batch.batches] == [[0], [1, 2], [3, 4], [5]]
+
+
+def test_errors_reach_every_caller_of_the_batch(make_scheduler):
+    run_batch = Recorder(fail_keys=('bad',))
+    scheduler = make_scheduler(run_batch, max_batch_size=2, max_wait=0.01)
+    bad = [scheduler.submit('bad', i) for i in range(2)]
+    good = scheduler.submit('good', 1)
+    for request in bad:
+        with pytest.raises(ValueError, match='bad batch'):
+            request.result(timeout=5)
+    # a failed batch does not stop the scheduler
+    assert good.result(timeout=5) == 2
+
+
+def test_close_drains_pending_requests():
+    run_batch = Recorder()
+    scheduler = MicroBatchScheduler(run_batch, max_batch_size=8, max_wait=60.0)
+    requests = [scheduler.submit('a', i) for i in range(3)]
+    scheduler.close()
+    assert [request.result(timeout=0) for request in requests] == [0, 2, 4]
+    with pytest.raises(RuntimeError):
+        scheduler.submit('a', 3)
+
+
+def test_base_exception_fails_every_outstanding_request():
+    run_batch = Recorder(fail_keys=())
+    run_batch.release.clear()
+
+    def exiting_run_batch(key, payloads):
+        run_batch(key, payloads)
+        raise SystemExit(1)
+
+    scheduler = MicroBatchScheduler(exiting_run_batch, max_batch_size=2, max_wait=0.01)
+    running = [scheduler.submit('a', i) for i in range(2)]
+    time.sleep(0.05)
+    queued = [scheduler.submit('b', i) for i in range(2)]
+    run_batch.release.set()
+    for request in running + queued:
+        with pytest.raises(RuntimeError, match='scheduler stopped'):
+            request.result(timeout=5)
+    scheduler.close()
+    with pytest.raises(RuntimeError):
+        scheduler.submit('a', 3)
+
+
+def test_cancelled_requests_are_left_out_of_their_batch(make_scheduler):
+    run_batch = Recorder()
+    run_batch.release.clear()
+    scheduler = make_scheduler(run_batch, max_batch_size=2, max_wait=0.01)
+    first = scheduler.submit('a', 0)
+    time.sleep(0.05)
+    requests = [scheduler.submit('a', i) for i in range(1, 4)]
+    assert requests[0].cancel()
+    assert not first.cancel()  # its batch is running
+    run_batch.release.set()
+    assert first.result(timeout=5) == 0
+    assert [request.result(timeout=5) for request in requests[1:]] == [4, 6]
+    assert [payloads for _, payloads in run_batch.batches] == [[0], [2, 3]]
@@ -0,0 +1,106 @@
+import os
+import threading
+
+from saicinpainting.inference.cache import ResultCache, make_cache_key
+
+
+def test_make_cache_key_separates_parts():
+    assert make_cache_key(b'ab', b'c') != make_cache_key(b'a', b'bc')
+    assert make_cache_key(b'ab', {'x': 1, 'y': 2}) == make_cache_key(b'ab', {'y': 2, 'x': 1})
+    assert make_cache_key(b'ab', {'x': 1}) != make_cache_key(b'ab', {'x': 2})
+
+
+def test_memory_tier_evicts_least_recently_used_by_bytes():
+    cache = ResultCache(max_bytes=100)
+    cache.put('a', b'a' * 40, {'n': 'a'})
+    cache.put('b', b'b' * 40, {'n': 'b'})
+    assert cache.get('a')[2] == 'memory'  # a is now more recently used than b
+    cache.put('c', b'c' * 40, {'n': 'c'})
+    assert cache.get('b') is None
+    assert cache.get('a') == (b'a' * 40, {'n': 'a'}, 'memory')
+    assert cache.get('c') == (b'c' * 40, {'n': 'c'}, 'memory')
+    stats = cache.stats()
+    assert stats['memory_entries'] == 2 and stats['memory_bytes'] == 80
+    assert stats['memory_hits'] == 3 and stats['misses'] == 1
+
+
+def test_memory_tier_skips_values_larger_than_the_limit():
+    cache = ResultCache(max_bytes=100)
+    cache.put('a', b'a' * 40, {})
+    cache.put('big', b'x' * 101, {})
+    assert cache.get('big') is None
+    assert cache.get('a') is not None
+
+
+def test_memory_tier_replaces_a_key():
+    cache = ResultCache(max_bytes=100)
+    cache.put('a', b'a' * 40, {'v': 1})
+    cache.put('a', b'a' * 60, {'v': 2})
+    assert cache.get('a') == (b'a' * 60, {'v': 2}, 'memory')
+    assert cache.stats()['memory_bytes'] == 60
+
+
+def test_disk_tier_round_trip(tmp_path):
+    cache = ResultCache(max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    data, meta = bytes(range(256)), {'content_type': 'image/png', 'size': [3, 4]}
+    cache.put('ab12', data, meta)
+
+    # a new process sharing the directory: empty memory tier, the entry comes from disk and is promoted
+    restarted = ResultCache(max_bytes=1000, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    assert restarted.stats()['disk_entries'] == 1
+    assert restarted.get('ab12') == (data, meta, 'disk')
+    assert restarted.get('ab12') == (data, meta, 'memory')
+    assert not [name for _, _, names in os.walk(tmp_path) for name in names if name.endswith('.tmp')]
+
+
+def test_disk_tier_evicts_oldest_accessed_by_bytes(tmp_path):
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=100)
+    cache.put('aa', b'a' * 40, {})
+    cache.put('bb', b'b' * 40, {})
+    assert cache.get('aa')[2] == 'disk'
+    cache.put('cc', b'c' * 40, {})
+    assert cache.get('bb') is None
+    assert cache.get('aa') is not None and cache.get('cc') is not None
+    assert cache.stats()['disk_bytes'] == 80
+    assert not os.path.exists(tmp_path / 'bb' / 'bb.bin')
+
+
+def test_disk_tier_drops_unreadable_entries(tmp_path):
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    cache.put('aa', b'a' * 10, {'v': 1})
+    (tmp_path / 'aa' / 'aa.json').write_text('{not json')
+    assert cache.get('aa') is None
+    assert cache.stats()['disk_entries'] == 0
+
+
+def test_disk_reads_do_not_block_memory_hits(tmp_path):
+    cache = ResultCache(max_bytes=1000, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    cache.put('aa', b'a' * 10, {})
+    reading, release = threading.Event(), threading.Event()
+    disk_get = cache._disk.get
+
+    def slow_disk_get(key):
+        reading.set()
+        release.wait(10)
+        return disk_get(key)
+
+    cache._disk.get = slow_disk_get
+    miss = threading.Thread(target=cache.get, args=('bb',))
+    miss.start()
+    try:
+        assert reading.wait(10)
+        # the miss is reading the disk, the memory tier and the stats stay available meanwhile
+        assert cache.get('aa')[2] == 'memory'
+        assert cache.stats()['disk_entries'] == 1
+    finally:
+        release.set()
+        miss.join(10)
+    assert cache.stats()['misses'] == 1
+
+
+def test_disk_tier_indexes_entries_of_other_processes(tmp_path):
+    first = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    second = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    first.put('aa', b'a' * 10, {'v': 1})
+    assert second.get('aa') == (b'a' * 10, {'v': 1}, 'disk')
+    assert second.stats()['disk_bytes'] == 10
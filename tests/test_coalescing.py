@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from saicinpainting.inference.coalescing import SingleFlight
+
+
+def run_coalesced(single_flight, key, compute):
+    """The way the handlers use SingleFlight: the leader computes and releases, followers wait for it"""
+    leader = single_flight.claim(key)
+    if leader is not None:
+        return leader.result(timeout=5)
+    try:
+        result = compute()
+    except BaseException as ex:
+        single_flight.release(key, error=ex)
+        raise
+    single_flight.release(key, result)
+    return result
+
+
+def test_followers_share_the_result_of_the_leader():
+    single_flight = SingleFlight()
+    assert single_flight.claim('a') is None
+    followers = [single_flight.claim('a') for _ in range(3)]
+    assert all(follower is followers[0] for follower in followers)
+    assert not followers[0].done()
+    single_flight.release('a', {'image': b'png'})
+    assert [follower.result(timeout=0) for follower in followers] == [{'image': b'png'}] * 3
+    assert single_flight.stats() == {'leaders': 1, 'coalesced': 3, 'in_flight': 0}
+    assert single_flight.coalesced == 3
+
+
+def test_different_keys_do_not_coalesce():
+    single_flight = SingleFlight()
+    assert single_flight.claim('a') is None
+    assert single_flight.claim('b') is None
+    assert single_flight.stats() == {'leaders': 2, 'coalesced': 0, 'in_flight': 2}
+    single_flight.release('a', 1)
+    single_flight.release('b', 2)
+    assert single_flight.stats()['in_flight'] == 0
+
+
+def test_errors_reach_every_follower():
+    single_flight = SingleFlight()
+    assert single_flight.claim('a') is None
+    follower = single_flight.claim('a')
+    single_flight.release('a', error=ValueError('bad input'))
+    with pytest.raises(ValueError, match='bad input'):
+        follower.result(timeout=0)
+
+
+def test_released_key_is_computed_again():
+    single_flight = SingleFlight()
+    assert single_flight.claim('a') is None
+    single_flight.release('a', error=RuntimeError('worker died'))
+    # nothing is kept once the leader is done, neither results nor errors
+    assert single_flight.claim('a') is None
+    single_flight.release('a', 2)
+    assert single_flight.claim('a') is None
+    assert single_flight.stats() == {'leaders': 3, 'coalesced': 0, 'in_flight': 1}
+
+
+def test_concurrent_callers_compute_once():
+    single_flight = SingleFlight()
+    computing, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        computing.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(run_coalesced(single_flight, 'a', compute)))
+               for _ in range(4)]
+    threads[0].start()
+    assert computing.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while single_flight.coalesced < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    assert single_flight.stats() == {'leaders': 1, 'coalesced': 3, 'in_flight': 0}
+
+
+def test_failed_leader_releases_the_key_for_the_next_caller():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise ValueError('bad input')
+
+    with pytest.raises(ValueError):
+        run_coalesced(single_flight, 'a', fail)
+    assert run_coalesced(single_flight, 'a', lambda: 'ok') == 'ok'
+    assert single_flight.stats()['in_flight'] == 0
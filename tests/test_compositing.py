@@ -0,0 +1,56 @@
+import cv2
+import numpy as np
+
+from saicinpainting.inference.compositing import composite_full_res, get_composite_mask, get_composite_sizes
+from saicinpainting.inference.mask_processing import get_resize_scale, process_mask
+
+
+def _make_page(size, stroke):
+    image = np.full((size, size, 3), 200, np.uint8)
+    mask = np.zeros((size, size), np.uint8)
+    x0, y0, x1, y1 = stroke
+    mask[y0:y1, x0:x1] = 255
+    return image, mask
+
+
+def _downscale_and_process(mask, model_size, blur_radius=5, feather_amount=0.1):
+    # as the handler does with blur_edges on: area resize, then the blur at model resolution
+    scale = get_resize_scale(mask.shape[::-1], (model_size, model_size))
+    small = cv2.resize(mask, (model_size, model_size), interpolation=cv2.INTER_AREA)
+    return process_mask(small, blur_radius, feather_amount, scale), scale
+
+
+def test_composite_mask_contains_original_and_processed_mask():
+    _, mask = _make_page(400, (200, 100, 204, 300))
+    model_mask, _ = _downscale_and_process(mask, 200)
+    region = get_composite_mask(mask, model_mask)
+    assert region.shape == mask.shape and region.dtype == np.uint8
+    assert np.all(region[mask > 0] == 255)
+    upscaled = cv2.resize(model_mask, (400, 400), interpolation=cv2.INTER_NEAREST)
+    assert np.all(region[upscaled > 0] == 255)
+    assert np.all(region[(mask == 0) & (upscaled == 0)] == 0)
+
+
+def test_composite_covers_blurred_fringe_past_default_dilation():
+    image, mask = _make_page(400, (200, 100, 204, 300))
+    model_mask, scale = _downscale_and_process(mask, 200)
+    pred = np.zeros((200, 200, 3), np.uint8)
+    dilation, feather = get_composite_sizes(scale)
+    inpainted = cv2.resize((model_mask > 0).astype(np.uint8), (400, 400), interpolation=cv2.INTER_NEAREST) > 0
+
+    # the blur grows the mask further than the default dilation of the raw strokes reaches
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * dilation + 1, 2 * dilation + 1))
+    dilated = cv2.dilate(mask, kernel) > 0
+    fringe = inpainted & ~dilated
+    assert fringe.any()
+
+    raw, _, _ = composite_full_res(image, mask, pred, dilation, feather)
+    assert np.any(raw[fringe] != 0)  # halo of partly original pixels around the raw strokes
+
+    result, changed, crops = composite_full_res(image, get_composite_mask(mask, model_mask), pred,
+                                                dilation, feather)
+    assert crops == 1
+    assert np.all(result[inpainted] == 0)
+    assert np.all(changed[inpainted] == 255)
+    # far from the stroke the page keeps its pixels
+    assert np.all(result[:50] == 200)
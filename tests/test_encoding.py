@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+import pytest
+
+from saicinpainting.inference.encoding import crop_patch, encode, get_output_options
+
+
+def test_output_options_defaults_and_aliases():
+    assert get_output_options({}) == {'format': 'png', 'patch': False, 'png_compression': 1}
+    assert get_output_options({}, 'jpeg', jpeg_quality=80) == {'format': 'jpeg', 'patch': False, 'jpeg_quality': 80}
+    assert get_output_options({'output_format': 'JPG', 'jpeg_quality': '90', 'output': 'patch'}) == \
+        {'format': 'jpeg', 'patch': True, 'jpeg_quality': 90}
+    assert get_output_options({'output_format': 'webp', 'jpeg_quality': 'ignored'}) == {'format': 'webp',
+                                                                                          'patch': False}
+
+
+@pytest.mark.parametrize('inp', [
+    {'output_format': 'gif'},
+    {'output': 'crop'},
+    {'png_compression': 10},
+    {'png_compression': -1},
+    {'png_compression': 'fast'},
+    {'output_format': 'jpeg', 'jpeg_quality': 0},
+    {'output_format': 'jpeg', 'jpeg_quality': 101},
+    {'output_format': 'jpeg', 'jpeg_quality': 95.5},
+    {'output_format': 'jpeg', 'jpeg_quality': None},
+    {'output_format': 'jpeg', 'jpeg_quality': True},
+])
+def test_output_options_reject_invalid_values(inp):
+    with pytest.raises(ValueError):
+        get_output_options(inp)
+
+
+def test_encode_round_trip_and_patch():
+    image = np.random.default_rng(0).integers(0, 256, (32, 48, 3), dtype=np.uint8)
+    mask = np.zeros((32, 48), np.uint8)
+    mask[4:10, 20:30] = 255
+    options = get_output_options({'output': 'patch'})
+    fmt, patch_only = options.pop('format'), options.pop('patch')
+    assert patch_only
+    patch, rect = crop_patch(image, mask)
+    assert rect == (20, 4, 10, 6)
+    data, content_type = encode(patch, fmt, **options)
+    assert content_type == 'image/png'
+    decoded = cv2.cvtColor(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    np.testing.assert_array_equal(decoded, image[4:10, 20:30])
@@ -0,0 +1,152 @@
+import asyncio
+from http import HTTPStatus
+
+import pytest
+
+from saicinpainting.inference.http_parsing import HttpError, parse_binary_request, parse_json_input, read_body
+
+IMAGE = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 4
+MASK = b'\x89PNG\r\n\x1a\n\r\n--not-a-boundary\r\n' + bytes(range(255, -1, -1))
+
+
+def _make_multipart(parts, boundary='test-boundary-123'):
+    body = b''
+    for name, value, filename in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+        content_type = 'application/octet-stream' if filename else 'text/plain'
+        body += (f'--{boundary}\r\nContent-Disposition: {disposition}\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n').encode() + value + b'\r\n'
+    body += f'--{boundary}--\r\n'.encode()
+    return {'content-type': f'multipart/form-data; boundary={boundary}'}, body
+
+
+def test_multipart_files_and_fields():
+    headers, body = _make_multipart([('image', IMAGE, 'page.png'), ('mask', MASK, 'mask.png'),
+                                     ('max_size', b'768', None), ('roi_mode', b'components', None),
+                                     ('tiled', b'false', None), ('blur_radius', b'2.5', None)])
+    inp = parse_binary_request(headers, 'output_format=webp', body)
+    assert bytes(inp.pop('image')) == IMAGE
+    assert bytes(inp.pop('mask')) == MASK
+    assert inp == {'max_size': 768, 'roi_mode': 'components', 'tiled': False, 'blur_radius': 2.5,
+                   'output_format': 'webp'}
+
+
+def test_multipart_without_mask():
+    headers, body = _make_multipart([('image', IMAGE, 'page.png')])
+    with pytest.raises(HttpError) as e:
+        parse_binary_request(headers, '', body)
+    assert e.value.status == HTTPStatus.BAD_REQUEST and e.value.error == 'missing_image_or_mask'
+
+
+def test_image_length_split():
+    inp = parse_binary_request({'x-image-length': str(len(IMAGE))}, 'max_size=512&composite=true', IMAGE + MASK)
+    assert bytes(inp['image']) == IMAGE
+    assert bytes(inp['mask']) == MASK
+    assert inp['max_size'] == 512 and inp['composite'] is True
+
+
+@pytest.mark.parametrize('headers, error', [
+    ({}, 'missing_image_length'),
+    ({'x-image-length': 'abc'}, 'missing_image_length'),
+    ({'x-image-length': '0'}, 'invalid_image_length'),
+    ({'x-image-length': str(len(IMAGE + MASK))}, 'invalid_image_length'),
+    ({'x-image-length': '-5'}, 'invalid_image_length'),
+])
+def test_invalid_image_length(headers, error):
+    with pytest.raises(HttpError) as e:
+        parse_binary_request(headers, '', IMAGE + MASK)
+    assert e.value.status == HTTPStatus.BAD_REQUEST and e.value.error == error
+
+
+@pytest.mark.parametrize('body, required, expected', [
+    (b'{"input": {"image": "a", "mask": "b"}}', True, {'image': 'a', 'mask': 'b'}),
+    (b'{}', False, {}),
+    (b'', False, {}),
+])
+def test_json_input(body, required, expected):
+    assert parse_json_input(body, required) == expected
+
+
+@pytest.mark.parametrize('body, required', [
+    (b'[]', False),
+    (b'"x"', False),
+    (b'5', False),
+    (b'null', False),
+    (b'{"input": []}', False),
+    (b'{"input": "x"}', False),
+    (b'{}', True),
+    (b'{not json', False),
+    (b'\xff\xfe', False),
+])
+def test_invalid_json_input(body, required):
+    with pytest.raises(HttpError) as e:
+        parse_json_input(body, required)
+    assert e.value.status == HTTPStatus.BAD_REQUEST and e.value.error == 'invalid_json'
+
+
+class FakeWriter:
+    def __init__(self):
+        self.written = b''
+
+    def write(self, data):
+        self.written += data
+
+    async def drain(self):
+        pass
+
+
+def _read_body(headers, data, max_bytes=1024):
+    """(body or HttpError, what was written back, bytes left unread) of read_body over data"""
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        writer = FakeWriter()
+        try:
+            body = await read_body(reader, writer, headers, max_bytes)
+        except HttpError as e:
+            body = e
+        return body, writer.written, await reader.read()
+    return asyncio.run(run())
+
+
+def test_content_length_body():
+    assert _read_body({'content-length': '5'}, b'hello, next request') == (b'hello', b'', b', next request')
+    assert _read_body({}, b'next request') == (b'', b'', b'next request')
+
+
+def test_chunked_body():
+    data = b'5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\n\r\nnext'
+    assert _read_body({'transfer-encoding': 'chunked'}, data) == (b'hello, world', b'', b'next')
+
+
+def test_chunked_body_with_trailers():
+    data = b'3\r\nabc\r\n0\r\nX-Checksum: 1\r\nX-Other: 2\r\n\r\nnext'
+    assert _read_body({'transfer-encoding': 'Chunked'}, data) == (b'abc', b'', b'next')
+
+
+def test_expect_100_continue_is_answered_before_reading():
+    body, written, _ = _read_body({'content-length': '3', 'expect': '100-continue'}, b'abc')
+    assert body == b'abc' and written == b'HTTP/1.1 100 Continue\r\n\r\n'
+    body, written, _ = _read_body({'transfer-encoding': 'chunked', 'expect': '100-Continue'}, b'1\r\na\r\n0\r\n\r\n')
+    assert body == b'a' and written == b'HTTP/1.1 100 Continue\r\n\r\n'
+
+
+def test_expect_without_body_is_not_answered():
+    assert _read_body({'content-length': '0', 'expect': '100-continue'}, b'') == (b'', b'', b'')
+
+
+@pytest.mark.parametrize('headers, data, status, error', [
+    ({'transfer-encoding': 'gzip'}, b'', HTTPStatus.NOT_IMPLEMENTED, 'unsupported_transfer_encoding'),
+    ({'content-length': 'abc'}, b'', HTTPStatus.BAD_REQUEST, 'invalid_content_length'),
+    ({'content-length': '-1'}, b'', HTTPStatus.BAD_REQUEST, 'invalid_content_length'),
+    ({'content-length': '2048'}, b'', HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'body_too_large'),
+    ({'transfer-encoding': 'chunked'}, b'800\r\n', HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'body_too_large'),
+    ({'transfer-encoding': 'chunked'}, b'zz\r\n', HTTPStatus.BAD_REQUEST, 'invalid_chunk'),
+    ({'transfer-encoding': 'chunked'}, b'3\r\nabcX\r\n', HTTPStatus.BAD_REQUEST, 'invalid_chunk'),
+    ({'content-length': '3', 'expect': 'something'}, b'abc', HTTPStatus.EXPECTATION_FAILED, 'expectation_failed'),
+])
+def test_invalid_body(headers, data, status, error):
+    body, written, _ = _read_body(headers, data)
+    assert isinstance(body, HttpError) and body.status == status and body.error == error
+    assert written == b''  # nothing is continued once the request is rejected
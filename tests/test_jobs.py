@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+from saicinpainting.inference.jobs import JobQueueFull, JobStore
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _encoded(data=b'png-bytes'):
+    return {'data': data, 'content_type': 'image/png', 'metadata': {'timings': {'forward': 12.5}, 'size': [4, 3]}}
+
+
+def test_lifecycle_and_timestamps():
+    clock = FakeClock()
+    store = JobStore(max_pending=2, ttl=60, clock=clock)
+    job = store.create({'image': 'x'})
+    assert job.status == 'queued' and job.created_at == 1000.0 and store.get(job.id) is job
+    clock.now += 1
+    store.start(job)
+    assert job.status == 'running' and job.payload is None and job.started_at == 1001.0
+    store.set_progress(job, stage='inpaint')
+    clock.now += 2
+    store.finish(job, _encoded())
+    assert job.status == 'done' and job.finished_at == 1003.0
+    assert job.progress == {'stage': 'done'} and job.timings == {'forward': 12.5}
+    assert store.get_result(job) == (b'png-bytes', 'image/png')
+    stats = store.stats()
+    assert stats['submitted'] == 1 and stats['done'] == 1 and stats['finished'] == 1 and stats['queued'] == 0
+
+
+def test_max_pending_counts_queued_and_running_jobs():
+    store = JobStore(max_pending=2, ttl=60, clock=FakeClock())
+    first, second = store.create({}), store.create({})
+    store.start(first)
+    with pytest.raises(JobQueueFull):
+        store.create({})
+    store.fail(second, 'bad input')
+    assert store.create({}) is not None
+    assert store.stats()['rejected'] == 1 and store.stats()['error'] == 1
+
+
+def test_finished_jobs_expire_after_ttl():
+    clock = FakeClock()
+    store = JobStore(max_pending=4, ttl=60, clock=clock)
+    done, failed, running = store.create({}), store.create({}), store.create({})
+    store.finish(done, _encoded())
+    clock.now += 30
+    store.fail(failed, 'bad input')
+    store.start(running)
+
+    clock.now += 40  # done is 70 s old, failed 40 s
+    assert store.get(done.id) is None
+    assert store.get(failed.id) is failed
+    clock.now += 30
+    assert store.evict_expired() == 1
+    assert store.get(failed.id) is None
+    # jobs that have not finished never expire
+    assert store.get(running.id) is running
+    assert store.stats()['evicted'] == 2
+
+
+def test_finished_jobs_are_persisted_and_served_from_disk(tmp_path):
+    store = JobStore(max_pending=4, ttl=60, persist_dir=str(tmp_path), clock=FakeClock())
+    done, failed, queued = store.create({}), store.create({}), store.create({})
+    store.finish(done, _encoded(b'\x89PNG result'))
+    store.fail(failed, 'bad input')
+    assert done.persisted and done.data is None
+    assert store.get_result(done) == (b'\x89PNG result', 'image/png')
+    assert sorted(os.listdir(tmp_path)) == sorted([f'{done.id}.json', f'{done.id}.bin', f'{failed.id}.json'])
+    assert not os.path.exists(tmp_path / f'{queued.id}.json')
+
+
+def test_restart_recovers_finished_jobs(tmp_path):
+    clock = FakeClock()
+    store = JobStore(max_pending=4, ttl=60, persist_dir=str(tmp_path), clock=clock)
+    done, failed, queued = store.create({}), store.create({}), store.create({})
+    store.finish(done, _encoded())
+    store.fail(failed, 'bad input')
+
+    clock.now += 10
+    restarted = JobStore(max_pending=4, ttl=60, persist_dir=str(tmp_path), clock=clock)
+    recovered = restarted.get(done.id)
+    assert recovered.to_dict() == done.to_dict()
+    assert restarted.get_result(recovered) == (b'png-bytes', 'image/png')
+    assert restarted.get(failed.id).error == 'bad input'
+    # queued and running jobs are lost with the process
+    assert restarted.get(queued.id) is None
+    assert restarted.stats()['finished'] == 2
+
+
+def test_restart_drops_expired_and_unreadable_jobs(tmp_path):
+    clock = FakeClock()
+    store = JobStore(max_pending=4, ttl=60, persist_dir=str(tmp_path), clock=clock)
+    old, recent = store.create({}), store.create({})
+    store.finish(old, _encoded())
+    clock.now += 50
+    store.finish(recent, _encoded())
+    (tmp_path / 'broken.json').write_text('{not json')
+
+    clock.now += 20  # old is 70 s old, recent 20 s
+    restarted = JobStore(max_pending=4, ttl=60, persist_dir=str(tmp_path), clock=clock)
+    assert restarted.get(old.id) is None
+    assert restarted.get(recent.id) is not None
+    assert sorted(os.listdir(tmp_path)) == sorted([f'{recent.id}.json', f'{recent.id}.bin'])
+
+    clock.now += 60
+    assert restarted.evict_expired() == 1
+    assert os.listdir(tmp_path) == []
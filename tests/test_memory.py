@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+from saicinpainting.inference.memory import InsufficientMemory, MemoryAdmission, MemoryModel
+
+MB = 2 ** 20
+
+
+def _make_admission(free_mb=1000, headroom_mb=100, timeout=0.2):
+    # 1 MB per 1024x1024 pixel block: a 1024x1024 run costs 1 MB + 10 MB fixed
+    model = MemoryModel(bytes_per_pixel=1.0, fixed_bytes=10 * MB)
+    free = {'bytes': free_mb * MB}
+    admission = MemoryAdmission(model, headroom_bytes=headroom_mb * MB, timeout=timeout, poll_interval=0.005,
+                                get_free=lambda: free['bytes'])
+    return admission, free
+
+
+def test_memory_model_fit_covers_every_point(tmp_path):
+    points = [dict(height=h, width=w, batch_size=b, peak_bytes=int(5e6 + 900 * b * h * w + noise))
+              for (h, w, b), noise in zip([(256, 256, 1), (512, 512, 1), (512, 768, 2), (1024, 1024, 1)],
+                                          [3e5, -2e5, 1e5, 0])]
+    model = MemoryModel.fit(points, device='cpu')
+    assert 850 < model.bytes_per_pixel < 950
+    assert all(model.peak_bytes(p['height'], p['width'], p['batch_size']) >= p['peak_bytes'] for p in points)
+
+    path = str(tmp_path / 'memory_model.json')
+    model.save(path)
+    loaded = MemoryModel.load(path)
+    assert loaded.peak_bytes(1000, 700, 2) == model.peak_bytes(1000, 700, 2)
+    assert loaded.info['device'] == 'cpu'
+
+
+def test_memory_model_pads_to_modulo():
+    model = MemoryModel(bytes_per_pixel=2.0, fixed_bytes=0)
+    assert model.peak_bytes(100, 100) == 2 * 104 * 104
+    assert model.max_pixels(model.peak_bytes(512, 512, 2), batch_size=2) == 512 * 512
+
+
+def test_capacity_is_free_memory_minus_headroom():
+    admission, free = _make_admission(free_mb=1000, headroom_mb=100)
+    assert admission.capacity == 900 * MB
+    free['bytes'] = 10 * MB  # later readings do not change the budget
+    assert admission.get_budget() == 900 * MB
+    assert admission.stats()['free_bytes'] == 10 * MB
+
+
+def test_reserve_and_release_accounting():
+    admission, free = _make_admission()
+    cost = admission.model.peak_bytes(1024, 1024)
+    with admission.reserve(1024, 1024) as waited:
+        assert waited < 0.1
+        assert admission.stats()['reserved_bytes'] == cost
+        # the allocations of the run lower the free memory, which must not be counted a second time
+        free['bytes'] -= cost
+        with admission.reserve(1024, 1024):
+            assert admission.stats()['reserved_bytes'] == 2 * cost
+        assert admission.stats()['reserved_bytes'] == cost
+    assert admission.stats()['reserved_bytes'] == 0
+    assert admission.stats()['admitted'] == 2
+
+
+def test_reservation_is_released_on_error():
+    admission, _ = _make_admission()
+    with pytest.raises(ValueError):
+        with admission.reserve(1024, 1024):
+            raise ValueError('model run failed')
+    assert admission.stats()['reserved_bytes'] == 0
+
+
+def test_queued_run_starts_once_the_run_in_flight_is_done():
+    # a 600 MB run next to another one does not fit 900 MB, alone it does
+    admission, _ = _make_admission(timeout=5.0)
+    height = width = 1024 * 24  # 576 MB + 10 MB
+    release = threading.Event()
+    reserved = threading.Event()
+
+    def first_run():
+        with admission.reserve(height, width):
+            reserved.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=first_run)
+    thread.start()
+    reserved.wait(5)
+    threading.Timer(0.05, release.set).start()
+    started_at = time.perf_counter()
+    with admission.reserve(height, width) as waited:
+        assert waited >= 0.04
+        assert time.perf_counter() - started_at >= 0.04
+    thread.join()
+    stats = admission.stats()
+    assert stats['queued'] == 1 and stats['admitted'] == 2 and stats['reserved_bytes'] == 0
+
+
+def test_timeout_raises_insufficient_memory():
+    admission, _ = _make_admission(timeout=0.05)
+    height = width = 1024 * 24
+    with admission.reserve(height, width):
+        with pytest.raises(InsufficientMemory, match='Timed out'):
+            with admission.reserve(height, width):
+                pass
+    stats = admission.stats()
+    assert stats['queued'] == 1 and stats['rejected'] == 1 and stats['reserved_bytes'] == 0
+
+
+def test_run_larger_than_capacity_is_rejected_right_away():
+    admission, _ = _make_admission(timeout=5.0)
+    started_at = time.perf_counter()
+    with pytest.raises(InsufficientMemory, match='available'):
+        with admission.reserve(1024 * 32, 1024 * 32):  # 1024 MB + 10 MB
+            pass
+    assert time.perf_counter() - started_at < 1.0
+    assert admission.stats()['rejected'] == 1 and admission.stats()['queued'] == 0
+
+
+def test_get_scale_and_max_side_fit_the_capacity():
+    admission, _ = _make_admission()
+    assert admission.get_scale(1024, 1024) == 1.0
+    height = width = 1024 * 40
+    scale = admission.get_scale(height, width)
+    assert scale < 1
+    side = int(height * scale) // 8 * 8
+    assert admission.model.peak_bytes(side, side) <= admission.capacity
+    max_side = admission.get_max_side(height, width)
+    assert admission.model.peak_bytes(max_side // 8 * 8, max_side // 8 * 8) <= admission.capacity
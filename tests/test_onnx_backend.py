@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from saicinpainting.inference import onnx_backend
+from saicinpainting.inference.model import InpaintingModel
+from saicinpainting.inference.onnx_backend import OnnxInpaintingModel, export_onnx, irfft2_matmul, rfft2_matmul
+from saicinpainting.training.modules.ffc import FFCResNetGenerator
+
+_real_export = torch.onnx.export
+
+
+def _make_model():
+    torch.manual_seed(0)
+    generator = FFCResNetGenerator(4, 3, ngf=8, n_downsampling=2, n_blocks=1, add_out_act='sigmoid',
+                                   init_conv_kwargs=dict(ratio_gin=0, ratio_gout=0, enable_lfu=False),
+                                   downsample_conv_kwargs=dict(ratio_gin=0, ratio_gout=0, enable_lfu=False),
+                                   resnet_conv_kwargs=dict(ratio_gin=0.75, ratio_gout=0.75, enable_lfu=False))
+    return InpaintingModel(generator).eval()
+
+
+@pytest.mark.parametrize('height, width', [(16, 16), (24, 40), (33, 17)])
+def test_matmul_fft_matches_torch_fft(height, width):
+    x = torch.rand(2, 3, height, width, dtype=torch.float64)
+    real, imag = rfft2_matmul(x)
+    expected = torch.fft.rfftn(x, dim=(-2, -1), norm='ortho')
+    torch.testing.assert_close(real, expected.real)
+    torch.testing.assert_close(imag, expected.imag)
+    torch.testing.assert_close(irfft2_matmul(real, imag, (height, width)), x)
+
+
+def _old_torch_export(model, args, f, export_params=True, verbose=False, input_names=None, output_names=None,
+                      opset_version=None, dynamic_axes=None):
+    """torch.onnx.export of torch < 2.5, which has no dynamo argument and always uses the TorchScript exporter"""
+    return _real_export(model, args, f, dynamo=False, export_params=export_params, verbose=verbose,
+                        input_names=input_names, output_names=output_names, opset_version=opset_version,
+                        dynamic_axes=dynamic_axes)
+
+
+@pytest.mark.parametrize('old_torch', [False, True])
+def test_export_matmul_dynamic_size(tmp_path, monkeypatch, old_torch):
+    pytest.importorskip('onnxruntime')
+    if old_torch:
+        monkeypatch.setattr(torch.onnx, 'export', _old_torch_export)
+        assert not onnx_backend._has_dynamo_exporter()
+    model = _make_model()
+    path = str(tmp_path / 'generator.onnx')
+    export_onnx(model, path, fft='matmul', sample_size=64)
+
+    onnx_model = OnnxInpaintingModel(path, threads=1)
+    for height, width in [(64, 64), (48, 80)]:
+        image = torch.rand(1, 3, height, width)
+        mask = (torch.rand(1, 1, height, width) > 0.7).float()
+        with torch.no_grad():
+            expected = model(dict(image=image, mask=mask))['inpainted']
+        actual = onnx_model(dict(image=image, mask=mask))['inpainted']
+        assert actual.shape == expected.shape
+        assert (actual - expected).abs().max().item() < 1e-5
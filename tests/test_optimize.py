@@ -0,0 +1,62 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from saicinpainting.inference.optimize import FoldedFFC_BN_ACT, optimize_for_inference
+from saicinpainting.training.modules.ffc import FFC_BN_ACT, FFCResNetGenerator
+
+# max abs difference of the sigmoid output, folding only reorders float32 multiply-adds
+MAX_ABS_DIFF = 1.2e-7
+
+
+def _make_generator(seed):
+    """big-lama layout at a small width, with BatchNorm statistics far from the identity"""
+    torch.manual_seed(seed)
+    generator = FFCResNetGenerator(4, 3, ngf=16, n_downsampling=2, n_blocks=3, add_out_act='sigmoid',
+                                   init_conv_kwargs=dict(ratio_gin=0, ratio_gout=0, enable_lfu=False),
+                                   downsample_conv_kwargs=dict(ratio_gin=0, ratio_gout=0, enable_lfu=False),
+                                   resnet_conv_kwargs=dict(ratio_gin=0.75, ratio_gout=0.75, enable_lfu=False))
+    for module in generator.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.2, 0.2)
+    return generator.eval()
+
+
+@pytest.fixture(scope='module', params=[0, 1, 2])
+def generators(request):
+    generator = _make_generator(request.param)
+    return generator, optimize_for_inference(copy.deepcopy(generator))
+
+
+def test_fold_removes_every_batch_norm(generators):
+    generator, folded = generators
+    assert any(isinstance(module, nn.BatchNorm2d) for module in generator.modules())
+    assert not any(isinstance(module, nn.BatchNorm2d) for module in folded.modules())
+    assert not any(isinstance(module, FFC_BN_ACT) for module in folded.modules())
+    assert sum(isinstance(module, FoldedFFC_BN_ACT) for module in folded.modules()) == \
+        sum(isinstance(module, FFC_BN_ACT) for module in generator.modules())
+
+
+def test_activations_after_folded_convs_run_in_place(generators):
+    _, folded = generators
+    acts = [act for module in folded.modules() if isinstance(module, nn.Sequential)
+            for conv, act in zip(module, module[1:])
+            if type(conv) in (nn.Conv2d, nn.ConvTranspose2d) and type(act) in (nn.ReLU, nn.LeakyReLU)]
+    assert acts  # the upsampler and the spectral conv1
+    assert all(act.inplace for act in acts)
+
+
+@pytest.mark.parametrize('height, width', [(64, 64), (48, 80), (96, 72)])
+def test_fold_matches_the_unfolded_forward(generators, height, width):
+    generator, folded = generators
+    torch.manual_seed(1)
+    x = torch.cat([torch.rand(2, 3, height, width), (torch.rand(2, 1, height, width) > 0.7).float()], dim=1)
+    with torch.no_grad():
+        expected, actual = generator(x), folded(x)
+    assert actual.shape == expected.shape
+    assert (actual - expected).abs().max().item() <= MAX_ABS_DIFF
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from saicinpainting.inference.roi import crop_roi, get_roi_bboxes, merge_close_bboxes, pad_to_size
+
+
+def _make_mask(height, width, boxes):
+    mask = np.zeros((height, width), np.uint8)
+    for x0, y0, x1, y1 in boxes:
+        mask[y0:y1, x0:x1] = 255
+    return mask
+
+
+def _assert_disjoint(bboxes):
+    for i, a in enumerate(bboxes):
+        for b in bboxes[i + 1:]:
+            assert a[2] <= b[0] or b[2] <= a[0] or a[3] <= b[1] or b[3] <= a[1], (a, b)
+
+
+def test_merge_close_bboxes_keeps_separated_boxes():
+    bboxes = [(0, 0, 10, 10), (50, 0, 60, 10), (0, 50, 10, 60)]
+    assert sorted(merge_close_bboxes(bboxes, 16)) == sorted(bboxes)
+
+
+def test_merge_close_bboxes_unions_adjacent_boxes():
+    assert merge_close_bboxes([(0, 0, 10, 10), (20, 0, 30, 10)], 16) == [(0, 0, 30, 10)]
+    # with no merge distance only overlapping boxes merge, touching ones share no pixel
+    assert merge_close_bboxes([(0, 0, 10, 10), (8, 0, 20, 10)], 0) == [(0, 0, 20, 10)]
+    assert merge_close_bboxes([(0, 0, 10, 10), (10, 0, 20, 10)], 0) == [(0, 0, 10, 10), (10, 0, 20, 10)]
+
+
+def test_merge_close_bboxes_merges_transitively():
+    # a-b and b-c are close but a-c are not, all three end up in one box
+    bboxes = [(0, 0, 10, 10), (20, 0, 30, 10), (40, 0, 50, 10)]
+    assert merge_close_bboxes(bboxes, 16) == [(0, 0, 50, 10)]
+
+
+def test_get_roi_bboxes_separated_components():
+    mask = _make_mask(512, 512, [(40, 40, 60, 60), (400, 400, 420, 440)])
+    bboxes = get_roi_bboxes(mask, margin=16, merge_distance=32)
+    assert bboxes == [(24, 24, 80, 80), (384, 384, 440, 456)]
+    for x0, y0, x1, y1 in bboxes:
+        assert x0 % 8 == 0 and y0 % 8 == 0 and x1 % 8 == 0 and y1 % 8 == 0
+    _assert_disjoint(bboxes)
+
+
+def test_get_roi_bboxes_adjacent_components_merge():
+    mask = _make_mask(512, 512, [(40, 40, 60, 60), (70, 40, 90, 60)])
+    assert get_roi_bboxes(mask, margin=16, merge_distance=32) == [(24, 24, 112, 80)]
+
+
+def test_get_roi_bboxes_overlapping_margins_merge():
+    # components farther apart than merge_distance whose context margins overlap still give disjoint crops
+    mask = _make_mask(512, 512, [(40, 40, 60, 60), (120, 40, 140, 60)])
+    bboxes = get_roi_bboxes(mask, margin=48, merge_distance=8)
+    assert bboxes == [(0, 0, 192, 112)]
+    _assert_disjoint(bboxes)
+
+
+def test_get_roi_bboxes_cover_the_mask():
+    rng = np.random.default_rng(0)
+    mask = (rng.random((300, 420)) > 0.998).astype(np.uint8) * 255
+    bboxes = get_roi_bboxes(mask, margin=8, merge_distance=24)
+    _assert_disjoint(bboxes)
+    covered = np.zeros(mask.shape, bool)
+    for x0, y0, x1, y1 in bboxes:
+        covered[y0:y1, x0:x1] = True
+    assert covered[mask > 0].all()
+
+
+def test_get_roi_bboxes_empty_mask():
+    assert get_roi_bboxes(np.zeros((64, 64), np.uint8), margin=16, merge_distance=32) == []
+
+
+@pytest.mark.parametrize('shape', [(37, 53), (37, 53, 3), (64, 64, 3)])
+def test_pad_to_size_round_trip(shape):
+    img = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    padded = pad_to_size(img, 64, 80)
+    assert padded.shape == (64, 80) + shape[2:]
+    assert padded.dtype == img.dtype
+    np.testing.assert_array_equal(crop_roi(padded, (0, 0, shape[1], shape[0])), img)
@@ -0,0 +1,60 @@
+import json
+import os
+
+import pytest
+import torch
+
+from saicinpainting.runtime import THREAD_ENV_VARS, configure_runtime, get_runtime_config
+
+
+@pytest.fixture
+def clean_env(monkeypatch):
+    for name in THREAD_ENV_VARS + ('RUNTIME_THREADS', 'RUNTIME_CONFIG', 'RUNTIME_INTEROP_THREADS', 'RUNTIME_CPUS',
+                                   'RUNTIME_NUMA_NODE', 'RUNTIME_ALLOCATOR'):
+        monkeypatch.delenv(name, raising=False)
+    threads = torch.get_num_threads()
+    yield monkeypatch
+    torch.set_num_threads(threads)
+
+
+def test_threads_default_to_usable_cpus(clean_env):
+    applied = configure_runtime(get_runtime_config())
+    cpus = len(os.sched_getaffinity(0))
+    assert applied['threads'] == cpus
+    assert all(os.environ[name] == str(cpus) for name in THREAD_ENV_VARS)
+
+
+def test_operator_thread_env_is_kept(clean_env):
+    clean_env.setenv('OMP_NUM_THREADS', '3')
+    clean_env.setenv('MKL_NUM_THREADS', '2')
+    config = get_runtime_config(default_threads=1)
+    assert config['threads'] == 3
+    applied = configure_runtime(config)
+    assert applied['threads'] == 3
+    assert os.environ['OMP_NUM_THREADS'] == '3' and os.environ['MKL_NUM_THREADS'] == '2'
+    assert os.environ['OPENBLAS_NUM_THREADS'] == '3'
+
+
+def test_operator_thread_env_wins_over_config_file(clean_env, tmp_path):
+    path = tmp_path / 'runtime.json'
+    path.write_text(json.dumps({'threads': 8}))
+    clean_env.setenv('RUNTIME_CONFIG', str(path))
+    assert get_runtime_config()['threads'] == 8
+    clean_env.setenv('MKL_NUM_THREADS', '2')
+    assert get_runtime_config()['threads'] == 2
+    clean_env.setenv('OMP_NUM_THREADS', '4,2')  # nested OpenMP levels, the outer one counts
+    assert get_runtime_config()['threads'] == 4
+
+
+def test_runtime_threads_replaces_thread_env(clean_env):
+    clean_env.setenv('OMP_NUM_THREADS', '3')
+    clean_env.setenv('RUNTIME_THREADS', '2')
+    applied = configure_runtime(get_runtime_config())
+    assert applied['threads'] == 2
+    assert all(os.environ[name] == '2' for name in THREAD_ENV_VARS)
+
+
+def test_invalid_thread_env_is_ignored(clean_env):
+    clean_env.setenv('OMP_NUM_THREADS', 'auto')
+    clean_env.setenv('MKL_NUM_THREADS', '0')
+    assert get_runtime_config(default_threads=1)['threads'] == 1
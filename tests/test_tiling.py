@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from saicinpainting.inference.tiling import get_tile_boxes, make_tile_weights, tiled_inpaint
+
+
+def _sum_weights(height, width, tile_size, overlap):
+    total = torch.zeros(1, 1, height, width)
+    for box in get_tile_boxes(height, width, tile_size, overlap):
+        y0, x0, y1, x1 = box
+        total[:, :, y0:y1, x0:x1] += make_tile_weights(box, height, width, overlap)
+    return total
+
+
+@pytest.mark.parametrize('height, width', [(64, 64 + 48 * 3), (64 + 48 * 2, 64)])
+def test_tile_weights_sum_to_one_over_overlaps(height, width):
+    # a single row or column of tiles with the stride dividing the size evenly: the ramps of neighbours
+    # cross-fade so that the weights of every pixel add up to exactly 1
+    torch.testing.assert_close(_sum_weights(height, width, 64, 16), torch.ones(1, 1, height, width))
+
+
+@pytest.mark.parametrize('height, width, tile_size, overlap', [(200, 300, 64, 16), (130, 97, 64, 24)])
+def test_tile_weights_cover_every_pixel(height, width, tile_size, overlap):
+    boxes = get_tile_boxes(height, width, tile_size, overlap)
+    assert all(y1 - y0 <= tile_size and x1 - x0 <= tile_size for y0, x0, y1, x1 in boxes)
+    assert (_sum_weights(height, width, tile_size, overlap) > 0).all()
+
+
+def _constant_model(value):
+    def model(batch):
+        return dict(batch, inpainted=torch.full_like(batch['image'], value))
+    return model
+
+
+def _make_batch(height, width, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    image = torch.rand(1, 3, height, width, generator=generator)
+    mask = (torch.rand(1, 1, height, width, generator=generator) > 0.7).float()
+    return dict(image=image, mask=mask)
+
+
+def test_tiled_inpaint_blends_to_the_prediction():
+    # normalized blending of identical tile predictions must give the prediction back in every masked pixel
+    batch = _make_batch(200, 300)
+    result = tiled_inpaint(_constant_model(0.25), batch, tile_size=64, overlap=16, context_size=None)
+    masked = batch['mask'].expand_as(result) > 0
+    torch.testing.assert_close(result[masked], torch.full_like(result[masked], 0.25))
+
+
+@pytest.mark.parametrize('context_size', [None, 64])
+def test_tiled_inpaint_keeps_unmasked_pixels(context_size):
+    batch = _make_batch(200, 300)
+
+    def noisy_model(batch):
+        return dict(batch, inpainted=torch.rand_like(batch['image']))
+
+    result = tiled_inpaint(noisy_model, batch, tile_size=64, overlap=16, context_size=context_size)
+    known = batch['mask'].expand_as(result) == 0
+    assert torch.equal(result[known], batch['image'][known])
+    # and byte-identical once converted back to uint8 like the handler does
+    to_uint8 = lambda img: (img * 255).clamp(0, 255).to(torch.uint8)
+    assert torch.equal(to_uint8(result)[known], to_uint8(batch['image'])[known])
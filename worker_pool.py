@@ -0,0 +1,306 @@
+import gc
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import recv_handle, send_handle
+from typing import Any, Dict, List
+
+import torch
+
+import rp_handler_cpu
+
+
+class WorkerError(RuntimeError):
+    """Exception raised by rp_handler_cpu in a worker, error_type is the name of its original class."""
+    def __init__(self, message: str, error_type: str = "RuntimeError"):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+def _split_cpus(n_workers: int) -> List[List[int]]:
+    """Split the CPUs this process may run on into n_workers contiguous, disjoint slices where possible."""
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < n_workers:
+        return [[cpus[i % len(cpus)]] for i in range(n_workers)]
+    per_worker = len(cpus) // n_workers
+    return [cpus[i * per_worker:(i + 1) * per_worker] for i in range(n_workers)]
+
+
+def _worker_main(index: int, conn, cpus: List[int], threads: int):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    if rp_handler_cpu.BACKEND == "onnxruntime":
+        # ONNX Runtime thread pools do not survive fork, so every worker opens its own session
+        from saicinpainting.inference.onnx_backend import OnnxInpaintingModel
+        rp_handler_cpu.INPAINTER = OnnxInpaintingModel(rp_handler_cpu.INPAINTER.path, threads)
+    # the scheduler thread is not inherited through fork, and a worker runs one request at a time anyway
+    rp_handler_cpu.SCHEDULER = None
+    print(f"[worker_pool] Worker {index} pid={os.getpid()} cpus={cpus} threads={threads}")
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        name, event = message
+        try:
+            reply = ("ok", getattr(rp_handler_cpu, name)(event))
+        except Exception as e:
+            reply = ("error", (type(e).__name__, str(e)))
+        # the occupancy of this worker's result cache rides along, for the metrics of the server
+        conn.send(reply + (rp_handler_cpu.RESULT_CACHE.stats(),))
+
+
+def _reap(pid: int, timeout: float) -> int:
+    """Exit code of the child pid, killed if it has not exited within timeout; -signal if a signal ended it."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            done, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            return 0  # already reaped
+        if done:
+            return os.waitstatus_to_exitcode(status)
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            deadline = float("inf")
+        time.sleep(0.05)
+
+
+def _supervisor_main(control, server_control):
+    """
+    Forks the workers on request. This process is forked when the pool is created, before the server starts
+    its event loop and thread pools, and stays single-threaded, so workers never inherit locks held by
+    threads of the serving process.
+    """
+    server_control.close()  # so that the control pipe reports EOF once the server is gone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole group, the server decides
+    children = {}
+    while True:
+        try:
+            message = control.recv()
+        except EOFError:
+            break
+        if message[0] == "start":
+            _, index, cpus, threads = message
+            conn = Connection(recv_handle(control))
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    control.close()
+                    _worker_main(index, conn, cpus, threads)
+                except BaseException:
+                    code = 1
+                finally:
+                    os._exit(code)
+            conn.close()
+            children[index] = pid
+            control.send(pid)
+        elif message[0] == "reap":
+            _, pid, timeout = message
+            control.send(_reap(pid, timeout))
+        elif message[0] == "stop":
+            _, timeout = message
+            for pid in children.values():
+                _reap(pid, timeout)
+            break
+    control.close()
+
+
+class _Worker:
+    def __init__(self, index, pid, conn, cpus, failures=0):
+        self.index = index
+        self.pid = pid
+        self.conn = conn
+        self.cpus = cpus
+        self.pending = deque()  # futures in the order their events were sent
+        self.outbox = queue.Queue()
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.cache = None  # RESULT_CACHE.stats() of the worker as of its last reply
+        self.alive = True
+        self.exitcode = None
+        self.started_at = time.monotonic()
+        self.failures = failures  # workers of this index in a row that died soon after start
+
+
+class WorkerPool:
+    """
+    Pre-forked inference processes running rp_handler_cpu.handler.
+
+    Workers are forked after rp_handler_cpu has loaded INPAINTER, so the weights are shared copy-on-write
+    instead of being loaded N times. Each worker is pinned to its own slice of CPUs with its own
+    intra-op thread count, and every event goes to the worker with the fewest outstanding events.
+    The forks are done by a supervisor process created with the pool, before the server starts any threads,
+    so a worker that dies (e.g. OOM-killed) fails its pending events and is forked again from that clean
+    state, after a delay that doubles while replacements keep dying within a minute of starting.
+    """
+    def __init__(self, n_workers: int, threads_per_worker: int = 0, pin_cpus: bool = True,
+                 restart_delay: float = 1.0, max_restart_delay: float = 60.0):
+        ctx = multiprocessing.get_context("fork")
+        self.cpu_slices = _split_cpus(n_workers)
+        self.threads_per_worker = threads_per_worker
+        self.pin_cpus = pin_cpus
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        # objects inherited from the parent are never collected in workers, so GC does not dirty their pages
+        gc.collect()
+        gc.freeze()
+
+        self.control, supervisor_control = ctx.Pipe()
+        self.supervisor = ctx.Process(target=_supervisor_main, args=(supervisor_control, self.control),
+                                      name="inference-supervisor", daemon=True)
+        self.supervisor.start()
+        supervisor_control.close()
+        self.control_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.closing = False
+        self.restarts = 0
+        self.workers = [self._start_worker(i) for i in range(n_workers)]
+
+    def _call_supervisor(self, message, handle=None):
+        with self.control_lock:
+            self.control.send(message)
+            if handle is not None:
+                send_handle(self.control, handle, self.supervisor.pid)
+            return self.control.recv()
+
+    def _start_worker(self, index: int, failures: int = 0) -> _Worker:
+        cpus = self.cpu_slices[index] if self.pin_cpus else None
+        threads = self.threads_per_worker or len(self.cpu_slices[index])
+        parent_conn, child_conn = multiprocessing.Pipe()
+        try:
+            pid = self._call_supervisor(("start", index, cpus or [], threads), child_conn.fileno())
+        finally:
+            child_conn.close()
+        worker = _Worker(index, pid, parent_conn, cpus, failures)
+        threading.Thread(target=self._send_loop, args=(worker,), daemon=True).start()
+        threading.Thread(target=self._recv_loop, args=(worker,), daemon=True).start()
+        return worker
+
+    @property
+    def size(self) -> int:
+        return len(self.workers)
+
+    def submit(self, event: Dict[str, Any], fn: str = "handler") -> Future:
+        """Run rp_handler_cpu.<fn>(event) on the least loaded live worker, the future resolves to its result."""
+        future = Future()
+        with self.lock:
+            alive = [worker for worker in self.workers if worker.alive]
+            if not alive:
+                raise RuntimeError("All inference workers are dead")
+            worker = min(alive, key=lambda w: len(w.pending))
+            worker.pending.append(future)
+            worker.outbox.put((fn, event))
+        return future
+
+    def _send_loop(self, worker: _Worker):
+        while True:
+            message = worker.outbox.get()
+            try:
+                worker.conn.send(message)
+            except (OSError, ValueError):
+                return
+            if message is None:
+                return
+
+    def _recv_loop(self, worker: _Worker):
+        while True:
+            try:
+                status, result, cache = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = worker.pending.popleft()
+                worker.completed += 1
+                worker.cache = cache
+            if status == "ok":
+                future.set_result(result)
+            else:
+                error_type, message = result
+                future.set_exception(WorkerError(message, error_type))
+
+        with self.lock:
+            worker.alive = False  # no new events for it
+        worker.outbox.put(None)  # ends its send loop
+        worker.conn.close()
+        try:
+            worker.exitcode = self._call_supervisor(("reap", worker.pid, 5.0))
+        except (EOFError, OSError):
+            pass  # the supervisor is gone, and its workers with it
+
+        with self.lock:
+            pending = list(worker.pending)
+            worker.pending.clear()
+        if pending or not self.closing:
+            print(f"[worker_pool] Worker {worker.index} exited with code {worker.exitcode}, "
+                  f"failing {len(pending)} request(s)")
+        for future in pending:
+            future.set_exception(WorkerError(f"Inference worker {worker.index} died", "WorkerDied"))
+        if not self.closing:
+            self._restart(worker)
+
+    def _restart(self, worker: _Worker):
+        """Fork a replacement of a dead worker into its slot."""
+        failures = worker.failures + 1 if time.monotonic() - worker.started_at < 60 else 0
+        delay = min(self.max_restart_delay, self.restart_delay * 2 ** max(0, failures - 1))
+        print(f"[worker_pool] Restarting worker {worker.index} in {delay:g}s")
+        time.sleep(delay)
+        if self.closing:
+            return
+        try:
+            replacement = self._start_worker(worker.index, failures)
+        except (EOFError, OSError) as e:
+            print(f"[worker_pool] Could not restart worker {worker.index}: {e}")
+            return
+        with self.lock:
+            self.workers[worker.index] = replacement
+            self.restarts += 1
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [{"index": worker.index, "pid": worker.pid, "alive": worker.alive,
+                     "cpus": worker.cpus, "pending": len(worker.pending), "completed": worker.completed}
+                    for worker in self.workers]
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Result cache occupancy of the live workers: their memory tiers add up, the disk tier is shared so it is
+        the largest count any of them has seen"""
+        with self.lock:
+            caches = [worker.cache for worker in self.workers if worker.alive and worker.cache is not None]
+        return {"memory_entries": sum(cache["memory_entries"] for cache in caches),
+                "memory_bytes": sum(cache["memory_bytes"] for cache in caches),
+                "disk_entries": max((cache["disk_entries"] for cache in caches), default=0),
+                "disk_bytes": max((cache["disk_bytes"] for cache in caches), default=0)}
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            alive = sum(worker.alive for worker in self.workers)
+            return {"alive": alive, "dead": len(self.workers) - alive, "restarts": self.restarts}
+
+    def close(self, timeout: float = 10.0):
+        with self.lock:
+            self.closing = True
+            workers = list(self.workers)
+        for worker in workers:
+            worker.outbox.put(None)
+        try:
+            with self.control_lock:
+                self.control.send(("stop", timeout))  # waits for the workers, killing the ones still running
+        except OSError:
+            pass
+        self.supervisor.join(timeout + 5.0)
+        if self.supervisor.is_alive():
+            self.supervisor.terminate()